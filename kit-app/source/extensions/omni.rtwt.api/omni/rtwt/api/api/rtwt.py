@@ -757,13 +757,14 @@ def set_gradient_scale(min_val: float, max_val: float) -> bool:
     return True
 
 @app.request
-def load_uploaded_files(stl_filename: str = None, streamlines_filename: str = None) -> bool:
+def load_uploaded_files(stl_filename: str = None, streamlines_filename: str = None, triangle_budget: int = None) -> bool:
     """
     Load uploaded STL and/or streamlines files into the scene
 
     Args:
         stl_filename: Name of the STL file to load (optional)
         streamlines_filename: Name of the streamlines JSON file to load (optional)
+        triangle_budget: Maximum number of STL triangles, loads a coarser level of detail of large meshes (optional)
 
     Returns:
         bool: True if successful, False otherwise
@@ -781,7 +782,8 @@ def load_uploaded_files(stl_filename: str = None, streamlines_filename: str = No
             stl_path = os.path.join(upload_dir, "stl", stl_filename)
             if os.path.exists(stl_path):
                 carb.log_info(f"Loading STL file: {stl_path}")
-                result = load_stl_as_mesh(stl_path, stage, mesh_prim_path="/World/UploadedSTL")
+                result = load_stl_as_mesh(stl_path, stage, mesh_prim_path="/World/UploadedSTL",
+                                          triangle_budget=triangle_budget)
                 if not result:
                     carb.log_error(f"Failed to load STL file: {stl_filename}")
                     success = False
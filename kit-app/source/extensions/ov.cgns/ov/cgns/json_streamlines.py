@@ -5,13 +5,95 @@ Loads streamlines from JSON format and creates USD BasisCurves primitives
 
 import json
 import numpy as np
+from pathlib import Path
 from pxr import Usd, UsdGeom, Vt, Gf
 import carb
 
+# binary copy of an uploaded JSON file, written by the upload service (see upload-service/STREAMLINE_FORMAT.md)
+ARRAYS_SUFFIX = ".arrays"
+# welded mesh of an uploaded STL file, written by the upload service
+MESH_SUFFIX = ".mesh"
+
+
+def load_streamline_arrays(json_path, simplified=True):
+    """
+    Memory map the binary copy of a streamlines JSON file
+
+    Args:
+        json_path: Path to the JSON file
+        simplified: Only the points kept by the simplification of the upload service, if it has run
+
+    Returns:
+        tuple: (points float32 (P, 3), vertex counts int32 (L,), scalars float32 (P,) or None),
+        None if there is no binary copy or it is older than the JSON file
+    """
+    json_path = Path(json_path)
+    arrays_dir = json_path.with_suffix(ARRAYS_SUFFIX)
+    try:
+        with open(arrays_dir / "meta.json", 'r') as f:
+            meta = json.load(f)
+        stat = json_path.stat()
+        if meta.get("source_size") != stat.st_size or meta.get("source_mtime_ns") != stat.st_mtime_ns:
+            return None
+
+        points = np.load(arrays_dir / "points.npy", mmap_mode='r')
+        counts = np.load(arrays_dir / "counts.npy", mmap_mode='r')
+        scalars = np.load(arrays_dir / "scalars.npy", mmap_mode='r') if "scalars" in meta.get("arrays", []) else None
+
+        if simplified and "kept" in meta.get("arrays", []):
+            # the scalars stay aligned with the kept points
+            kept = np.load(arrays_dir / "kept.npy")
+            points = points[kept]
+            counts = np.load(arrays_dir / "kept_counts.npy")
+            scalars = scalars[kept] if scalars is not None else None
+    except (OSError, ValueError):
+        return None
+
+    return points, counts, scalars
+
+
+def load_mesh_arrays(stl_path, triangle_budget=None):
+    """
+    Memory map the welded mesh of an STL file
+
+    Args:
+        stl_path: Path to the STL file
+        triangle_budget: Optional maximum number of triangles, picks the most detailed level of detail
+            within it (the coarsest if none fits), the full mesh if None
+
+    Returns:
+        tuple: (vertices float32 (V, 3), faces int32 (F, 3), normals float32 (V, 3)),
+        None if there is no mesh or it is older than the STL file
+    """
+    stl_path = Path(stl_path)
+    mesh_dir = stl_path.with_suffix(MESH_SUFFIX)
+    try:
+        with open(mesh_dir / "meta.json", 'r') as f:
+            meta = json.load(f)
+        stat = stl_path.stat()
+        if meta.get("source_size") != stat.st_size or meta.get("source_mtime_ns") != stat.st_mtime_ns:
+            return None
+
+        level = 0
+        lods = meta.get("lods") or []
+        if triangle_budget is not None and lods:
+            fitting = [lod for lod in lods if lod["num_faces"] <= triangle_budget]
+            level = (max(fitting, key=lambda lod: lod["num_faces"]) if fitting
+                     else min(lods, key=lambda lod: lod["num_faces"]))["level"]
+        prefix = "" if level == 0 else f"lod{level}_"
+
+        vertices = np.load(mesh_dir / f"{prefix}vertices.npy", mmap_mode='r')
+        faces = np.load(mesh_dir / f"{prefix}faces.npy", mmap_mode='r')
+        normals = np.load(mesh_dir / f"{prefix}normals.npy", mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    return vertices, faces, normals
+
 
 def load_streamlines_from_json(json_path, stage, parent_prim_path="/World/Streamlines",
                                 curve_prim_path="/World/Streamlines/StreamLines",
-                                width=0.5):
+                                width=0.5, simplified=True):
     """
     Load streamlines from a JSON file and create USD BasisCurves
 
@@ -21,6 +103,7 @@ def load_streamlines_from_json(json_path, stage, parent_prim_path="/World/Stream
         parent_prim_path: Path to the parent prim for streamlines
         curve_prim_path: Path to the curves prim
         width: Line width for visualization
+        simplified: Load the lines simplified by the upload service (nearly collinear points dropped) if available
 
     Returns:
         bool: True if successful, False otherwise
@@ -28,18 +111,74 @@ def load_streamlines_from_json(json_path, stage, parent_prim_path="/World/Stream
     try:
         carb.log_info(f"Loading streamlines from JSON: {json_path}")
 
-        # Read JSON file
-        with open(json_path, 'r') as f:
-            data = json.load(f)
+        streamline_arrays = load_streamline_arrays(json_path, simplified)
+        if streamline_arrays is not None:
+            carb.log_info(f"Using the binary copy of {json_path}")
+            points, counts, scalars = streamline_arrays
+            if len(counts) == 0:
+                carb.log_warn("No streamlines found in JSON file")
+                return False
+
+            # lines with fewer than 2 points are skipped, as for the JSON
+            valid = np.asarray(counts) >= 2
+            if not np.all(valid):
+                carb.log_warn(f"{int(np.sum(~valid))} streamlines have fewer than 2 points, skipping")
+            point_mask = np.repeat(valid, counts)
+
+            all_vertices = np.ascontiguousarray(points[point_mask], dtype=np.float32)
+            curve_vertex_counts = np.asarray(counts)[valid].tolist()
+            has_scalars = scalars is not None
+            # lines without scalars are NaN in the binary copy, zeros as for the JSON
+            all_scalars = np.nan_to_num(np.asarray(scalars)[point_mask], nan=0.0) if has_scalars else []
+        else:
+            # Read JSON file
+            with open(json_path, 'r') as f:
+                data = json.load(f)
+
+            if "streamlines" not in data:
+                carb.log_error("JSON file must contain 'streamlines' array")
+                return False
+
+            streamlines = data["streamlines"]
+            if len(streamlines) == 0:
+                carb.log_warn("No streamlines found in JSON file")
+                return False
+
+            # Collect all vertices and curve counts
+            all_vertices = []
+            curve_vertex_counts = []
+            all_scalars = []
+            has_scalars = False
+
+            for i, streamline in enumerate(streamlines):
+                path = streamline.get("path", [])
+                if len(path) < 2:
+                    carb.log_warn(f"Streamline {i} has fewer than 2 points, skipping")
+                    continue
+
+                # Convert path to numpy array
+                path_array = np.array(path, dtype=np.float32)
+
+                # Convert to 100cm scale (USD uses cm by default in Omniverse)
+                # path_array *= 100.0
+
+                all_vertices.append(path_array)
+                curve_vertex_counts.append(len(path))
+
+                # Get scalar values if available
+                if "scalar" in streamline:
+                    scalars = streamline["scalar"]
+                    if len(scalars) == len(path):
+                        all_scalars.extend(scalars)
+                        has_scalars = True
+                    else:
+                        # Pad with zeros if length doesn't match
+                        all_scalars.extend([0.0] * len(path))
+                else:
+                    # No scalars for this streamline
+                    all_scalars.extend([0.0] * len(path))
 
-        if "streamlines" not in data:
-            carb.log_error("JSON file must contain 'streamlines' array")
-            return False
-
-        streamlines = data["streamlines"]
-        if len(streamlines) == 0:
-            carb.log_warn("No streamlines found in JSON file")
-            return False
+            all_vertices = np.concatenate(all_vertices) if all_vertices else np.zeros((0, 3), dtype=np.float32)
 
         # Ensure parent prim exists
         parent_prim = stage.GetPrimAtPath(parent_prim_path)
@@ -55,47 +194,13 @@ def load_streamlines_from_json(json_path, stage, parent_prim_path="/World/Stream
         curves_prim = stage.DefinePrim(curve_prim_path, "BasisCurves")
         basis_curves = UsdGeom.BasisCurves(curves_prim)
 
-        # Collect all vertices and curve counts
-        all_vertices = []
-        curve_vertex_counts = []
-        all_scalars = []
-        has_scalars = False
-
-        for i, streamline in enumerate(streamlines):
-            path = streamline.get("path", [])
-            if len(path) < 2:
-                carb.log_warn(f"Streamline {i} has fewer than 2 points, skipping")
-                continue
-
-            # Convert path to numpy array
-            path_array = np.array(path, dtype=np.float32)
-
-            # Convert to 100cm scale (USD uses cm by default in Omniverse)
-            # path_array *= 100.0
-
-            all_vertices.extend(path_array.tolist())
-            curve_vertex_counts.append(len(path))
-
-            # Get scalar values if available
-            if "scalar" in streamline:
-                scalars = streamline["scalar"]
-                if len(scalars) == len(path):
-                    all_scalars.extend(scalars)
-                    has_scalars = True
-                else:
-                    # Pad with zeros if length doesn't match
-                    all_scalars.extend([0.0] * len(path))
-            else:
-                # No scalars for this streamline
-                all_scalars.extend([0.0] * len(path))
-
         if len(all_vertices) == 0:
             carb.log_error("No valid streamlines found")
             return False
 
         # Set curve attributes
         basis_curves.GetCurveVertexCountsAttr().Set(curve_vertex_counts)
-        basis_curves.GetPointsAttr().Set(Vt.Vec3fArray([Gf.Vec3f(*v) for v in all_vertices]))
+        basis_curves.GetPointsAttr().Set(Vt.Vec3fArray.FromNumpy(all_vertices))
         basis_curves.GetTypeAttr().Set("linear")  # Linear curves (straight lines between points)
         basis_curves.GetWrapAttr().Set("nonperiodic")
 
@@ -116,28 +221,19 @@ def load_streamlines_from_json(json_path, stage, parent_prim_path="/World/Stream
                 normalized_scalars = np.zeros_like(scalars_array)
 
             # Create color map (blue -> cyan -> green -> yellow -> red)
-            colors = []
-            for s in normalized_scalars:
-                if s < 0.25:
-                    # Blue to cyan
-                    t = s / 0.25
-                    color = Gf.Vec3f(0.0, t, 1.0)
-                elif s < 0.5:
-                    # Cyan to green
-                    t = (s - 0.25) / 0.25
-                    color = Gf.Vec3f(0.0, 1.0, 1.0 - t)
-                elif s < 0.75:
-                    # Green to yellow
-                    t = (s - 0.5) / 0.25
-                    color = Gf.Vec3f(t, 1.0, 0.0)
-                else:
-                    # Yellow to red
-                    t = (s - 0.75) / 0.25
-                    color = Gf.Vec3f(1.0, 1.0 - t, 0.0)
-
-                colors.append(color)
-
-            basis_curves.GetDisplayColorAttr().Set(Vt.Vec3fArray(colors))
+            segment = np.minimum((normalized_scalars / 0.25).astype(np.int32), 3)
+            t = normalized_scalars / 0.25 - segment
+            zeros = np.zeros_like(t)
+            ones = np.ones_like(t)
+            colors = np.select(
+                [segment[:, None] == i for i in range(4)],
+                [np.stack([zeros, t, ones], axis=1),           # Blue to cyan
+                 np.stack([zeros, ones, 1.0 - t], axis=1),     # Cyan to green
+                 np.stack([t, ones, zeros], axis=1),           # Green to yellow
+                 np.stack([ones, 1.0 - t, zeros], axis=1)]     # Yellow to red
+            ).astype(np.float32)
+
+            basis_curves.GetDisplayColorAttr().Set(Vt.Vec3fArray.FromNumpy(colors))
             basis_curves.GetDisplayColorPrimvar().SetInterpolation("vertex")
 
         else:
@@ -160,7 +256,7 @@ def load_streamlines_from_json(json_path, stage, parent_prim_path="/World/Stream
         return False
 
 
-def load_stl_as_mesh(stl_path, stage, mesh_prim_path="/World/UploadedSTL"):
+def load_stl_as_mesh(stl_path, stage, mesh_prim_path="/World/UploadedSTL", triangle_budget=None):
     """
     Load an STL file and create a USD mesh
 
@@ -168,17 +264,29 @@ def load_stl_as_mesh(stl_path, stage, mesh_prim_path="/World/UploadedSTL"):
         stl_path: Path to the STL file
         stage: USD stage
         mesh_prim_path: Path for the USD mesh prim
+        triangle_budget: Optional maximum number of triangles, loads a level of detail of the mesh
+            prepared by the upload service
 
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        import trimesh
+        # the mesh prepared by the upload service skips parsing and welding the STL
+        mesh_arrays = load_mesh_arrays(stl_path, triangle_budget)
+        if mesh_arrays is not None:
+            carb.log_info(f"Loading mesh arrays of STL file: {stl_path}")
+            vertices, faces, normals = mesh_arrays
+        else:
+            import trimesh
 
-        carb.log_info(f"Loading STL file: {stl_path}")
+            carb.log_info(f"Loading STL file: {stl_path}")
 
-        # Load STL using trimesh
-        mesh = trimesh.load(str(stl_path))
+            # Load STL using trimesh
+            mesh = trimesh.load(str(stl_path))
+            vertices = mesh.vertices.astype(np.float32)
+            faces = mesh.faces.astype(np.int32)
+            # Compute normals if available
+            normals = mesh.vertex_normals.astype(np.float32) if hasattr(mesh, 'vertex_normals') else None
 
         # Get existing prim or create new one
         mesh_prim = stage.GetPrimAtPath(mesh_prim_path)
@@ -190,27 +298,21 @@ def load_stl_as_mesh(stl_path, stage, mesh_prim_path="/World/UploadedSTL"):
         mesh_prim = stage.DefinePrim(mesh_prim_path, "Mesh")
         usd_mesh = UsdGeom.Mesh(mesh_prim)
 
-        # Convert vertices and faces
-        vertices = mesh.vertices.astype(np.float32)
-        faces = mesh.faces.astype(np.int32)
-
         # Convert to 100cm scale (USD uses cm in Omniverse)
         # vertices *= 100.0
 
         # Set mesh data
-        usd_mesh.GetPointsAttr().Set(Vt.Vec3fArray([Gf.Vec3f(*v) for v in vertices]))
+        usd_mesh.GetPointsAttr().Set(Vt.Vec3fArray.FromNumpy(np.ascontiguousarray(vertices, dtype=np.float32)))
 
         # Flatten faces array for USD
-        face_vertex_counts = [3] * len(faces)  # All triangles
-        face_vertex_indices = faces.flatten().tolist()
+        face_vertex_counts = np.full(len(faces), 3, dtype=np.int32)  # All triangles
+        face_vertex_indices = np.ascontiguousarray(faces, dtype=np.int32).reshape(-1)
 
-        usd_mesh.GetFaceVertexCountsAttr().Set(face_vertex_counts)
-        usd_mesh.GetFaceVertexIndicesAttr().Set(face_vertex_indices)
+        usd_mesh.GetFaceVertexCountsAttr().Set(Vt.IntArray.FromNumpy(face_vertex_counts))
+        usd_mesh.GetFaceVertexIndicesAttr().Set(Vt.IntArray.FromNumpy(face_vertex_indices))
 
-        # Compute normals if available
-        if hasattr(mesh, 'vertex_normals'):
-            normals = mesh.vertex_normals.astype(np.float32)
-            usd_mesh.GetNormalsAttr().Set(Vt.Vec3fArray([Gf.Vec3f(*n) for n in normals]))
+        if normals is not None:
+            usd_mesh.GetNormalsAttr().Set(Vt.Vec3fArray.FromNumpy(np.ascontiguousarray(normals, dtype=np.float32)))
 
         # Set display color (light gray)
         display_color = Gf.Vec3f(0.8, 0.8, 0.8)
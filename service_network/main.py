@@ -19,8 +19,37 @@ if __name__ == "__main__":
                         help="Protocol for ZMQ (default=tcp)")
     parser.add_argument('--zmq_tmp', type=str, default="",
                         help=f"Tmp dir for ZMQ (default='')")
+    parser.add_argument('--zmq_chunk_size', type=int, default=None,
+                        help="Fixed chunk size in bytes, 0 sends arrays in one chunk (default: auto-tuned)")
+    parser.add_argument('--zmq_reliable', action='store_true',
+                        help="Open a credit-based DEALER/ROUTER data channel next to the PUB sockets (default: False)")
+    parser.add_argument('--zmq_surface', action='store_true',
+                        help="Open an XPUB socket publishing the surface fields on subscription (default: False)")
+    parser.add_argument('--zmq_multiplex', action='store_true',
+                        help="Publish all fields on one PUB socket with topic frames instead of a port per field (default: False)")
+    parser.add_argument('--record', type=str, default="",
+                        help="Append every config request to a JSON lines file, see replay.py (default: '')")
     parser.add_argument('--unnormalization', action='store_true',
                         help='Unnormalize dataset (default: False)')
+    parser.add_argument('--voxel_fields', action='store_true',
+                        help="Also publish velocity and pressure voxelized into a sparse block grid (default: False)")
+    parser.add_argument('--cell_size', type=float, default=1.625,
+                        help="Voxel size in stage units, should match exts.\"omni.cgns\".cell_size (default=1.625)")
+    parser.add_argument('--streamline_fields', action='store_true',
+                        help="Also publish streamlines traced on the CPU from the request 'seeds' (default: False)")
+    parser.add_argument('--streamline_workers', type=int, default=None,
+                        help="Worker processes for the streamline tracing (default: CPU count)")
+    parser.add_argument('--derived_fields', type=str, nargs='*', default=[],
+                        choices=['velocity_magnitude', 'vorticity', 'cp'],
+                        help="Also publish fields derived from velocity and pressure (default: none)")
+    parser.add_argument('--files', type=str, default="",
+                        help="Serve designs from files instead of uploads, path with a %%d for the design index (default: '')")
+    parser.add_argument('--files_from', type=int, default=1,
+                        help="First design index of --files (default=1)")
+    parser.add_argument('--files_to', type=int, default=1,
+                        help="Last design index of --files (default=1)")
+    parser.add_argument('--watch_files', action='store_true',
+                        help="Add, refresh and remove designs when the files of --files change (default: False)")
     parser.add_argument("--num_points", type=int, default=1_255_000,
                         help="Number of requested sampled points (1.255.000)")
 
@@ -30,12 +59,28 @@ if __name__ == "__main__":
     zmq_port_offset = args.zmq_port_offset
     zmq_protocol = args.zmq_protocol
     zmq_tmp = args.zmq_tmp
+    zmq_chunk_size = args.zmq_chunk_size
+    zmq_reliable = args.zmq_reliable
+    zmq_surface = args.zmq_surface
+    zmq_multiplex = args.zmq_multiplex
+    record = args.record
 
     unnormalize_data = args.unnormalization
     num_points = args.num_points
+    voxel_fields = args.voxel_fields
+    cell_size = args.cell_size
+    streamline_fields = args.streamline_fields
+    streamline_workers = args.streamline_workers
+    derived_fields = args.derived_fields
+    files = {'filepath': args.files, 'from': args.files_from, 'to': args.files_to, 'watch': args.watch_files} if args.files else []
 
     # define fields which will be sent as an array ('bounding_box_dims' are only used locally)
     field_names = ["coordinates", "velocity", "pressure", "sdf"]
+    if voxel_fields:
+        field_names += ["voxel_blocks", "voxel_masks", "voxel_values"]
+    if streamline_fields:
+        field_names += ["streamline_points", "streamline_counts"]
+    field_names += derived_fields
 
     # paths are relative and are added to the path in STL_ROOT in inference.py
     stl_ids = (
@@ -48,12 +93,16 @@ if __name__ == "__main__":
         list(range(500, 516))
     )
     stl_path_format = "design_%d_1/aero_suv_low.stl"
-    stream_velocity = 30    # default value
+    stream_velocity = 30    # default value, used for 'cp' of designs without 'stream_velocity'
 
     rank = 0
 
     print(f"Current config: unnormalize dataset: {unnormalize_data}")
     print(f"                num_points: {num_points:,}")
+    print(f"                voxel fields: {voxel_fields} (cell size: {cell_size})")
+    print(f"                streamline fields: {streamline_fields}")
+    print(f"                derived fields: {derived_fields}")
+    print(f"                files: {files['filepath'] if files else 'uploads'} (watch: {args.watch_files})")
 
     zmq_port = zmq_first_port + rank * zmq_port_offset
     zmq_tmp_dir = zmq_tmp if zmq_protocol == "ipc" else ""
@@ -62,10 +111,24 @@ if __name__ == "__main__":
     print(f"                config request port: {zmq_port}")
     print(f"                zmpq protocol: {zmq_protocol}")
     print(f"                tmp dir: {zmq_tmp_dir}")
+    print(f"                chunk size: {'auto' if zmq_chunk_size is None else zmq_chunk_size}")
+    print(f"                reliable channel: {zmq_reliable}")
+    print(f"                surface channel: {zmq_surface}")
+    print(f"                multiplexed publisher: {zmq_multiplex}")
+    print(f"                record requests: {record or False}")
 
     service_zmq = ServiceZMQ(
+        files=files,
         field_names=field_names,
         unnormalize=unnormalize_data,
-        num_points=num_points
+        num_points=num_points,
+        cell_size=cell_size,
+        streamline_workers=streamline_workers,
+        stream_velocity=stream_velocity,
+        chunk_size=zmq_chunk_size,
+        reliable=zmq_reliable,
+        surface=zmq_surface,
+        multiplex=zmq_multiplex,
+        record=record
     )
     asyncio.run(service_zmq.run(zmq_port, zmq_dir=zmq_tmp_dir))   
@@ -0,0 +1,238 @@
+import asyncio
+import argparse
+import json
+import time
+import numpy as np
+import zmq
+import zmq.asyncio
+
+TOC_TOPIC = b"__toc__|"
+PERCENTILES = [50, 90, 99]
+
+
+class UpdateTracker():
+    '''Fields received per update, updates are told apart by the timestamp the replayer sets'''
+
+    def __init__(self):
+        self.sent = {}          # timestamp -> send time
+        self.fields = {}        # timestamp -> {field_name: complete}
+        self.expected = {}      # timestamp -> field count announced by a table of contents
+        self.last_end = {}      # timestamp -> time the last field ended
+        self.bytes = 0
+
+    def on_toc(self, toc):
+        self.expected[toc['timestamp']] = len(toc['fields'])
+
+    def on_field(self, metadata, nbytes):
+        timestamp = metadata.get('timestamp')
+        if timestamp not in self.sent:
+            return
+        expected = int(np.prod(metadata['shape'])) * np.dtype(metadata['dtype']).itemsize
+        self.fields.setdefault(timestamp, {})[metadata['field_name']] = nbytes == expected
+        self.last_end[timestamp] = time.perf_counter()
+
+    def field_count(self):
+        '''Fields of a complete update, from the tables of contents or the most fields seen'''
+
+        counts = list(self.expected.values()) or [len(f) for f in self.fields.values()]
+        return max(counts, default=0)
+
+    def is_complete(self, timestamp):
+        fields = self.fields.get(timestamp, {})
+        expected = self.expected.get(timestamp, self.field_count())
+        return len(fields) >= expected > 0 and all(fields.values())
+
+    def pending(self):
+        return [t for t in self.sent if not self.is_complete(t)]
+
+
+async def receive_fields(socket, tracker, multiplexed):
+    '''Read field transfers (metadata, START, chunks, END) from a SUB socket'''
+
+    streams = {}    # topic -> {'state', 'metadata', 'bytes'}
+    while True:
+        frames = await socket.recv_multipart()
+        topic, frame = (frames[0], frames[1]) if multiplexed else (b"", frames[0])
+        tracker.bytes += len(frame)
+
+        if topic == TOC_TOPIC:
+            tracker.on_toc(json.loads(frame))
+            continue
+
+        stream = streams.setdefault(topic, {'state': 'metadata'})
+        if stream['state'] == 'metadata':
+            try:
+                stream['metadata'] = json.loads(frame)
+                stream['state'] = 'start'
+            except ValueError:
+                pass    # joined in the middle of a transfer
+        elif stream['state'] == 'start':
+            stream['state'] = 'data' if frame == b"START" else 'metadata'
+            stream['bytes'] = 0
+        elif frame == b"END":
+            tracker.on_field(stream['metadata'], stream['bytes'])
+            stream['state'] = 'metadata'
+        else:
+            stream['bytes'] += len(frame)
+
+
+def latency_stats(latencies):
+    if not latencies:
+        return {}
+    values = np.array(latencies) * 1e3
+    stats = {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+    stats['max'] = round(float(values.max()), 2)
+    return stats
+
+
+async def replay(args):
+    entries = []
+    with open(args.log) as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    if args.limit:
+        entries = entries[:args.limit]
+    configs = [e for e in entries if e['request'].get('request_type', 'config') == 'config' and e['request'].get('id', 0) >= 0]
+    if not configs:
+        raise RuntimeError(f"No config requests in '{args.log}'")
+
+    context = zmq.asyncio.Context()
+    url = f"tcp://{args.host}:"
+
+    socket = context.socket(zmq.REQ)
+    # a lost reply does not block the next request
+    socket.setsockopt(zmq.REQ_RELAXED, 1)
+    socket.setsockopt(zmq.REQ_CORRELATE, 1)
+    socket.connect(f"{url}{args.port}")
+
+    # the first config tells the number of field sockets, its data is not measured
+    await socket.send_json(dict(configs[0]['request'], timestamp=-1))
+    reply = await asyncio.wait_for(socket.recv_string(), args.timeout)
+    if not reply.isdigit():
+        # e.g. requests of sessions replayed without --zmq_multiplex
+        raise RuntimeError(f"Config request refused by the service: {reply}")
+    fields_cnt = int(reply)
+
+    tracker = UpdateTracker()
+    subscribers = []
+    for i in range(1 if args.multiplex else fields_cnt):
+        subscriber = context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.RCVHWM, 0)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        subscriber.connect(f"{url}{args.port + 1 + i}")
+        subscribers.append(asyncio.ensure_future(receive_fields(subscriber, tracker, args.multiplex)))
+    await asyncio.sleep(args.warmup)
+
+    print(f"Replaying {len(entries)} requests ({len(configs)} configs) at {'max speed' if args.speed <= 0 else f'{args.speed}x'}...")
+
+    queries = {}        # request type -> [latency]
+    errors = {}         # request type -> count
+    lag = 0.0
+    start = time.perf_counter()
+    first_time = entries[0]['time']
+
+    for sequence, entry in enumerate(entries):
+        if args.speed > 0:
+            delay = (entry['time'] - first_time) / args.speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+
+        request = dict(entry['request'])
+        request_type = request.get('request_type', 'config')
+        if request_type == 'config' and request.get('id', 0) >= 0:
+            request['timestamp'] = sequence
+            tracker.sent[sequence] = time.perf_counter()
+        else:
+            request_type = request_type if request_type != 'config' else 'connect'
+
+        sent = time.perf_counter()
+        await socket.send_json(request)
+        try:
+            reply = await asyncio.wait_for(socket.recv_multipart(), args.timeout)
+        except asyncio.TimeoutError:
+            errors[request_type] = errors.get(request_type, 0) + 1
+            continue
+
+        tracker.bytes += sum(len(frame) for frame in reply)
+        if request_type != 'config':
+            queries.setdefault(request_type, []).append(time.perf_counter() - sent)
+            if reply[0].startswith(b'{"error"'):
+                errors[request_type] = errors.get(request_type, 0) + 1
+
+    # wait for the last updates
+    drain_end = time.perf_counter() + args.drain
+    while tracker.pending() and time.perf_counter() < drain_end:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    for subscriber in subscribers:
+        subscriber.cancel()
+    context.destroy(linger=0)
+
+    complete = [t for t in tracker.sent if tracker.is_complete(t)]
+    partial = [t for t in tracker.pending() if t in tracker.fields]
+    report = {
+        'requests': len(entries),
+        'elapsed': round(elapsed, 3),
+        'schedule_lag': round(lag, 3),
+        'updates': {
+            'sent': len(tracker.sent),
+            'complete': len(complete),
+            'partial': len(partial),
+            'dropped': len(tracker.sent) - len(complete) - len(partial),
+            'errors': errors.get('config', 0),
+            'latency_ms': latency_stats([tracker.last_end[t] - tracker.sent[t] for t in complete]),
+        },
+        'queries': {t: {'count': len(l), 'errors': errors.get(t, 0), 'latency_ms': latency_stats(l)} for t, l in queries.items()},
+        'bytes': tracker.bytes,
+        'throughput_mb_s': round(tracker.bytes / elapsed / 1e6, 2) if elapsed > 0 else 0.0,
+    }
+    return report
+
+
+def print_report(report):
+    updates = report['updates']
+    print(f"Replayed {report['requests']} requests in {report['elapsed']:.2f} s (max schedule lag {report['schedule_lag']:.3f} s)")
+    print(f"  updates: {updates['sent']} sent, {updates['complete']} complete, {updates['partial']} partial, "
+          f"{updates['dropped']} dropped, {updates['errors']} without reply")
+    print(f"  update latency (ms): {updates['latency_ms']}")
+    for request_type, query in report['queries'].items():
+        print(f"  {request_type}: {query['count']} replies, {query['errors']} errors, latency (ms): {query['latency_ms']}")
+    print(f"  received {report['bytes'] / 1e6:.1f} MB ({report['throughput_mb_s']} MB/s)")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Replay config requests recorded with main.py --record against a service.')
+
+    parser.add_argument('log', type=str, metavar='LOG',
+                        help='JSON lines file written by --record')
+    parser.add_argument('port', type=int, metavar='PORT',
+                        help='Config port of the service')
+    parser.add_argument('--host', type=str, default='localhost',
+                        help="Host of the service (default=localhost)")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed factor, 0 replays at maximum speed (default=1.0)")
+    parser.add_argument('--multiplex', action='store_true',
+                        help="The service runs with --zmq_multiplex (default: False)")
+    parser.add_argument('--limit', type=int, default=0,
+                        help="Replay only the first requests (default: all)")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help="Seconds to wait for a reply (default=10)")
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help="Seconds to wait for the subscriptions before replaying (default=1)")
+    parser.add_argument('--drain', type=float, default=10.0,
+                        help="Seconds to wait for the last updates (default=10)")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the report as JSON (default: False)")
+
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,134 @@
+import os
+import re
+import asyncio
+
+from pathlib import Path
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+WATCH_INTERVAL = 2.0    # seconds between directory scans without inotify
+SETTLE_DELAY = 0.5      # seconds to wait for more events after an inotify event
+
+
+class DatasetWatcher():
+    '''
+    Watch the directory of a design file pattern ("design_%d.npz") for added, modified and removed designs
+
+    Uses inotify (with the optional `inotify_simple` package) and falls back to polling the directory.
+    A file is reported once it is complete: after it is closed or moved in (inotify), or when it is
+    unchanged over two scans (polling). Files present when the watcher starts are the baseline.
+    '''
+
+    def __init__(self, filepath, from_file, interval=WATCH_INTERVAL):
+        path = Path(filepath)
+        self.directory = path.parent if str(path.parent) else Path('.')
+        self.from_file = from_file
+        self.interval = interval
+
+        # one "%d" (or "%04d") placeholder for the design index, none for a single file
+        parts = re.split(r"%0?\d*d", path.name)
+        if len(parts) > 2:
+            raise RuntimeError(f"Can not watch '{filepath}', more than one index in the file name")
+        self.pattern = re.compile("(\\d+)".join(re.escape(p) for p in parts) + "$")
+
+        self.inotify = None
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                flags = inotify_simple.flags
+                self.inotify.add_watch(str(self.directory), flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM)
+            except OSError as e:
+                print(f"WARNING: inotify not available ({e}), polling '{self.directory}'")
+                self.inotify = None
+
+        self.known = self.scan()
+        self.pending = {}   # files changed in the last scan, reported when they settle
+        print(f"Watching '{self.directory}' for designs ({'inotify' if self.inotify else 'polling'})")
+
+    def get_index(self, filename):
+        '''Design index of a file name, None for other files'''
+
+        match = self.pattern.match(filename)
+        if match is None:
+            return None
+        return int(match.group(1)) if match.groups() else self.from_file
+
+    def get_filepath(self, file_index):
+        return self.files[file_index]
+
+    def scan(self):
+        '''Index -> (mtime, size) of the design files in the directory'''
+
+        snapshot = {}
+        self.files = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return snapshot
+
+        for entry in entries:
+            file_index = self.get_index(entry.name)
+            if file_index is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            snapshot[file_index] = (stat.st_mtime_ns, stat.st_size)
+            self.files[file_index] = entry.path
+        return snapshot
+
+    def _diff(self, snapshot, settled):
+        '''Compare a scan with the known designs, `settled` are the indices of files known to be complete'''
+
+        added, modified, removed = set(), set(), set()
+
+        for file_index in set(self.known) - set(snapshot):
+            removed.add(file_index)
+            del self.known[file_index]
+
+        for file_index, stat in snapshot.items():
+            if self.known.get(file_index) == stat:
+                self.pending.pop(file_index, None)
+                continue
+            # the file may still be written, wait for its close event or for an unchanged scan
+            if file_index not in settled and self.pending.get(file_index) != stat:
+                self.pending[file_index] = stat
+                continue
+            self.pending.pop(file_index, None)
+            (modified if file_index in self.known else added).add(file_index)
+            self.known[file_index] = stat
+
+        return added, modified, removed
+
+    async def _wait_inotify(self):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        loop.add_reader(self.inotify.fd, event.set)
+        try:
+            await event.wait()
+        finally:
+            loop.remove_reader(self.inotify.fd)
+
+        # a copy of many designs comes as a burst of events
+        await asyncio.sleep(SETTLE_DELAY)
+        settled = set()
+        for event in self.inotify.read(timeout=0):
+            file_index = self.get_index(event.name)
+            if file_index is not None:
+                settled.add(file_index)
+        return settled
+
+    async def watch(self):
+        '''Yield (added, modified, removed) sets of design indices'''
+
+        while True:
+            if self.inotify is not None:
+                settled = await self._wait_inotify()
+            else:
+                await asyncio.sleep(self.interval)
+                settled = set()
+
+            changes = self._diff(self.scan(), settled)
+            if any(changes):
+                yield changes
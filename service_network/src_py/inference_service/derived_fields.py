@@ -0,0 +1,45 @@
+import numpy as np
+
+from .voxel_grid import SparseBlockGrid
+
+DERIVED_FIELDS = ['velocity_magnitude', 'vorticity', 'cp']
+
+RHO_AIR = 1.205                 # kg/m^3, air at 20C
+VORTICITY_CELL_FACTOR = 0.5     # vorticity grid cell size relative to the spatial index cell
+
+
+def velocity_magnitude(velocity):
+    '''|velocity| per point, float32 (N,)'''
+
+    return np.linalg.norm(velocity.reshape(-1, 3).astype(np.float32), axis=1)
+
+
+def pressure_coefficient(pressure, stream_velocity, rho=RHO_AIR):
+    '''Cp = p / (0.5 rho U^2) per point, the pressure is relative to the free stream pressure'''
+
+    dynamic_pressure = 0.5 * rho * float(stream_velocity) ** 2
+    if dynamic_pressure <= 0:
+        raise RuntimeError(f"Invalid stream velocity {stream_velocity} for 'cp'")
+    return (pressure.reshape(-1) / dynamic_pressure).astype(np.float32)
+
+
+def vorticity(points, velocity, cell_size):
+    '''
+    Curl of the velocity per point, float32 (N, 3)
+
+    The points are binned into a voxel grid holding the mean velocity and the mean position of
+    each cell. The velocity gradient of a cell is the least squares fit over its face neighbours
+    (see SparseBlockGrid.gradient), the curl of each cell is sampled back to the points.
+    '''
+
+    grid = SparseBlockGrid(points, np.column_stack([velocity.reshape(-1, 3), points]), cell_size)
+
+    # jacobian[m, i, j] = d velocity_i / d x_j
+    jacobian = grid.gradient(grid.values[:, :3], grid.values[:, 3:])
+    curl = np.stack([jacobian[:, 2, 1] - jacobian[:, 1, 2],
+                     jacobian[:, 0, 2] - jacobian[:, 2, 0],
+                     jacobian[:, 1, 0] - jacobian[:, 0, 1]], axis=1)
+
+    values, valid = grid.sample(points, curl)
+    values[~valid] = 0.0
+    return values.astype(np.float32)
@@ -0,0 +1,48 @@
+import numpy as np
+
+HISTOGRAM_BINS = 64
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+
+
+def compute_field_stats(array):
+    '''
+    Statistics of a float field for colormap domains and gradient scales, None for other fields
+
+        min, max:     per component for (N, C) fields, scalars otherwise
+        magnitude:    min and max of the vector length, for (N, C) fields
+        percentiles:  of the values, or of the vector length
+        histogram:    HISTOGRAM_BINS counts over 'range' of the values, or of the vector length
+
+    Non finite values are left out.
+    '''
+
+    array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.floating) or array.size == 0:
+        return None
+
+    stats = {}
+    if array.ndim == 2:
+        components = array.astype(np.float64)
+        finite = np.all(np.isfinite(components), axis=1)
+        components = components[finite]
+        if components.shape[0] == 0:
+            return None
+        stats['min'] = components.min(axis=0).tolist()
+        stats['max'] = components.max(axis=0).tolist()
+        values = np.linalg.norm(components, axis=1)
+        stats['magnitude'] = {'min': float(values.min()), 'max': float(values.max())}
+    else:
+        values = array.astype(np.float64).reshape(-1)
+        values = values[np.isfinite(values)]
+        if values.shape[0] == 0:
+            return None
+        stats['min'] = float(values.min())
+        stats['max'] = float(values.max())
+
+    percentiles = np.percentile(values, PERCENTILES)
+    stats['percentiles'] = {str(p): float(v) for p, v in zip(PERCENTILES, percentiles)}
+
+    value_range = (float(values.min()), float(values.max()))
+    counts, _ = np.histogram(values, bins=HISTOGRAM_BINS, range=value_range)
+    stats['histogram'] = {'range': list(value_range), 'counts': counts.tolist()}
+    return stats
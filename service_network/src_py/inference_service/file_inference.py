@@ -1,12 +1,18 @@
 import sys
 import numpy as np
 import os
+import hashlib
+import tempfile
 
 from pathlib import Path
 
 
 DO_NOT_LOAD_FIELDS = ['bounding_box_dims', 'stream_velocity', 'surface_coordinates', 'surface_pressure']
 
+# fields kept out of the data, served memory mapped from sidecar files on demand
+SURFACE_FIELDS = ['surface_coordinates', 'surface_pressure', 'stream_velocity']
+SIDECAR_DIR = ".sidecars"
+
 
 class FileInference():
     data = {}
@@ -20,6 +26,8 @@ class FileInference():
 
         self.filepath = filepath
         self.extension = Path(self.filepath).suffix
+        self.missing_sidecars = set()
+        self.sidecars_mtime = None     # modification time of the file the sidecars were extracted from
 
     @staticmethod
     def get_filepath(files_info, file_index):
@@ -39,6 +47,9 @@ class FileInference():
     def load_data(self):
         print(f"Loading data from '{self.filepath}'...")
 
+        # the file may have changed, its surface fields are looked up again
+        self.missing_sidecars = set()
+
         if self.extension == '.npz':
             self.data = np.load(self.filepath, allow_pickle=True)
         elif self.extension == '.npy':
@@ -48,6 +59,64 @@ class FileInference():
     def get_data(self):
         return self.data
 
+    def get_sidecar_path(self, field_name):
+        '''Sidecar file of a field, next to the data file or in the temp dir if that is read-only'''
+
+        source = Path(self.filepath).resolve()
+        filename = f"{source.stem}.{field_name}.npy"
+        sidecar_dir = source.parent / SIDECAR_DIR
+        if os.access(source.parent, os.W_OK) or sidecar_dir.exists():
+            return sidecar_dir / filename
+        return Path(tempfile.gettempdir()) / SIDECAR_DIR / hashlib.md5(str(source.parent).encode('utf-8')).hexdigest() / filename
+
+    def _extract_sidecars(self):
+        '''Write the surface fields of the file to .npy sidecar files'''
+
+        print(f"Extracting surface fields from '{self.filepath}'...")
+
+        if self.extension == '.npz':
+            data = np.load(self.filepath, allow_pickle=True)
+        elif self.data:
+            data = self.data
+        else:
+            data = np.load(self.filepath, allow_pickle=True).item()
+
+        missing = set()
+        for field_name in SURFACE_FIELDS:
+            path = self.get_sidecar_path(field_name)
+            if field_name not in data:
+                # a field removed from the file leaves no stale sidecar behind
+                path.unlink(missing_ok=True)
+                missing.add(field_name)
+                continue
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # write and rename, a reader never maps a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(data[field_name]))
+            os.replace(tmp_path, path)
+        self.missing_sidecars = missing
+
+    def load_sidecar(self, field_name):
+        '''Memory map a surface field from its sidecar file, extracted from the data file on first use'''
+
+        mtime = os.path.getmtime(self.filepath)
+        if mtime != self.sidecars_mtime:
+            # the file changed since the extraction, fields it lacked may be there now
+            self.missing_sidecars = set()
+        if field_name in self.missing_sidecars:
+            return None
+
+        path = self.get_sidecar_path(field_name)
+        if not path.exists() or path.stat().st_mtime < mtime:
+            self._extract_sidecars()
+            self.sidecars_mtime = mtime
+            if field_name in self.missing_sidecars:
+                return None
+
+        return np.load(path, mmap_mode='r')
+
     def get_field_names(self):
         field_names = []
 
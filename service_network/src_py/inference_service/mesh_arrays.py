@@ -0,0 +1,53 @@
+import json
+import numpy as np
+
+from pathlib import Path
+
+# welded mesh of an uploaded STL file, written by the upload service (see STREAMLINE_FORMAT.md)
+MESH_SUFFIX = ".mesh"
+ARRAY_NAMES = ['vertices', 'faces', 'normals', 'bounds']
+
+
+def select_lod(meta, triangle_budget=None):
+    '''Level of detail with the most triangles within the budget, the coarsest if none fits, the full mesh without a budget'''
+
+    lods = meta.get('lods') or [{'level': 0, 'num_faces': meta.get('num_faces', 0)}]
+    if triangle_budget is None:
+        return 0
+    fitting = [lod for lod in lods if lod['num_faces'] <= triangle_budget]
+    if fitting:
+        return max(fitting, key=lambda lod: lod['num_faces'])['level']
+    return min(lods, key=lambda lod: lod['num_faces'])['level']
+
+
+def load_mesh_arrays(stl_path, triangle_budget=None):
+    '''
+    Memory map the mesh of an uploaded STL file, None if missing or older than the STL file
+
+    Returns a dict with 'vertices' float32 (V, 3), 'faces' int32 (F, 3), 'normals' float32 (V, 3)
+    and 'bounds' float32 (2, 3). With a triangle budget the vertices, faces and normals are those
+    of the level of detail chosen by select_lod.
+    '''
+
+    stl_path = Path(stl_path)
+    mesh_dir = stl_path.with_suffix(MESH_SUFFIX)
+    try:
+        with open(mesh_dir / "meta.json") as f:
+            meta = json.load(f)
+        stat = stl_path.stat()
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('source_size') != stat.st_size or meta.get('source_mtime_ns') != stat.st_mtime_ns:
+        print(f"WARNING: Ignoring mesh arrays older than '{stl_path}'")
+        return None
+
+    level = select_lod(meta, triangle_budget)
+    prefix = "" if level == 0 else f"lod{level}_"
+    arrays = {}
+    for name in ARRAY_NAMES:
+        array_name = prefix + name if name != 'bounds' else name
+        if array_name not in meta.get('arrays', []):
+            return None
+        arrays[name] = np.load(mesh_dir / f"{array_name}.npy", mmap_mode='r')
+    return arrays
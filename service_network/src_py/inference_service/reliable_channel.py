@@ -0,0 +1,228 @@
+import zmq
+import json
+import time
+import asyncio
+
+from collections import OrderedDict
+
+from .socket_tuning import array_bytes, STALL_SLEEP, STALL_MAX_SLEEP, STALL_TIMEOUT
+
+CLIENT_TIMEOUT = 60.0   # seconds without a message before a client out of credit is forgotten
+
+
+class ReliableClient():
+    '''Transfer state of one DEALER peer'''
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.client_id = None       # session of the client, it only gets the values published for it
+        self.fields = set()         # subscribed fields, updates are pushed
+        self.credit = 0             # chunks the client is ready to receive
+        self.pending = OrderedDict()    # field -> [version, offset]
+        self.last_seen = time.monotonic()
+
+
+class ReliableChannel():
+    '''
+    Credit-based data channel on a ROUTER socket with a last-value cache
+
+    Clients connect with a DEALER socket and send JSON commands:
+        {"cmd": "subscribe", "fields": [...], "credit": n, "resume": {field: {"version": v, "offset": o}}}
+        {"cmd": "fetch", "field": name, "offset": o, "version": v, "credit": n}
+        {"cmd": "credit", "credit": n}
+        {"cmd": "toc"}
+        {"cmd": "unsubscribe"}
+
+    A command may carry the "client_id" of a session (see sessions.py), the client then gets the
+    values published for that session instead of the shared ones.
+
+    Every chunk costs one credit. A transfer starts with a `metadata` message (free of credit),
+    followed by `chunk` messages [header, bytes] carrying the byte offset, the last one is
+    flagged with "last". A new publish of a field restarts its transfer from offset 0, so a slow
+    client always ends up with the latest value and never with a mix of two.
+    '''
+
+    def __init__(self, tuner):
+        self.tuner = tuner
+        self.socket = None
+        self.last_values = {}   # client_id -> field -> {'metadata', 'data', 'version'}, None for the shared values
+        self.clients = {}
+        self.wakeup = asyncio.Event()
+
+    def bind(self, context, address):
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.tuner.configure(self.socket)
+        self.socket.bind(address)
+        print(f"Created reliable data socket on {address}")
+
+    def publish(self, field_name, metadata, array, client_id=None):
+        '''Store the latest value of a field of a session and restart transfers of its subscribed clients'''
+
+        values = self.last_values.setdefault(client_id, {})
+        entry = values.get(field_name)
+        version = entry['version'] + 1 if entry else 1
+        data = array_bytes(array)
+        values[field_name] = {'metadata': metadata, 'data': data, 'version': version}
+
+        for client in self.clients.values():
+            if client.client_id == client_id and field_name in client.fields:
+                client.pending[field_name] = [version, 0]
+                client.pending.move_to_end(field_name)
+        self.wakeup.set()
+
+    def retain_sessions(self, client_ids):
+        '''Drop the values of the sessions not in client_ids, the shared values are kept'''
+
+        for client_id in [c for c in self.last_values if c is not None and c not in client_ids]:
+            del self.last_values[client_id]
+            for client in self.clients.values():
+                if client.client_id == client_id:
+                    client.pending.clear()
+
+    def get_toc(self, client_id=None):
+        toc = {}
+        for field_name, entry in self.last_values.get(client_id, {}).items():
+            toc[field_name] = dict(entry['metadata'], version=entry['version'], nbytes=entry['data'].nbytes)
+        return toc
+
+    def get_stats(self):
+        return {
+            'clients': len(self.clients),
+            'fields': {name: entry['version'] for name, entry in self.last_values.get(None, {}).items()},
+            'sessions': len([c for c in self.last_values if c is not None]),
+        }
+
+    def _start_transfer(self, client, field_name, version=None, offset=0):
+        entry = self.last_values.get(client.client_id, {}).get(field_name)
+        if entry is None:
+            return
+        if version != entry['version']:
+            offset = 0
+        client.pending[field_name] = [entry['version'], max(0, min(int(offset), entry['data'].nbytes))]
+
+    def _handle_command(self, identity, request):
+        client = self.clients.get(identity)
+        if client is None:
+            client = self.clients[identity] = ReliableClient(identity)
+        client.last_seen = time.monotonic()
+        if 'client_id' in request and request['client_id'] != client.client_id:
+            # the transfers of the previous session do not apply
+            client.client_id = request['client_id']
+            client.fields.clear()
+            client.pending.clear()
+
+        cmd = request.get('cmd')
+        client.credit += int(request.get('credit', 0))
+
+        if cmd == 'subscribe':
+            fields = request.get('fields') or list(self.last_values.get(client.client_id, {}).keys())
+            resume = request.get('resume', {})
+            client.fields.update(fields)
+            for field_name in fields:
+                state = resume.get(field_name, {})
+                self._start_transfer(client, field_name, state.get('version'), state.get('offset', 0))
+
+        elif cmd == 'fetch':
+            self._start_transfer(client, request.get('field'), request.get('version'), request.get('offset', 0))
+
+        elif cmd == 'unsubscribe':
+            self.clients.pop(identity, None)
+            return None
+
+        elif cmd == 'toc':
+            return {'cmd': 'toc', 'fields': self.get_toc(client.client_id)}
+
+        elif cmd != 'credit':
+            return {'cmd': 'error', 'message': f"Unknown command '{cmd}'"}
+
+        self.wakeup.set()
+        return None
+
+    async def receive_commands(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            identity = frames[0]
+            try:
+                request = json.loads(frames[-1])
+            except ValueError:
+                print("WARNING: Invalid reliable channel request")
+                continue
+
+            reply = self._handle_command(identity, request)
+            if reply is not None and not await self._send(identity, [json.dumps(reply).encode('utf-8')]):
+                self.clients.pop(identity, None)
+
+    async def _send(self, identity, frames, copy=True):
+        '''Send to one client, returns False if the client is gone or stopped reading for STALL_TIMEOUT'''
+
+        sleep = STALL_SLEEP
+        waited = 0.0
+        while True:
+            try:
+                await self.socket.send_multipart([identity] + frames, zmq.DONTWAIT, copy=copy)
+                return True
+            except zmq.Again:
+                # peer queue is full, the credit window is larger than its HWM
+                if waited >= STALL_TIMEOUT:
+                    return False
+                await asyncio.sleep(sleep)
+                waited += sleep
+                sleep = min(2 * sleep, STALL_MAX_SLEEP)
+            except zmq.ZMQError as e:
+                if e.errno == zmq.EHOSTUNREACH:
+                    return False
+                raise RuntimeError(f"Error sending on reliable channel: {e}")
+
+    async def _send_next_chunk(self, client):
+        '''Send one chunk of the oldest pending transfer of a client'''
+
+        field_name, (version, offset) = next(iter(client.pending.items()))
+        entry = self.last_values[client.client_id][field_name]
+        data = entry['data']
+
+        if offset == 0:
+            header = dict(entry['metadata'], cmd='metadata', version=version, nbytes=data.nbytes)
+            if not await self._send(client.identity, [json.dumps(header).encode('utf-8')]):
+                return False
+
+        chunk_size = self.tuner.chunk_size if self.tuner.chunk_size > 0 else data.nbytes
+        end = min(offset + chunk_size, data.nbytes)
+        last = end >= data.nbytes
+        header = {'cmd': 'chunk', 'field_name': field_name, 'version': version, 'offset': offset, 'last': last}
+        if not await self._send(client.identity, [json.dumps(header).encode('utf-8'), data[offset:end]], copy=False):
+            return False
+
+        client.credit -= 1
+        # the field may have been published again while sending, its transfer was restarted then
+        if client.pending.get(field_name) == [version, offset]:
+            if last:
+                del client.pending[field_name]
+            else:
+                client.pending[field_name][1] = end
+        return True
+
+    async def pump(self):
+        '''Round-robin pending chunks over clients while they have credit'''
+
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            now = time.monotonic()
+            busy = True
+            while busy:
+                busy = False
+                for identity, client in list(self.clients.items()):
+                    if client.credit <= 0 or not client.pending:
+                        if client.credit <= 0 and now - client.last_seen > CLIENT_TIMEOUT:
+                            self.clients.pop(identity, None)
+                        continue
+                    if not await self._send_next_chunk(client):
+                        # its transfers and credit go, it subscribes again (with "resume") when it reads again
+                        print("Reliable client disconnected or stopped reading, dropped")
+                        self.clients.pop(identity, None)
+                        continue
+                    busy = True
+                # let the command receiver and the publisher run
+                await asyncio.sleep(0)
@@ -0,0 +1,26 @@
+import json
+import time
+
+
+class RequestRecorder():
+    '''
+    Append every request received on the config port to a JSON lines file, for replay.py
+
+    One line per request: {"time": seconds since the epoch, "request": the request as received}
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.count = 0
+        print(f"Recording config requests to '{path}'")
+
+    def record(self, config_request):
+        try:
+            self.file.write(json.dumps({'time': time.time(), 'request': config_request}) + "\n")
+            self.count += 1
+        except (OSError, TypeError, ValueError) as e:
+            print(f"ERROR: Could not record a config request: {e}")
+
+    def close(self):
+        self.file.close()
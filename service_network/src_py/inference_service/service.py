@@ -2,11 +2,24 @@ import os
 import time
 import uuid
 import json
+import threading
 import numpy as np
 import trimesh
 from pathlib import Path
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from .file_inference import FileInference
+from .spatial_index import UniformGridIndex
+from .voxel_grid import SparseBlockGrid, VOXEL_FIELDS, BLOCK_DIM, DEFAULT_CELL_SIZE, STAGE_UNITS_PER_METER
+from .streamlines import compute_streamlines, STREAMLINE_FIELDS, DEFAULT_STEPS
+from .derived_fields import DERIVED_FIELDS, VORTICITY_CELL_FACTOR, velocity_magnitude, pressure_coefficient, vorticity
+from .field_stats import compute_field_stats
+from .sessions import SessionTable
+from .streamline_arrays import load_streamline_arrays
+from .mesh_arrays import load_mesh_arrays, MESH_SUFFIX
+from .streamline_arrays import ARRAYS_SUFFIX
 
 # Bounds for our normalized dataset
 BOUNDS = np.array([[-3.105525016784668, -1.7949625253677368, -0.330342], [6.356535, 1.7951075, 2.317086]])
@@ -14,13 +27,32 @@ HALF_SIZE = 0.5 * (BOUNDS[1] - BOUNDS[0])
 POSITION = 0.5 * (BOUNDS[1] + BOUNDS[0])
 
 NUM_SAMPLE_POINTS = 1_255_000
+STREAM_VELOCITY = 30.0      # free stream velocity of designs without 'stream_velocity'
+
+PROBE_NEIGHBOURS = 8
+MAX_PROBE_POINTS = 100_000
+
+SLICE_RESOLUTION = 128
+MAX_SLICE_RESOLUTION = 1024
+SLICE_NEIGHBOURS = 4
+SLICE_POSITION_BUCKETS = 256    # slice planes per axis, nearby positions share a cached slice
+MAX_CACHED_SLICES = 32          # per design
+
+MIN_CELL_SIZE = 0.1             # smallest voxel size of a request, in stage units
+MAX_GRID_BLOCKS = 1 << 24       # blocks spanned by the bounds of a voxel grid, its block table is dense
+
+BATCH_WORKERS = 8               # designs loaded in parallel for a batch request
+
+MAX_PARSED_UPLOADS = 4          # uploaded files kept parsed, for those without prepared arrays
+MAX_UPLOAD_DESIGNS = 8          # uploaded designs keeping their per design caches, least recently used dropped
+PREWARM_READ_SIZE = 8 * 1024 * 1024
 
 
 class Service:
-    data = None         # loaded / received data
     extension = ""
     config_request_old = {}
     file_inferences = {}
+    files = {}
     uploaded_files_dir = None
     current_stl_path = None
     current_streamlines_path = None
@@ -32,37 +64,102 @@ class Service:
                  preload=True,
                  prune_points=0,
                  num_points=NUM_SAMPLE_POINTS,
-                 uploaded_files_dir=None):
+                 uploaded_files_dir=None,
+                 cell_size=DEFAULT_CELL_SIZE,
+                 streamline_workers=None,
+                 stream_velocity=STREAM_VELOCITY):
         self.field_names = field_names
         self.unnormalize_data = unnormalize
         self.preload_data = preload
         self.prune_points = prune_points
         self.num_sample_points = num_points
+        self.cell_size = cell_size      # voxel size in stage units, as exts."omni.cgns".cell_size
+        self.streamline_workers = streamline_workers
+        self.stream_velocity = stream_velocity
         self.uploaded_files_dir = uploaded_files_dir or os.environ.get("UPLOAD_FILES_DIR", "/app/uploaded_files")
 
+        # current design data, and the design being built, of every thread (designs are also built in workers)
+        self.thread_state = threading.local()
+        self.design_cache = OrderedDict()   # design key -> dict of arrays and indices computed from the design
+        # guards the catalog and the design caches, shared by the event loop and the worker threads
+        self.design_cache_lock = threading.Lock()
+        self.computing = {}         # (design cache, key) -> Event of the cache entries being computed
+        # file inference -> batches using it, for the designs loaded by batches (see _load_designs)
+        self.batch_designs = {}
+        self.batch_designs_lock = threading.Lock()
+        # uploaded file key -> {'ready': Event, 'data': parsed arrays}, filled by loads and prewarm requests
+        self.parsed_uploads = OrderedDict()
+        self.parsed_uploads_lock = threading.Lock()
+        self.parsed_upload_hits = 0
+        self.parsed_upload_misses = 0
+
+        # fields computed by the service instead of read from the files
+        self.computed_fields = {}
+        self.computed_point_fields = set()
+        self.per_design_fields = set()
+        for field_name in VOXEL_FIELDS:
+            self.register_field(field_name, self._get_voxel_field)
+        for field_name in STREAMLINE_FIELDS:
+            self.register_field(field_name, self._get_streamline_field)
+        self.register_field('velocity_magnitude', self._compute_velocity_magnitude, point_field=True, per_design=True)
+        self.register_field('vorticity', self._compute_vorticity, point_field=True, per_design=True)
+        self.register_field('cp', self._compute_cp, point_field=True, per_design=True)
+
         self._reset_config()
 
         if len(files) > 0:
+            self.files = files
             self.from_file = files['from']
             self.to_file = files['to']
 
             for i in range(self.from_file, self.to_file + 1):
                 filepath = FileInference.get_filepath(files, i)
+                # a watched dataset may get its designs later
+                if files.get('watch') and not os.path.exists(filepath):
+                    continue
                 self.file_inferences[i] = FileInference(filepath)
 
+    @property
+    def data(self):
+        '''Loaded / received data of the current design of the calling thread'''
+        return getattr(self.thread_state, 'data', None)
+
+    @data.setter
+    def data(self, data):
+        self.thread_state.data = data
+
+    def register_field(self, field_name, getter, point_field=False, per_design=False):
+        '''
+        Register a field computed by the service, it can be requested by name in `field_names`
+
+        `getter(file_index, field_name, config_request)` returns the array. Point fields have a value
+        per design point (they are cropped to the region of interest), per design fields do not
+        depend on the request and are computed once per design and cached.
+        '''
+
+        self.computed_fields[field_name] = getter
+        if point_field:
+            self.computed_point_fields.add(field_name)
+        if per_design:
+            self.per_design_fields.add(field_name)
+
     def _reset_config(self):
         self.config_request_old['id'] = -1
         self.config_request_old['config'] = -1
         self.config_request_old['multip'] = -1
         # self.config_request_old['params'] = ""    # not used
+        # clients sending a 'client_id' get their own state, the others share the session None
+        self.sessions = SessionTable()
 
     def _field_names_reader(self):
         '''Get list of fields in the data dictionary'''
 
+        computed_field_names = [f for f in self.field_names if f in self.computed_fields]
+
         if self.file_inferences:
             # load fields from a first file
             first_key = next(iter(self.file_inferences))
-            self.field_names = self.file_inferences[first_key].get_field_names()
+            self.field_names = self.file_inferences[first_key].get_field_names() + computed_field_names
         else:
             if len(self.field_names) == 0:
                 raise RuntimeError("No field names set")
@@ -71,7 +168,7 @@ class Service:
 
         print(f"Data fields: {self.field_names}")
 
-    def _get_data_from_file(self, config_request):
+    def _get_data_from_file(self, config_request, session=None):
 
         file_index = int(config_request['id'])
         file_index = int(np.clip(file_index, self.from_file, self.to_file))
@@ -81,14 +178,36 @@ class Service:
             return -1
 
         if not self.preload_data:
-            self.file_inferences[file_index].load_data()
+            file_inference = self.file_inferences[file_index]
+            # another client shows the same design, its load is shared
+            shared = session is not None and file_inference.get_data() and \
+                any(s.file_index == file_index and s.data is file_inference.get_data() for s in self.sessions.others(session))
+            if not shared:
+                file_inference.load_data()
 
         if self.file_inferences and file_index in self.file_inferences:
             self.data = self.file_inferences[file_index].get_data()
 
         return file_index
 
-    def _get_data_from_script(self, config_request):
+    def _get_upload_load_key(self, config_request):
+        '''Uploaded files of a request by inode and modification time, equal keys load the same data
+
+        Names uploaded with the same content are hard links to one stored file, they share a key.
+        '''
+
+        stl_path = Path(self.uploaded_files_dir) / "stl" / config_request.get('id', 'default.stl')
+        streamlines_path = Path(self.uploaded_files_dir) / "streamlines" / config_request.get('streamlines', 'streamlines.json')
+        key = []
+        for path in [stl_path, streamlines_path]:
+            try:
+                stat = path.stat()
+                key.append((stat.st_dev, stat.st_ino, stat.st_mtime_ns))
+            except OSError:
+                key.append((str(path), None))
+        return tuple(key) + (config_request.get('triangle_budget'),)
+
+    def _get_data_from_script(self, config_request, session=None):
         """Load data from uploaded files instead of running Triton inference"""
 
         if config_request == self.config_request_old:
@@ -101,10 +220,23 @@ class Service:
 
         self.config_request_old = config_request
 
+        if session is not None:
+            session.load_key = self._get_upload_load_key(config_request)
+            # another client shows the same uploaded files, its load is shared
+            for other in self.sessions.others(session):
+                if other.data and other.load_key == session.load_key:
+                    print(f"Sharing uploaded files loaded for session '{other.client_id}'")
+                    self.data = other.data
+                    return
+
         print(f"Loading uploaded files: STL={stl_filename}, Streamlines={streamlines_filename}")
 
+        # the files may have been uploaded again under the same name
+        with self.design_cache_lock:
+            self.design_cache.pop(self._design_key(-1, config_request), None)
+
         # Load uploaded files
-        uploaded_data = self.load_uploaded_files(stl_filename, streamlines_filename)
+        uploaded_data = self.load_uploaded_files(stl_filename, streamlines_filename, config_request.get('triangle_budget'))
 
         if uploaded_data:
             self.data = uploaded_data
@@ -198,11 +330,27 @@ class Service:
 
         print("Caching data to a memory...")
 
-        for file_inference in self.file_inferences.values():
+        # may run in a worker thread while the dataset watcher changes the catalog
+        for file_index in sorted(self.file_inferences):
+            designs = self._snapshot_designs([file_index])
+            if file_index in designs:
+                with self._pinned_designs(designs):
+                    self._preload_design(file_index)
+
+        self.data = None
+
+    def _preload_design(self, file_index):
+        '''Cache the arrays of a design and the fields computed from them'''
+
+        file_inference = self._get_file_inference(file_index)
+        if not file_inference.get_data():
             file_inference.load_data()
-            self.data = file_inference.get_data()
+
+        with self._design_data(file_index):
             file_arrays = {}
             for field_name in self.field_names:
+                if field_name in self.computed_fields:
+                    continue
                 array = self._get_array(field_name)
                 if array is not None:
                     file_arrays[field_name] = array
@@ -216,31 +364,702 @@ class Service:
 
             file_inference.arrays = file_arrays
 
-        self.data = None
+            if any(f in VOXEL_FIELDS for f in self.field_names):
+                self._get_voxel_grid(file_index, {})
+            for field_name in self.field_names:
+                if field_name in self.per_design_fields:
+                    self._get_field(file_index, field_name)
+                self._get_field_stats(file_index, field_name, {})
+
+    def open_design(self, file_index, filepath):
+        '''
+        Open a new or modified design file, loaded and preloaded (with its design cache) when the data is preloaded
+
+        Does not touch the design being served, it runs in a worker thread. The design is served after `set_design`.
+        Returns the file inference and its design cache.
+        '''
+
+        file_inference = FileInference(filepath)
+        design_cache = {}
+        if self.preload_data:
+            file_inference.load_data()
+            with self._pinned_designs({file_index: (file_inference, design_cache)}):
+                self._preload_design(file_index)
+        return file_inference, design_cache
+
+    def set_design(self, file_index, file_inference, design_cache):
+        '''Add a design opened by `open_design` to the catalog or replace it, with the caches built for it'''
+
+        print(f"{'Refreshing' if file_index in self.file_inferences else 'Adding'} design {file_index}...")
+
+        with self.design_cache_lock:
+            self.design_cache[file_index] = design_cache
+            self.file_inferences[file_index] = file_inference
+        self._update_file_range()
+
+    def remove_design(self, file_index):
+        '''Evict a design from the catalog and the caches'''
+
+        if file_index not in self.file_inferences:
+            return
+
+        print(f"Removing design {file_index}...")
+
+        with self.design_cache_lock:
+            del self.file_inferences[file_index]
+            self.design_cache.pop(file_index, None)
+        self._update_file_range()
+
+    def _update_file_range(self):
+        if self.file_inferences:
+            self.from_file = min(self.file_inferences)
+            self.to_file = max(self.file_inferences)
 
     def _request_data(self, config_request):
         '''Get data for current config request'''
 
-        if self.file_inferences:
-            file_index = self._get_data_from_file(config_request)
+        # continue from the last request of the client
+        session = self.sessions.get(config_request.get('client_id'))
+        self.config_request_old = session.config_request_old
+        self.data = session.data
+
+        # a watched dataset may have no designs yet
+        if self.files:
+            file_index = self._get_data_from_file(config_request, session)
         else:
             file_index = -1
-            self._get_data_from_script(config_request)
+            self._get_data_from_script(config_request, session)
+
+        session.config_request_old = self.config_request_old
+        session.data = self.data
+        session.file_index = file_index
 
         if not self.data:
             print(f"WARNING: Could not load data for id {config_request['id']}")
 
         return file_index
 
-    def _get_data_to_send(self, file_index, field_name, config_request):
+    def _design_key(self, file_index, config_request):
+        '''Key of the design a request refers to, used for the per design caches'''
+
+        if file_index >= 0:
+            return file_index
+        return (str(config_request.get('id')), str(config_request.get('streamlines', '')))
+
+    @contextmanager
+    def _pinned_designs(self, designs):
+        '''
+        Serve designs from the given objects in the calling thread, {index: (file inference, design cache)}
+
+        A worker thread keeps the designs it started with while the catalog changes (see `_snapshot_designs`),
+        `open_design` builds a design that is not in the catalog yet.
+        '''
+
+        previous = getattr(self.thread_state, 'designs', None)
+        self.thread_state.designs = designs
+        try:
+            yield
+        finally:
+            self.thread_state.designs = previous
+
+    def _snapshot_designs(self, file_indices):
+        '''Designs of the catalog for `_pinned_designs`, the indices not in the catalog are left out'''
+
+        with self.design_cache_lock:
+            return {i: (self.file_inferences[i], self.design_cache.setdefault(i, {}))
+                    for i in set(file_indices) if i is not None and i in self.file_inferences}
+
+    def _get_file_inference(self, file_index):
+        '''File of a design, the one pinned in the calling thread if any'''
+
+        designs = getattr(self.thread_state, 'designs', None)
+        if designs is not None and file_index in designs:
+            return designs[file_index][0]
+        return self.file_inferences[file_index]
+
+    def _get_design_cache(self, design_key):
+        designs = getattr(self.thread_state, 'designs', None)
+        if designs is not None and design_key in designs:
+            return designs[design_key][1]
+
+        with self.design_cache_lock:
+            cache = self.design_cache.setdefault(design_key, {})
+            if isinstance(design_key, tuple):
+                # uploads come and go under any name, only the recently used ones keep their caches
+                self.design_cache.move_to_end(design_key)
+                upload_keys = [key for key in self.design_cache if isinstance(key, tuple)]
+                for key in upload_keys[:max(0, len(upload_keys) - MAX_UPLOAD_DESIGNS)]:
+                    del self.design_cache[key]
+        return cache
+
+    def _get_cached(self, cache, key, compute, replaces=None):
+        '''
+        Entry of a design cache, computed with `compute()` on first use
+
+        The entry is computed once, outside of the lock: other threads asking for it meanwhile wait for it.
+        With `replaces`, the entries keyed by tuples starting with it are dropped when the entry is stored,
+        so a design keeps one of a kind (the grid of the latest cell size, the latest streamlines).
+        '''
+
+        pending_key = (id(cache), key)
+        while True:
+            with self.design_cache_lock:
+                if key in cache:
+                    return cache[key]
+                event = self.computing.get(pending_key)
+                if event is None:
+                    event = self.computing[pending_key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            value = compute()
+            with self.design_cache_lock:
+                if replaces is not None:
+                    for other in [k for k in cache if isinstance(k, tuple) and k[0] == replaces]:
+                        del cache[other]
+                cache[key] = value
+            return value
+        finally:
+            with self.design_cache_lock:
+                del self.computing[pending_key]
+            event.set()
+
+    def _get_surface_field(self, file_index, field_name):
+        '''Get a surface field of a design, memory mapped from its sidecar file (file mode only)'''
+
+        file_inference = self.file_inferences.get(file_index)
+        if file_inference is None:
+            return None
+
+        array = file_inference.load_sidecar(field_name)
+        if array is not None and self.unnormalize_data and field_name == 'surface_coordinates':
+            array = self._get_cached(self._get_design_cache(file_index), 'surface_coordinates',
+                                     lambda: (HALF_SIZE * array + POSITION).astype(np.float32))
+        return array
+
+    def _get_field(self, file_index, field_name, config_request={}):
+        '''Get a field of the current design, from the preloaded arrays if possible'''
+
+        if field_name in self.per_design_fields:
+            def compute():
+                start_time = time.time()
+                with self._design_data(file_index):
+                    array = self.computed_fields[field_name](file_index, field_name, config_request)
+                if array is not None:
+                    print(f"Computed '{field_name}' in {time.time() - start_time:.2f}s")
+                return array
+
+            cache = self._get_design_cache(self._design_key(file_index, config_request))
+            return self._get_cached(cache, ('field', field_name), compute)
+
+        if field_name in self.computed_fields:
+            return self.computed_fields[field_name](file_index, field_name, config_request)
 
         if self.file_inferences and self.preload_data and file_index >= 0:
-            if field_name in self.file_inferences[file_index].arrays:
-                array = self.file_inferences[file_index].arrays[field_name]
-        else:
-            array = self._get_array(field_name)
+            return self._get_file_inference(file_index).arrays.get(field_name)
+        return self._get_array(field_name)
+
+    def _get_spatial_index(self, file_index, config_request):
+        '''Get the cached spatial index over the design coordinates, build it on first use'''
+
+        def build():
+            coordinates = self._get_field(file_index, 'coordinates')
+            if coordinates is None:
+                print("ERROR: Could not build spatial index, 'coordinates' array not found")
+                return None
+
+            print(f"Building spatial index over {coordinates.shape[0]:,} points...")
+            return UniformGridIndex(coordinates)
+
+        cache = self._get_design_cache(self._design_key(file_index, config_request))
+        return self._get_cached(cache, 'spatial_index', build)
+
+    def _get_cell_size(self, cache, coordinates, config_request):
+        '''
+        Voxel size of a request in stage units: its 'cell_size' (or the default), at least MIN_CELL_SIZE
+        and coarse enough for the bounds of the design to span at most MAX_GRID_BLOCKS blocks
+        '''
+
+        try:
+            cell_size = float(config_request.get('cell_size', self.cell_size))
+        except (TypeError, ValueError):
+            cell_size = float('nan')
+        if not np.isfinite(cell_size) or cell_size <= 0:
+            print(f"WARNING: Invalid cell_size {config_request.get('cell_size')!r}, using {self.cell_size}")
+            cell_size = self.cell_size
+        cell_size = max(cell_size, MIN_CELL_SIZE)
+
+        extent = self._get_cached(cache, 'extent', lambda: np.ptp(coordinates, axis=0).astype(np.float64) * STAGE_UNITS_PER_METER
+                                  if coordinates.shape[0] > 0 else np.zeros(3))
+        requested = cell_size
+        while np.prod(np.floor(extent / (cell_size * BLOCK_DIM)) + 1) > MAX_GRID_BLOCKS:
+            cell_size *= 1.25
+        if cell_size != requested:
+            print(f"WARNING: cell_size {requested} too small for the design, using {cell_size:.4g}")
+        return cell_size
+
+    def _get_voxel_grid(self, file_index, config_request):
+        '''Get the cached sparse voxel grid of velocity and pressure, voxelize on first use'''
+
+        coordinates = self._get_field(file_index, 'coordinates')
+        if coordinates is None:
+            print("ERROR: Could not voxelize, 'coordinates' array not found")
+            return None
+
+        cache = self._get_design_cache(self._design_key(file_index, config_request))
+        cell_size = self._get_cell_size(cache, coordinates, config_request)
+
+        def build():
+            velocity = self._get_field(file_index, 'velocity')
+            pressure = self._get_field(file_index, 'pressure')
+            if velocity is None or pressure is None:
+                print("ERROR: Could not voxelize, 'velocity' or 'pressure' array not found")
+                return None
+
+            values = np.column_stack([velocity.reshape(-1, 3), pressure.reshape(-1, 1)])
+            grid = SparseBlockGrid(coordinates, values, cell_size / STAGE_UNITS_PER_METER)
+            print(f"Voxelized {coordinates.shape[0]:,} points into {grid.blocks.shape[0]:,} blocks "
+                  f"({grid.values.shape[0]:,} cells, {grid.nbytes / 1e6:.1f} MB)")
+            return grid
+
+        # only the grid of the latest cell size is kept
+        return self._get_cached(cache, ('voxel_grid', cell_size), build, replaces='voxel_grid')
+
+    def _get_voxel_field(self, file_index, field_name, config_request):
+        grid = self._get_voxel_grid(file_index, config_request)
+        return None if grid is None else grid.get_field(field_name)
+
+    def _get_streamline_field(self, file_index, field_name, config_request):
+        return self._get_streamlines(file_index, config_request)[STREAMLINE_FIELDS.index(field_name)]
+
+    def _compute_velocity_magnitude(self, file_index, field_name, config_request):
+        velocity = self._get_field(file_index, 'velocity')
+        return None if velocity is None else velocity_magnitude(velocity)
+
+    def _compute_cp(self, file_index, field_name, config_request):
+        pressure = self._get_field(file_index, 'pressure')
+        if pressure is None:
+            return None
+
+        # the free stream velocity of the simulation, stored with the design data when known
+        stream_velocity = self.data.get('stream_velocity') if self.data else None
+        stream_velocity = self.stream_velocity if stream_velocity is None else float(stream_velocity)
+        return pressure_coefficient(pressure, stream_velocity)
+
+    def _compute_vorticity(self, file_index, field_name, config_request):
+        coordinates = self._get_field(file_index, 'coordinates')
+        velocity = self._get_field(file_index, 'velocity')
+        index = self._get_spatial_index(file_index, config_request)
+        if coordinates is None or velocity is None or index is None:
+            return None
+
+        return vorticity(coordinates, velocity, VORTICITY_CELL_FACTOR * index.cell_size)
+
+    def _get_streamlines(self, file_index, config_request):
+        '''
+        Get streamlines traced on the CPU from the request 'seeds' [[x, y, z], ...] through the voxel grid
+
+        Optional keys are 'streamline_steps' (points per streamline) and 'streamline_scalar'
+        ('velocity' magnitude or 'pressure'). Results are cached per design and seed set.
+        '''
+
+        seeds = np.asarray(config_request.get('seeds', []), dtype=np.float64).reshape(-1, 3)
+        num_steps = int(config_request.get('streamline_steps', DEFAULT_STEPS))
+        scalar = str(config_request.get('streamline_scalar', 'velocity'))
+
+        if seeds.shape[0] == 0:
+            return np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.int32)
+
+        grid = self._get_voxel_grid(file_index, config_request)
+        if grid is None:
+            return None, None
+
+        def trace():
+            streamlines = compute_streamlines(grid, seeds, num_steps, scalar, self.streamline_workers)
+            print(f"Traced {streamlines[1].shape[0]:,} streamlines from {seeds.shape[0]:,} seeds")
+            return streamlines
+
+        # only the latest seed set is kept
+        cache = self._get_design_cache(self._design_key(file_index, config_request))
+        streamlines_key = ('streamlines', grid.cell_size, seeds.tobytes(), num_steps, scalar)
+        return self._get_cached(cache, streamlines_key, trace, replaces='streamlines')
+
+    def _get_roi_indices(self, file_index, config_request):
+        '''
+        Get indices of the points inside the region of interest of a request, None for all points
+
+        The region is an optional 'aabb' [xmin, ymin, zmin, xmax, ymax, zmax] and/or a 'slab'
+        {'axis': 'x', 'pct': -1..1 (as in set_slice_pos) or 'pos': coordinate, 'thickness': t},
+        both in the units of the 'coordinates' field.
+        '''
+
+        aabb = config_request.get('aabb')
+        slab = config_request.get('slab')
+        if aabb is None and slab is None:
+            return None
+
+        index = self._get_spatial_index(file_index, config_request)
+        if index is None:
+            return None
+
+        lower = index.lower.copy()
+        upper = index.upper.copy()
+
+        if aabb is not None:
+            aabb = np.asarray(aabb, dtype=np.float64)
+            lower = np.maximum(lower, aabb[:3])
+            upper = np.minimum(upper, aabb[3:])
+
+        if slab is not None:
+            axis = "xyz".index(str(slab.get('axis', 'x')).lower())
+            if 'pos' in slab:
+                pos = float(slab['pos'])
+            else:
+                pos = 0.5 * (index.lower[axis] + index.upper[axis]) + 0.5 * float(slab.get('pct', 0.0)) * (index.upper[axis] - index.lower[axis])
+            half_thickness = 0.5 * float(slab.get('thickness', index.cell_size))
+            lower[axis] = max(lower[axis], pos - half_thickness)
+            upper[axis] = min(upper[axis], pos + half_thickness)
+
+        indices = index.query_aabb(lower, upper)
+        print(f"Region of interest: {indices.shape[0]:,} of {index.num_points:,} points")
+        return indices
+
+    def _query_file_index(self, config_request):
+        '''Index of the design a query refers to, None if the design is not available'''
+
+        if self.files:
+            try:
+                file_index = int(config_request.get('id', self.from_file))
+            except (TypeError, ValueError):
+                return None
+            # unlike config requests, queries are never answered with another design: ids out of the range,
+            # or in a gap of a watched dataset, are not available
+            return file_index if file_index in self.file_inferences else None
+
+        # uploaded designs are only loaded while they are the current one
+        if self.data and self._design_key(-1, config_request) == self._design_key(-1, self.config_request_old):
+            return -1
+        return None
+
+    @contextmanager
+    def _design_data(self, file_index):
+        '''Make the data of a design current while answering a query about it'''
+
+        data = self.data
+        if file_index >= 0:
+            file_inference = self._get_file_inference(file_index)
+            if not file_inference.get_data():
+                file_inference.load_data()
+            self.data = file_inference.get_data()
+        try:
+            yield
+        finally:
+            self.data = data
+
+    def _interpolate(self, file_index, config_request, points, k):
+        '''
+        Velocity and pressure at points, inverse distance weighted over the k nearest design points
+
+        Returns a dict of field values (None for missing fields) and the distance to the nearest point.
+        '''
+
+        cache = self._get_design_cache(self._design_key(file_index, config_request))
+        with self._design_data(file_index):
+            index = self._get_spatial_index(file_index, config_request)
+            probe_fields = self._get_cached(cache, 'probe_fields',
+                                            lambda: {f: self._get_field(file_index, f) for f in ['velocity', 'pressure']})
+        if index is None:
+            return None, None
+
+        indices, distances = index.query_knn(points, k)
+        weights = 1.0 / np.maximum(distances, 1e-12) ** 2
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        values = {}
+        for field_name, array in probe_fields.items():
             if array is None:
-                return None, None
+                values[field_name] = None
+                continue
+            field_values = np.einsum('qk,qkc->qc', weights, array.reshape(index.num_points, -1)[indices].astype(np.float64))
+            values[field_name] = field_values if field_values.shape[1] > 1 else field_values[:, 0]
+        return values, distances[:, 0]
+
+    def probe(self, config_request):
+        '''
+        Interpolate velocity and pressure at query points
+
+        Request: {'request_type': 'probe', 'id': ..., 'points': [[x, y, z], ...], 'k': 8}, with the
+        points in the units of the 'coordinates' field. Values are inverse distance weighted over
+        the k nearest points, 'distance' is the distance to the nearest point.
+        '''
+
+        points = np.asarray(config_request.get('points', []), dtype=np.float64).reshape(-1, 3)
+        k = int(config_request.get('k', PROBE_NEIGHBOURS))
+        if points.shape[0] > MAX_PROBE_POINTS:
+            return {'error': f"Too many probe points ({points.shape[0]} > {MAX_PROBE_POINTS})"}
+
+        file_index = self._query_file_index(config_request)
+        if file_index is None:
+            return {'error': f"Design '{config_request.get('id')}' is not available"}
+
+        values, distance = self._interpolate(file_index, config_request, points, k)
+        if values is None:
+            return {'error': "Design has no 'coordinates'"}
+
+        reply = {'id': config_request.get('id'), 'distance': distance.tolist()}
+        for field_name, field_values in values.items():
+            reply[field_name] = None if field_values is None else field_values.tolist()
+        return reply
+
+    def get_slice(self, config_request):
+        '''
+        Resample velocity and pressure onto a 2D grid on an axis aligned plane
+
+        Request: {'request_type': 'slice', 'id': ..., 'axis': 'x', 'pct': -1..1 (as in set_slice_pos)
+        or 'pos': coordinate, 'resolution': [nu, nv], 'k': 4}. The plane spans the design points in
+        the two other axes (u, v in xyz order). Positions are snapped to one of SLICE_POSITION_BUCKETS
+        planes along the axis and the slices are cached per design, axis and bucket.
+
+        Returns a header and the arrays: velocity float32 (nv, nu, 3), pressure float32 (nv, nu).
+        Pixels farther than a pixel diagonal (or an index cell) from the points are NaN.
+        '''
+
+        file_index = self._query_file_index(config_request)
+        if file_index is None:
+            return {'error': f"Design '{config_request.get('id')}' is not available"}, []
+
+        with self._design_data(file_index):
+            index = self._get_spatial_index(file_index, config_request)
+        if index is None:
+            return {'error': "Design has no 'coordinates'"}, []
+
+        axis = str(config_request.get('axis', 'x')).lower()
+        if axis not in ('x', 'y', 'z'):
+            return {'error': f"Invalid slice axis '{axis}'"}, []
+        axis = "xyz".index(axis)
+        u, v = [a for a in range(3) if a != axis]
+        resolution = config_request.get('resolution', [SLICE_RESOLUTION, SLICE_RESOLUTION])
+        nu, nv = [int(np.clip(int(r), 1, MAX_SLICE_RESOLUTION)) for r in resolution]
+        k = int(config_request.get('k', SLICE_NEIGHBOURS))
+
+        lower, upper = index.lower, index.upper
+        if 'pos' in config_request:
+            pos = float(config_request['pos'])
+        else:
+            pos = 0.5 * (lower[axis] + upper[axis]) + 0.5 * float(config_request.get('pct', 0.0)) * (upper[axis] - lower[axis])
+        bucket_size = max(upper[axis] - lower[axis], 1e-6) / SLICE_POSITION_BUCKETS
+        bucket = int(np.clip(np.floor((pos - lower[axis]) / bucket_size), 0, SLICE_POSITION_BUCKETS - 1))
+
+        def resample():
+            start_time = time.time()
+            pos = lower[axis] + (bucket + 0.5) * bucket_size
+            pixel_u = (upper[u] - lower[u]) / nu
+            pixel_v = (upper[v] - lower[v]) / nv
+            grid_v, grid_u = np.meshgrid(lower[v] + (np.arange(nv) + 0.5) * pixel_v, lower[u] + (np.arange(nu) + 0.5) * pixel_u, indexing='ij')
+            points = np.zeros((nv * nu, 3), dtype=np.float64)
+            points[:, axis] = pos
+            points[:, u] = grid_u.ravel()
+            points[:, v] = grid_v.ravel()
+
+            values, distance = self._interpolate(file_index, config_request, points, k)
+            empty = distance > max(np.hypot(pixel_u, pixel_v), index.cell_size)
+
+            arrays = {}
+            for field_name, field_values in values.items():
+                if field_values is None:
+                    continue
+                field_values = field_values.astype(np.float32)
+                field_values[empty] = np.nan
+                arrays[field_name] = field_values.reshape((nv, nu) + field_values.shape[1:])
+
+            header = {
+                'axis': "xyz"[axis],
+                'pos': float(pos),
+                'axes': ["xyz"[u], "xyz"[v]],
+                'bounds': [float(lower[u]), float(lower[v]), float(upper[u]), float(upper[v])],
+                'resolution': [nu, nv],
+                'coverage': float(1.0 - empty.mean()),
+            }
+            print(f"Sliced {header['axis']} = {pos:.4f} at {nu}x{nv} in {time.time() - start_time:.2f}s")
+            return header, arrays
+
+        cache = self._get_design_cache(self._design_key(file_index, config_request))
+        slices = self._get_cached(cache, 'slices', OrderedDict)
+        slice_key = (axis, bucket, nu, nv, k)
+        header, arrays = self._get_cached(slices, slice_key, resample)
+        with self.design_cache_lock:
+            if slice_key in slices:
+                slices.move_to_end(slice_key)
+            while len(slices) > MAX_CACHED_SLICES:
+                slices.popitem(last=False)
+
+        header = dict(header, id=config_request.get('id'), fields=[
+            {'field_name': name, 'shape': array.shape, 'dtype': str(array.dtype)} for name, array in arrays.items()])
+        return header, list(arrays.values())
+
+    def _batch_items(self, config_request):
+        '''Items of a batch request as config requests, from [id, speed, multip] lists or dicts'''
+
+        items = []
+        for item in config_request.get('items', []):
+            if not isinstance(item, dict):
+                item = dict(zip(['id', 'config', 'multip'], item))
+            items.append(dict(item, timestamp=config_request.get('timestamp', 0)))
+        return items
+
+    def _load_designs(self, file_indices):
+        '''
+        Load the data of designs not in memory in parallel
+
+        Returns the designs held by the batch, to pass to `_release_designs`: the ones it loaded and the
+        ones other batches loaded and still use. Designs loaded otherwise are not held, they are never released.
+        '''
+
+        if self.preload_data:
+            return []
+
+        held = []
+        to_load = []
+        with self.batch_designs_lock:
+            for i in sorted({i for i in file_indices if i is not None and i >= 0}):
+                file_inference = self._get_file_inference(i)
+                if file_inference in self.batch_designs:
+                    self.batch_designs[file_inference] += 1
+                elif not file_inference.get_data():
+                    self.batch_designs[file_inference] = 1
+                    to_load.append(file_inference)
+                else:
+                    continue
+                held.append(file_inference)
+
+        if to_load:
+            print(f"Loading {len(to_load)} designs for a batch...")
+            with ThreadPoolExecutor(min(BATCH_WORKERS, len(to_load))) as pool:
+                list(pool.map(lambda file_inference: file_inference.load_data(), to_load))
+        return held
+
+    def _release_designs(self, held):
+        '''Release the designs held by a batch, the data of the last batch using a design is dropped'''
+
+        with self.batch_designs_lock:
+            for file_inference in held:
+                self.batch_designs[file_inference] -= 1
+                if self.batch_designs[file_inference] > 0:
+                    continue
+                del self.batch_designs[file_inference]
+
+                # a client may have selected the design meanwhile
+                data = file_inference.get_data()
+                if not any(s.data is data for s in list(self.sessions.sessions.values())):
+                    file_inference.data = {}
+
+    def get_batch(self, config_request, file_indices=None, designs=None):
+        '''
+        Fields of several designs stacked along the first axis, for design sweeps
+
+        Request: {'request_type': 'batch', 'items': [[id, speed, multip], ...], 'fields': [...]}, the fields
+        default to the fields that do not depend on the request. Returns a header and one array per field,
+        the rows of item i are offsets[i]:offsets[i + 1] of the field. Items not available are empty.
+        Can run in a worker thread with the `file_indices` of the items and their `designs` (see `_snapshot_designs`)
+        taken beforehand, the designs removed or replaced meanwhile are answered as they were.
+        '''
+
+        items = self._batch_items(config_request)
+        if file_indices is None:
+            file_indices = [self._query_file_index(item) for item in items]
+        if designs is None:
+            designs = self._snapshot_designs(file_indices)
+        # indices removed from the catalog before the snapshot are not available
+        file_indices = [i if i is None or i < 0 or i in designs else None for i in file_indices]
+
+        with self._pinned_designs(designs):
+            return self._stack_batch(config_request, items, file_indices)
+
+    def _stack_batch(self, config_request, items, file_indices):
+        field_names = config_request.get('fields') or [
+            f for f in self.field_names if f not in self.computed_fields or f in self.per_design_fields]
+
+        loaded = self._load_designs(file_indices)
+        try:
+            fields = []
+            arrays = []
+            for field_name in field_names:
+                parts = []
+                for item, file_index in zip(items, file_indices):
+                    array = None
+                    if file_index is not None:
+                        with self._design_data(file_index):
+                            array = self._get_field(file_index, field_name, item)
+                    parts.append(None if array is None else np.asarray(array).reshape((-1,) + np.shape(array)[1:]))
+
+                present = [part for part in parts if part is not None]
+                if not present:
+                    continue
+                empty = np.zeros((0,) + present[0].shape[1:], dtype=present[0].dtype)
+                parts = [empty if part is None else part.astype(empty.dtype, copy=False) for part in parts]
+                offsets = np.concatenate([[0], np.cumsum([part.shape[0] for part in parts])])
+
+                array = np.concatenate(parts)
+                fields.append({'field_name': field_name, 'shape': array.shape, 'dtype': str(array.dtype),
+                               'offsets': offsets.tolist()})
+                arrays.append(array)
+        finally:
+            self._release_designs(loaded)
+
+        header = {
+            'items': [dict(item, loaded=file_index is not None) for item, file_index in zip(items, file_indices)],
+            'fields': fields,
+        }
+        print(f"Batch of {len(items)} designs: {sum(a.nbytes for a in arrays) / 1e6:.1f} MB")
+        return header, arrays
+
+    def _get_field_stats(self, file_index, field_name, config_request):
+        '''Get the cached statistics of a field over the whole design, None for request dependent fields'''
+
+        if field_name in self.computed_fields and field_name not in self.per_design_fields:
+            return None
+
+        def compute():
+            array = self._get_field(file_index, field_name, config_request)
+            return None if array is None else compute_field_stats(array)
+
+        cache = self._get_design_cache(self._design_key(file_index, config_request))
+        return self._get_cached(cache, ('stats', field_name), compute)
+
+    def get_update_fields(self, file_index, config_request, data, designs=None):
+        '''
+        Fields of the update of a config request, [(index in field_names, field_name, metadata, array)]
+
+        Runs in a worker thread, with the `data` of the design loaded by `_request_data` and the design
+        pinned with `_snapshot_designs`, while the event loop keeps serving.
+        '''
+
+        self.data = data
+        try:
+            with self._pinned_designs(designs or {}):
+                # builds the spatial index of the design on first use
+                roi_indices = self._get_roi_indices(file_index, config_request)
+                fields = []
+                for i, field_name in enumerate(self.field_names):
+                    metadata, array = self._get_data_to_send(file_index, field_name, config_request, roi_indices)
+                    if array is not None:
+                        fields.append((i, field_name, metadata, array))
+                return fields
+        finally:
+            self.data = None
+
+    def _get_data_to_send(self, file_index, field_name, config_request, roi_indices=None):
+
+        array = self._get_field(file_index, field_name, config_request)
+        if array is None:
+            return None, None
+
+        # crop point fields to the region of interest
+        if roi_indices is not None and (field_name not in self.computed_fields or field_name in self.computed_point_fields):
+            num_points = self._get_spatial_index(file_index, config_request).num_points
+            if array.ndim > 0 and array.shape[0] == num_points:
+                array = array[roi_indices]
 
         # Send the metadata
         metadata = {
@@ -250,15 +1069,24 @@ class Service:
             'shape': array.shape,
             'dtype': str(array.dtype),
         }
+        if field_name in VOXEL_FIELDS:
+            metadata['cell_size'] = self._get_voxel_grid(file_index, config_request).cell_size * STAGE_UNITS_PER_METER
+            metadata['block_dim'] = BLOCK_DIM
+
+        # bounds and histogram of the whole design, clients skip a pass over the values
+        stats = self._get_field_stats(file_index, field_name, config_request)
+        if stats is not None:
+            metadata['stats'] = stats
         return metadata, array
 
-    def load_uploaded_files(self, stl_filename, streamlines_filename):
+    def load_uploaded_files(self, stl_filename, streamlines_filename, triangle_budget=None):
         """
         Load STL file and streamlines JSON from uploaded files directory
 
         Args:
             stl_filename: Name of the STL file
             streamlines_filename: Name of the streamlines JSON file
+            triangle_budget: Optional maximum of STL triangles, picks a level of detail of the mesh
 
         Returns:
             Dictionary with coordinates, velocity, streamlines_data, and bounding_box_dims
@@ -276,61 +1104,61 @@ class Service:
             print(f"Looking for STL at: {stl_path}")
             print(f"Looking for streamlines at: {streamlines_path}")
 
-            # Load STL file
-            if stl_path.exists():
-                print(f"Loading STL file: {stl_path}")
-                stl_mesh = trimesh.load(str(stl_path))
+            # Load STL file, memory mapped from the mesh prepared by the upload service
+            mesh_arrays = load_mesh_arrays(stl_path, triangle_budget) if stl_path.exists() else None
+            if mesh_arrays is not None:
+                print(f"Loading mesh arrays of: {stl_path}")
 
-                # Get bounding box
-                bounds = stl_mesh.bounds  # [[xmin, ymin, zmin], [xmax, ymax, zmax]]
-                output_data["bounding_box_dims"] = bounds.astype(np.float32)
+                output_data["bounding_box_dims"] = np.array(mesh_arrays['bounds'], dtype=np.float32)
+                output_data["stl_vertices"] = np.asarray(mesh_arrays['vertices'])
+                output_data["stl_faces"] = np.asarray(mesh_arrays['faces'])
 
-                # Store STL mesh data
-                output_data["stl_vertices"] = stl_mesh.vertices.astype(np.float32)
-                output_data["stl_faces"] = stl_mesh.faces.astype(np.int32)
+                self.current_stl_path = str(stl_path)
+                print(f"Loaded STL: {len(mesh_arrays['vertices'])} vertices, bounds: {output_data['bounding_box_dims']}")
+
+            elif stl_path.exists():
+                print(f"Loading STL file: {stl_path}")
+                output_data.update(self._get_parsed_upload(stl_path, self._parse_stl))
 
                 self.current_stl_path = str(stl_path)
-                print(f"Loaded STL: {stl_mesh.vertices.shape[0]} vertices, bounds: {bounds}")
+                print(f"Loaded STL: {output_data['stl_vertices'].shape[0]} vertices, bounds: {output_data['bounding_box_dims']}")
             else:
                 print(f"WARNING: STL file not found: {stl_path}")
                 # Use default bounds
                 output_data["bounding_box_dims"] = BOUNDS.astype(np.float32)
 
-            # Load streamlines JSON
-            if streamlines_path.exists():
+            # Load streamlines, memory mapped from the binary copy written at upload time
+            streamline_arrays = load_streamline_arrays(streamlines_path) if streamlines_path.exists() else None
+            if streamline_arrays is not None:
+                print(f"Loading streamline arrays of: {streamlines_path}")
+
+                points = streamline_arrays['points']
+                scalars = streamline_arrays.get('scalars')
+                if scalars is not None:
+                    # as below, scalars as velocity in X and the default velocity for lines without them
+                    has_scalar = np.isfinite(scalars)
+                    velocities = np.ones((len(points), 3), dtype=np.float32) * 30.0
+                    velocities[has_scalar] = 0.0
+                    velocities[has_scalar, 0] = scalars[has_scalar]
+                else:
+                    velocities = np.ones((len(points), 3), dtype=np.float32) * 30.0
+
+                if len(points) > 0:
+                    output_data["coordinates"] = np.asarray(points)
+                    output_data["velocity"] = velocities
+                    output_data["pressure"] = np.zeros((len(points),), dtype=np.float32)
+
+                    print(f"Loaded {len(streamline_arrays['counts'])} streamlines")
+                    print(f"Total points: {len(points)}")
+
+                self.current_streamlines_path = str(streamlines_path)
+
+            elif streamlines_path.exists():
                 print(f"Loading streamlines JSON: {streamlines_path}")
-                with open(streamlines_path, 'r') as f:
-                    streamlines_data = json.load(f)
-
-                # Store the full streamlines data for direct use by Kit App
-                output_data["streamlines_json"] = streamlines_data
-
-                # Also convert to coordinates/velocity format for compatibility
-                all_points = []
-                all_velocities = []
-
-                for streamline in streamlines_data.get("streamlines", []):
-                    path = np.array(streamline["path"], dtype=np.float32)
-
-                    # Use scalar values as velocity magnitudes if available
-                    if "scalar" in streamline:
-                        scalars = np.array(streamline["scalar"], dtype=np.float32)
-                        # Create velocity vectors (assuming flow in X direction for now)
-                        # This is a simplified representation
-                        velocities = np.column_stack([scalars, np.zeros_like(scalars), np.zeros_like(scalars)])
-                    else:
-                        # Default velocity
-                        velocities = np.ones((len(path), 3), dtype=np.float32) * 30.0
-
-                    all_points.append(path)
-                    all_velocities.append(velocities)
-
-                if all_points:
-                    output_data["coordinates"] = np.vstack(all_points)
-                    output_data["velocity"] = np.vstack(all_velocities)
-                    output_data["pressure"] = np.zeros((len(output_data["coordinates"]),), dtype=np.float32)
-
-                    print(f"Loaded {len(streamlines_data.get('streamlines', []))} streamlines")
+                output_data.update(self._get_parsed_upload(streamlines_path, self._parse_streamlines))
+
+                if "coordinates" in output_data:
+                    print(f"Loaded {len(output_data['streamlines_json'].get('streamlines', []))} streamlines")
                     print(f"Total points: {len(output_data['coordinates'])}")
 
                 self.current_streamlines_path = str(streamlines_path)
@@ -347,4 +1175,131 @@ class Service:
             print(f"ERROR loading uploaded files: {e}")
             import traceback
             traceback.print_exc()
-            return None
\ No newline at end of file
+            return None
+
+    @staticmethod
+    def _parse_stl(stl_path):
+        '''Bounds, vertices and faces of an STL file without a prepared mesh'''
+
+        stl_mesh = trimesh.load(str(stl_path))
+        return {
+            # [[xmin, ymin, zmin], [xmax, ymax, zmax]]
+            "bounding_box_dims": stl_mesh.bounds.astype(np.float32),
+            "stl_vertices": stl_mesh.vertices.astype(np.float32),
+            "stl_faces": stl_mesh.faces.astype(np.int32),
+        }
+
+    @staticmethod
+    def _parse_streamlines(streamlines_path):
+        '''Parsed JSON and points of a streamlines file without prepared arrays'''
+
+        with open(streamlines_path, 'r') as f:
+            streamlines_data = json.load(f)
+
+        # Store the full streamlines data for direct use by Kit App
+        parsed = {"streamlines_json": streamlines_data}
+
+        # Also convert to coordinates/velocity format for compatibility
+        all_points = []
+        all_velocities = []
+
+        for streamline in streamlines_data.get("streamlines", []):
+            path = np.array(streamline["path"], dtype=np.float32)
+
+            # Use scalar values as velocity magnitudes if available
+            if "scalar" in streamline:
+                scalars = np.array(streamline["scalar"], dtype=np.float32)
+                # Create velocity vectors (assuming flow in X direction for now)
+                # This is a simplified representation
+                velocities = np.column_stack([scalars, np.zeros_like(scalars), np.zeros_like(scalars)])
+            else:
+                # Default velocity
+                velocities = np.ones((len(path), 3), dtype=np.float32) * 30.0
+
+            all_points.append(path)
+            all_velocities.append(velocities)
+
+        if all_points:
+            parsed["coordinates"] = np.vstack(all_points)
+            parsed["velocity"] = np.vstack(all_velocities)
+            parsed["pressure"] = np.zeros((len(parsed["coordinates"]),), dtype=np.float32)
+        return parsed
+
+    def _get_parsed_upload(self, path, parse):
+        '''
+        Parsed uploaded file from the cache, parsed on a miss (or waited for while a prewarm parses it)
+
+        Entries are keyed by inode and modification time, a file uploaded again under the same name
+        is parsed again. The cached arrays are shared by the loads, they are read only.
+        '''
+
+        stat = path.stat()
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        with self.parsed_uploads_lock:
+            entry = self.parsed_uploads.get(key)
+            owner = entry is None
+            if owner:
+                entry = self.parsed_uploads[key] = {'ready': threading.Event(), 'data': None}
+                self.parsed_upload_misses += 1
+            else:
+                self.parsed_uploads.move_to_end(key)
+                self.parsed_upload_hits += 1
+
+        if not owner:
+            entry['ready'].wait()
+            if entry['data'] is None:
+                return parse(path)      # the parse of the other thread failed
+            return entry['data']
+
+        try:
+            data = parse(path)
+            for value in data.values():
+                if isinstance(value, np.ndarray):
+                    value.flags.writeable = False
+            entry['data'] = data
+        finally:
+            entry['ready'].set()
+            with self.parsed_uploads_lock:
+                if entry['data'] is None:
+                    self.parsed_uploads.pop(key, None)
+                while len(self.parsed_uploads) > MAX_PARSED_UPLOADS:
+                    self.parsed_uploads.popitem(last=False)
+        return data
+
+    def prewarm_upload(self, kind, filename):
+        '''
+        Prepare an uploaded file for its first load, called in a worker thread after its upload
+
+        Files with arrays prepared by the upload service have them read once into the page cache,
+        the others are parsed into the parse cache. Returns True for prepared arrays.
+        '''
+
+        if kind not in ('stl', 'streamlines'):
+            raise RuntimeError(f"Unknown upload kind '{kind}'")
+        path = Path(self.uploaded_files_dir) / kind / Path(filename).name
+        if not path.exists():
+            raise RuntimeError(f"Uploaded file '{path}' not found")
+
+        start = time.perf_counter()
+        if kind == 'stl':
+            arrays_dir = path.with_suffix(MESH_SUFFIX)
+            prepared = load_mesh_arrays(path) is not None
+            parse = self._parse_stl
+        else:
+            arrays_dir = path.with_suffix(ARRAYS_SUFFIX)
+            prepared = load_streamline_arrays(path) is not None
+            parse = self._parse_streamlines
+
+        if prepared:
+            for array_path in sorted(arrays_dir.glob("*.npy")):
+                with open(array_path, 'rb') as f:
+                    while f.read(PREWARM_READ_SIZE):
+                        pass
+        else:
+            self._get_parsed_upload(path, parse)
+        print(f"Prewarmed {kind} '{path.name}' ({'arrays' if prepared else 'parsed'}) in {time.perf_counter() - start:.2f} s")
+        return prepared
+
+    def get_parsed_upload_stats(self):
+        with self.parsed_uploads_lock:
+            return {'entries': len(self.parsed_uploads), 'hits': self.parsed_upload_hits, 'misses': self.parsed_upload_misses}
@@ -1,60 +1,205 @@
 import zmq
 import zmq.asyncio
 import json
+import time
 import numpy as np
 import asyncio
+from pathlib import Path
 
 from .service import Service
+from .socket_tuning import SocketTuner, array_bytes, ZMQ_CHUNK_SIZE, STALL_SLEEP, STALL_MAX_SLEEP, STALL_TIMEOUT
+from .reliable_channel import ReliableChannel
+from .surface_channel import SurfaceChannel
+from .dataset_watcher import DatasetWatcher
+from .request_recorder import RequestRecorder
 
-ZMQ_CHUNK_SIZE = 2 * 1024 * 1024  # 2MB
+# multiplexed publishing: every message starts with a topic frame "<field_name>|"
+TOPIC_SEPARATOR = "|"
+TOC_TOPIC = "__toc__"
+
+# prewarm notifications the upload service spools in the uploaded files directory when it cannot reach the socket
+PREWARM_SPOOL_DIR = ".prewarm"
+PREWARM_POLL_INTERVAL = 1.0
+
+
+def field_topic(field_name, prefix=""):
+    '''Topic frame of a field, the separator keeps "velocity" from matching "velocity_magnitude"'''
+
+    return f"{prefix}{field_name}{TOPIC_SEPARATOR}".encode('utf-8')
 
 
 class ServiceZMQ(Service):
+    tuner = None
+    reliable_channel = None
+    surface_channel = None
+    surface_design = None   # (file_index, config_request) served on the surface channel
+    dataset_watcher = None
+    recorder = None
+    preloaded = None        # set once the designs are preloaded, queries about them wait for it
+
+    def __init__(self, chunk_size=None, reliable=False, surface=False, multiplex=False, record=None, **kwargs):
+        super().__init__(**kwargs)
+        # None lets the tuner pick the chunk size, 0 sends arrays in one chunk
+        self.chunk_size = chunk_size
+        # additional DEALER/ROUTER data channel next to the PUB sockets
+        self.reliable = reliable
+        # additional XPUB socket for the surface fields
+        self.surface = surface
+        # all fields on one PUB socket with topic frames instead of a socket per field
+        self.multiplex = multiplex
+        # JSON lines file the config requests are recorded to, for replay.py
+        self.record = record
+
+    @staticmethod
+    async def _send(socket, frame, copy=True, topic=None):
+        # the queue is checked on the first frame, the rest of a multipart message always follows
+        if topic is not None:
+            await socket.send(topic, zmq.DONTWAIT | zmq.SNDMORE)
+        await socket.send(frame, zmq.DONTWAIT, copy=copy)
+
+    @staticmethod
+    async def send_frame(socket, frame, tuner=None, copy=True, topic=None, stall=None):
+        '''
+        Send one message (prefixed with a topic frame), retrying with back-off while a subscriber queue is full
+
+        `stall` ({'waited': seconds}) is shared by the messages of one update: once they waited
+        STALL_TIMEOUT in total, the rest of the update is sent without waiting, dropped for the slow subscriber.
+        '''
+
+        if tuner is None:
+            await ServiceZMQ._send(socket, frame, copy, topic)
+            return
+
+        if stall is None:
+            stall = {'waited': 0.0}
+        sleep = STALL_SLEEP
+        stalled = False
+        while stall['waited'] < STALL_TIMEOUT:
+            try:
+                await ServiceZMQ._send(socket, frame, copy, topic)
+                return
+            except zmq.Again:
+                if not stalled:
+                    tuner.on_stall()
+                    stalled = True
+                await asyncio.sleep(sleep)
+                stall['waited'] += sleep
+                sleep = min(2 * sleep, STALL_MAX_SLEEP)
+
+        # fall back to plain PUB behaviour, the message is dropped for the slow subscriber only
+        tuner.on_drop()
+        socket.setsockopt(zmq.XPUB_NODROP, 0)
+        try:
+            await ServiceZMQ._send(socket, frame, copy, topic)
+        finally:
+            socket.setsockopt(zmq.XPUB_NODROP, 1)
 
     @staticmethod
-    async def send_data(socket, metadata, data_array):
-        '''Send data with ZMQ'''
+    async def send_data(socket, metadata, data_array, tuner=None, topic=None, stall=None):
+        '''Send data with ZMQ, every message is prefixed with `topic` on a multiplexed socket, `stall` as in send_frame'''
+
+        if stall is None:
+            stall = {'waited': 0.0}
 
         json_string = json.dumps(metadata)
+        start_time = time.perf_counter()
+        waited = stall['waited']
 
         try:
-            await socket.send(json_string.encode('utf-8'), zmq.DONTWAIT)
+            await ServiceZMQ.send_frame(socket, json_string.encode('utf-8'), tuner, topic=topic, stall=stall)
         except zmq.ZMQError as e:
             raise RuntimeError(f"Error sending metadata with ZMQ: {e}")
 
-        chunk_size = data_array.nbytes if ZMQ_CHUNK_SIZE == 0 else ZMQ_CHUNK_SIZE
-        num_chunks = (data_array.nbytes + chunk_size - 1) // chunk_size
+        data_bytes = array_bytes(data_array)
+        chunk_size = tuner.chunk_size if tuner is not None else ZMQ_CHUNK_SIZE
+        chunk_size = data_bytes.nbytes if chunk_size == 0 else chunk_size
+        num_chunks = (data_bytes.nbytes + chunk_size - 1) // chunk_size if chunk_size > 0 else 0
 
         try:
-            await socket.send(b"START", zmq.DONTWAIT)
+            await ServiceZMQ.send_frame(socket, b"START", tuner, topic=topic, stall=stall)
 
             for i in range(num_chunks):
                 start = i * chunk_size
-                end = min(start + chunk_size, data_array.nbytes)
-                chunk = data_array[start:end]
-                await socket.send(chunk, zmq.DONTWAIT, copy=False)
+                end = min(start + chunk_size, data_bytes.nbytes)
+                chunk = data_bytes[start:end]
+                await ServiceZMQ.send_frame(socket, chunk, tuner, copy=False, topic=topic, stall=stall)
 
-            await socket.send(b"END")
+            await ServiceZMQ.send_frame(socket, b"END", tuner, topic=topic, stall=stall)
         except zmq.ZMQError as e:
             raise RuntimeError(f"Error sending array with ZMQ: {e}")
 
+        if tuner is not None:
+            # an update out of stall budget drops instead of waiting, its arrays tell nothing about the link
+            stalled = stall['waited'] - waited if stall['waited'] < STALL_TIMEOUT else 0.0
+            tuner.record(data_bytes.nbytes, time.perf_counter() - start_time, stalled)
+
+    def get_stats(self, config_request=None):
+        '''Statistics reported on a `stats` request'''
+
+        stats = {}
+        if self.tuner is not None:
+            stats['sockets'] = self.tuner.get_stats()
+        if self.reliable_channel is not None:
+            stats['reliable_channel'] = self.reliable_channel.get_stats()
+        stats['sessions'] = len(self.sessions)
+        stats['parsed_uploads'] = self.get_parsed_upload_stats()
+        return stats
+
+    def prewarm(self, config_request):
+        '''
+        Answer a prewarm request at once, the uploaded file is prepared in a worker thread
+
+        Request: {'request_type': 'prewarm', 'kind': 'stl' or 'streamlines', 'filename': ...}, sent by
+        the upload service after an upload so the first load of the file is served from cache.
+        '''
+
+        kind = config_request.get('kind')
+        filename = config_request.get('filename')
+        if kind not in ('stl', 'streamlines') or not filename:
+            raise RuntimeError("Prewarm request needs a 'kind' ('stl' or 'streamlines') and a 'filename'")
+        self._schedule_prewarm(kind, filename)
+        return {'prewarming': filename}
+
+    def _schedule_prewarm(self, kind, filename):
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                print(f"ERROR: Could not prewarm {kind} '{filename}': {future.exception()}")
+
+        future = asyncio.get_running_loop().run_in_executor(None, self.prewarm_upload, kind, filename)
+        future.add_done_callback(done)
+
     async def _receive_data(self, config_queue, context, url, first_port):
 
+        # the arrays, derived fields and statistics of all designs are computed in a worker thread,
+        # the config port answers (stats, prewarm) meanwhile
         if self.file_inferences:
-            self._data_preloader()
+            await asyncio.get_running_loop().run_in_executor(None, self._data_preloader)
+        self.preloaded.set()
 
         fields_cnt = len(self.field_names)
 
         # Set up ZeroMQ
         sockets = []
         port = first_port
-        for i in range(fields_cnt):
+        for i in range(1 if self.multiplex else fields_cnt):
             socket = context.socket(zmq.PUB)
+            self.tuner.configure(socket)
             socket.bind(f"{url}{port}")
             sockets.append(socket)
             port += 1
 
-        print(f"Created publisher sockets on ports {first_port} - {port - 1}")
+        if self.multiplex:
+            print(f"Created multiplexed publisher socket on port {first_port}")
+        else:
+            print(f"Created publisher sockets on ports {first_port} - {port - 1}")
+
+        # the optional channels take the ports after the publishers
+        if self.reliable_channel is not None:
+            self.reliable_channel.bind(context, f"{url}{port}")
+            port += 1
+        if self.surface_channel is not None:
+            self.surface_channel.bind(context, f"{url}{port}")
+            port += 1
 
         self._reset_config()
 
@@ -64,15 +209,140 @@ class ServiceZMQ(Service):
             print("Requesting config: ", config_request)
 
             file_index = self._request_data(config_request)
+            # updates requested with a 'client_id' are published on the topics of the session
+            session = self.sessions.get(config_request.get('client_id'))
+            prefix = session.topic_prefix
 
-            for i in range(fields_cnt):
-                field_name = self.field_names[i]
-                metadata, array = self._get_data_to_send(file_index, field_name, config_request)
-                if array is None:
-                    continue
+            # the fields are computed in a worker thread (streamlines, voxel grid, derived fields and statistics
+            # may take seconds), queries and the other channels are served meanwhile
+            designs = self._snapshot_designs([file_index])
+            fields = await asyncio.get_running_loop().run_in_executor(
+                None, self.get_update_fields, file_index, config_request, self.data, designs)
+
+            # stall budget of the whole update, a slow subscriber delays it by STALL_TIMEOUT at most
+            stall = {'waited': 0.0}
 
+            if self.multiplex:
+                # table of contents first, clients know which fields follow in this update
+                await ServiceZMQ.send_frame(sockets[0], json.dumps(self._get_toc(config_request, fields, prefix)).encode('utf-8'),
+                                            self.tuner, topic=field_topic(TOC_TOPIC, prefix), stall=stall)
+
+            for i, field_name, metadata, array in fields:
                 print(f"Sending field '{field_name}'...")
-                await ServiceZMQ.send_data(sockets[i], metadata, array)
+                if self.multiplex:
+                    await ServiceZMQ.send_data(sockets[0], metadata, array, self.tuner, topic=field_topic(field_name, prefix), stall=stall)
+                else:
+                    await ServiceZMQ.send_data(sockets[i], metadata, array, self.tuner, stall=stall)
+
+                if self.reliable_channel is not None:
+                    self.reliable_channel.publish(field_name, metadata, array, session.client_id)
+
+            if self.reliable_channel is not None:
+                # the last values of dropped sessions go with them
+                self.reliable_channel.retain_sessions(self.sessions.sessions.keys())
+
+            # the surface channel has no session topics, it follows the shared session
+            if self.surface_channel is not None and session.client_id is None:
+                self.surface_design = (file_index, config_request)
+                self.surface_channel.update()
+
+            print(f"Socket stats: {self.tuner.get_stats()}")
+
+    @staticmethod
+    def _get_toc(config_request, fields, prefix=""):
+        '''Table of contents of an update on the multiplexed socket'''
+
+        return {
+            'timestamp': config_request['timestamp'],
+            'id': int(config_request['id']),
+            'fields': [{'field_name': field_name,
+                        'topic': field_topic(field_name, prefix).decode('utf-8'),
+                        'shape': metadata['shape'],
+                        'dtype': metadata['dtype'],
+                        'nbytes': int(array.nbytes)} for _, field_name, metadata, array in fields],
+        }
+
+    async def _run_query(self, designs, query, *args):
+        '''Answer a query in a worker thread so publishing goes on, with the current data and the designs it refers to'''
+
+        data = self.data
+
+        def run():
+            self.data = data
+            try:
+                with self._pinned_designs(designs):
+                    return query(*args)
+            finally:
+                self.data = None
+
+        return await asyncio.get_running_loop().run_in_executor(None, run)
+
+    async def batch(self, config_request):
+        '''Answer a batch request, the reply is built in a worker thread'''
+
+        # looked up on the loop, an uploaded design is only available while it is the current one
+        file_indices = [self._query_file_index(item) for item in self._batch_items(config_request)]
+        designs = self._snapshot_designs(file_indices)
+        return await self._run_query(designs, self.get_batch, config_request, file_indices, designs)
+
+    async def probe(self, config_request):
+        '''Answer a probe request in a worker thread, it may build the spatial index of the design'''
+
+        designs = self._snapshot_designs([self._query_file_index(config_request)])
+        return await self._run_query(designs, super().probe, config_request)
+
+    async def slice(self, config_request):
+        '''Answer a slice request, resampled in a worker thread'''
+
+        designs = self._snapshot_designs([self._query_file_index(config_request)])
+        return await self._run_query(designs, self.get_slice, config_request)
+
+    def _get_surface_data(self, field_name):
+        '''Metadata and array of a surface field of the current design'''
+
+        if self.surface_design is None:
+            return None, None
+
+        file_index, config_request = self.surface_design
+        array = self._get_surface_field(file_index, field_name)
+        if array is None:
+            return None, None
+
+        metadata = {
+            'timestamp': config_request['timestamp'],
+            'field_name': str(field_name),
+            'id': int(config_request['id']),
+            'shape': array.shape,
+            'dtype': str(array.dtype),
+        }
+        return metadata, array
+
+    @staticmethod
+    def _is_connect_request(config_request):
+        '''A client connecting sends a config request with a negative id'''
+
+        design_id = config_request['id']
+        return isinstance(design_id, (int, float)) and not isinstance(design_id, bool) and design_id < 0
+
+    def _check_config_request(self, config_request):
+        '''Error message for a config request the data loop could not serve, None if it is valid'''
+
+        if 'id' not in config_request:
+            return "Config request needs an 'id'"
+        if self._is_connect_request(config_request):
+            return None
+
+        design_id = config_request['id']
+        if isinstance(design_id, bool) or not isinstance(design_id, (int, float, str)):
+            return f"Invalid id {design_id!r}"
+        if self.files:
+            try:
+                int(design_id)
+            except ValueError:
+                return f"Invalid design id {design_id!r}, an integer is expected"
+        if not isinstance(config_request.get('timestamp'), (int, float)):
+            return "Config request needs a numeric 'timestamp'"
+        return None
 
     async def _receive_config_requests(self, config_queue, context, address):
 
@@ -81,15 +351,70 @@ class ServiceZMQ(Service):
         socket.setsockopt(zmq.RCVHWM, 1)  # Limit incoming requests
         fields_cnt = str(len(self.field_names))
 
+        # requests answered directly on the REP socket, they do not trigger a data update
+        design_queries = {'probe', 'slice', 'batch'}
+        query_handlers = {
+            'stats': self.get_stats,
+            'probe': self.probe,
+            'slice': self.slice,
+            'batch': self.batch,
+            'prewarm': self.prewarm,
+        }
+
         while True:
             print("Waiting for a config request...")
-            config_request = await socket.recv_json()
-            if config_request['id'] < 0:
+            try:
+                config_request = json.loads(await socket.recv())
+            except ValueError:
+                config_request = None
+
+            # a malformed request is answered with an error, it must not stop the service
+            error = None
+            request_type = None
+            if not isinstance(config_request, dict):
+                error = "Request must be a JSON object"
+            else:
+                if self.recorder is not None:
+                    self.recorder.record(config_request)
+                request_type = config_request.get('request_type', 'config')
+                if request_type == 'config':
+                    error = self._check_config_request(config_request)
+                elif request_type not in query_handlers:
+                    error = f"Unknown request_type '{request_type}'"
+
+            if error is not None:
+                print(f"ERROR: Invalid request: {error}")
+                await socket.send_json({'error': error})
+
+            elif request_type in query_handlers:
+                if request_type in design_queries:
+                    await self.preloaded.wait()
+                try:
+                    reply = query_handlers[request_type](config_request)
+                    if asyncio.iscoroutine(reply):
+                        reply = await reply
+                except Exception as e:
+                    print(f"ERROR: '{request_type}' request failed: {e}")
+                    reply = {'error': str(e)}
+
+                if isinstance(reply, tuple):
+                    # multipart reply: JSON header followed by the raw array buffers
+                    header, arrays = reply
+                    await socket.send_multipart([json.dumps(header).encode('utf-8')] + [array_bytes(a) for a in arrays], copy=False)
+                else:
+                    await socket.send_json(reply)
+
+            elif self._is_connect_request(config_request):
                 print(f"Client has connected to {address}...")
 
                 # confirm connection
                 await socket.send_string("0")
 
+            elif config_request.get('client_id') is not None and not self.multiplex:
+                # without topics the update of a session would reach every client
+                print(f"ERROR: Session request of '{config_request['client_id']}' refused, sessions need --zmq_multiplex")
+                await socket.send_json({'error': "Sessions ('client_id') need a service run with --zmq_multiplex"})
+
             else:
                 print("Config request received...")
                 await config_queue.put(config_request)
@@ -102,6 +427,7 @@ class ServiceZMQ(Service):
 
         # set up ZeroMQ
         context = zmq.asyncio.Context()
+        self.preloaded = asyncio.Event()
 
         if zmq_dir == "":
             protocol = "tcp"
@@ -112,11 +438,85 @@ class ServiceZMQ(Service):
 
         address = f"{url}{port}"
 
+        self.tuner = SocketTuner(protocol, self.chunk_size)
+        if self.reliable:
+            self.reliable_channel = ReliableChannel(self.tuner)
+        if self.surface:
+            self.surface_channel = SurfaceChannel(self._get_surface_data, self.tuner)
+        if self.record:
+            self.recorder = RequestRecorder(self.record)
+        if self.files and self.files.get('watch'):
+            self.dataset_watcher = DatasetWatcher(self.files['filepath'], self.files['from'])
+
         # next ports are used for publisher sockets
         port += 1
 
         self._field_names_reader()
 
         config_queue = asyncio.Queue()
-        await asyncio.gather(self._receive_config_requests(config_queue, context, address),
-                             self._receive_data(config_queue, context, url, port))
+        tasks = [self._receive_config_requests(config_queue, context, address),
+                 self._receive_data(config_queue, context, url, port)]
+        if self.reliable_channel is not None:
+            tasks += [self._run_reliable_channel()]
+        if self.surface_channel is not None:
+            tasks += [self._run_surface_channel()]
+        if self.dataset_watcher is not None:
+            tasks += [self._run_dataset_watcher()]
+        if not self.files:
+            tasks += [self._run_prewarm_spool()]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # a cancelled service closes its sockets, pending messages are dropped
+            context.destroy(linger=0)
+
+    async def _run_reliable_channel(self):
+        # wait for the socket, it is bound after the data preload
+        while self.reliable_channel.socket is None:
+            await asyncio.sleep(0.1)
+        await asyncio.gather(self.reliable_channel.receive_commands(), self.reliable_channel.pump())
+
+    async def _run_surface_channel(self):
+        while self.surface_channel.socket is None:
+            await asyncio.sleep(0.1)
+        await asyncio.gather(self.surface_channel.receive_subscriptions(), self.surface_channel.publish())
+
+    async def _run_dataset_watcher(self):
+        '''Apply changes of the dataset directory to the catalog while the service keeps serving'''
+
+        loop = asyncio.get_running_loop()
+        async for added, modified, removed in self.dataset_watcher.watch():
+            for file_index in sorted(removed):
+                self.remove_design(file_index)
+
+            for file_index in sorted(added | modified):
+                filepath = self.dataset_watcher.get_filepath(file_index)
+                try:
+                    # the design is read and preloaded in a worker thread, the old one is served until it is replaced
+                    file_inference, design_cache = await loop.run_in_executor(None, self.open_design, file_index, filepath)
+                    self.set_design(file_index, file_inference, design_cache)
+                except Exception as e:
+                    print(f"ERROR: Could not load design {file_index} from '{filepath}': {e}")
+
+    async def _run_prewarm_spool(self):
+        '''Prewarm the uploads notified through the spool directory, the stand-in for prewarm requests on the socket'''
+
+        spool_dir = Path(self.uploaded_files_dir) / PREWARM_SPOOL_DIR
+        while True:
+            for path in sorted(spool_dir.glob("*.json")):
+                try:
+                    with open(path) as f:
+                        notification = json.load(f)
+                except ValueError as e:
+                    print(f"WARNING: Dropping invalid prewarm notification '{path.name}': {e}")
+                    notification = None
+                except OSError:
+                    continue
+                path.unlink(missing_ok=True)
+
+                if notification is not None:
+                    try:
+                        self.prewarm(notification)
+                    except Exception as e:
+                        print(f"ERROR: Prewarm notification '{path.name}' failed: {e}")
+            await asyncio.sleep(PREWARM_POLL_INTERVAL)
@@ -0,0 +1,49 @@
+import time
+
+SESSION_TIMEOUT = 600.0     # seconds without a request before the state of a client is dropped
+
+
+class Session():
+    '''State of one client, keyed by the 'client_id' of its config requests (None for clients without one)'''
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.config_request_old = {'id': -1, 'config': -1, 'multip': -1}
+        self.data = None
+        self.file_index = None
+        self.load_key = None    # uploaded files the data was loaded from, see Service._get_upload_load_key
+        self.last_seen = time.monotonic()
+
+    @property
+    def topic_prefix(self):
+        '''Prefix of the topics the updates of the session are published on'''
+
+        return "" if self.client_id is None else f"{self.client_id}/"
+
+
+class SessionTable():
+    '''Sessions of the clients, idle sessions are dropped so their data can be freed'''
+
+    def __init__(self, timeout=SESSION_TIMEOUT):
+        self.timeout = timeout
+        self.sessions = {}
+
+    def get(self, client_id):
+        now = time.monotonic()
+        for key in [k for k, s in self.sessions.items() if k is not None and now - s.last_seen > self.timeout]:
+            print(f"Dropping idle session '{key}'")
+            del self.sessions[key]
+
+        session = self.sessions.get(client_id)
+        if session is None:
+            if client_id is not None:
+                print(f"New session '{client_id}'")
+            session = self.sessions[client_id] = Session(client_id)
+        session.last_seen = now
+        return session
+
+    def others(self, session):
+        return [s for s in self.sessions.values() if s is not session]
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,182 @@
+import os
+import zmq
+import numpy as np
+
+ZMQ_CHUNK_SIZE = 2 * 1024 * 1024  # 2MB, initial chunk size
+
+# Chunk sizes explored by the tuner (powers of two)
+MIN_CHUNK_SIZE = 256 * 1024         # 256KB
+MAX_CHUNK_SIZE = 32 * 1024 * 1024   # 32MB
+
+# Arrays smaller than this are too short to give a meaningful throughput sample
+MIN_TUNE_BYTES = 4 * MIN_CHUNK_SIZE
+# Only arrays that waited on a full queue for this share of their send time were paced by the link
+MIN_STALLED_SHARE = 0.1
+SAMPLES_PER_STEP = 3
+REEXPLORE_STEPS = 8
+THROUGHPUT_EMA = 0.5
+
+# Bytes allowed to queue per subscriber, the send high-water mark is derived from it
+QUEUE_BUDGET = {'tcp': 256 * 1024 * 1024, 'ipc': 128 * 1024 * 1024}
+MAX_QUEUE_BUDGET = 512 * 1024 * 1024
+QUEUE_MEMORY_SHARE = 16     # stalls grow the budget to 1/16 of the physical memory at most
+SNDBUF = {'tcp': 8 * 1024 * 1024, 'ipc': 2 * 1024 * 1024}
+MAX_SNDBUF = 64 * 1024 * 1024
+
+# Stalled sends are retried with back-off for this long per update, then the rest of the update is dropped
+STALL_SLEEP = 0.001
+STALL_MAX_SLEEP = 0.05
+STALL_TIMEOUT = 2.0
+
+
+def max_queue_budget():
+    '''Largest queue budget stalls may grow to, bounded by the physical memory'''
+
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return MAX_QUEUE_BUDGET
+    return min(MAX_QUEUE_BUDGET, max(QUEUE_BUDGET['ipc'], memory // QUEUE_MEMORY_SHARE))
+
+
+def array_bytes(array):
+    '''Flat uint8 view of an array buffer, chunks are byte ranges of it'''
+
+    return np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+
+
+class SocketTuner():
+    '''
+    Tune the chunk size and PUB socket options from stalls on full subscriber queues
+
+    Sends never block, an array that never stalled only measures how fast it was queued. The chunk size
+    is tuned on arrays that waited for the queues to drain: their send rate is the rate of the link.
+    '''
+
+    def __init__(self, protocol="tcp", chunk_size=None):
+        self.protocol = protocol
+        self.autotune = chunk_size is None
+        self.chunk_size = ZMQ_CHUNK_SIZE if chunk_size is None else chunk_size
+        self.queue_budget = QUEUE_BUDGET.get(protocol, QUEUE_BUDGET['tcp'])
+        self.max_queue_budget = max(self.queue_budget, max_queue_budget())
+        self.sndbuf = SNDBUF.get(protocol, SNDBUF['tcp'])
+        self.sockets = []
+
+        self.throughput = {}    # chunk size -> EMA of bytes/s
+        self.home = self.chunk_size     # the neighbours of this size are explored before moving on
+        self.samples = 0
+        self.steps = 0
+
+        self.bytes_sent = 0
+        self.arrays_sent = 0
+        self.stalls = 0
+        self.stalled_time = 0.0
+        self.drops = 0
+        self.last_throughput = 0.0
+
+    @property
+    def sndhwm(self):
+        '''High-water mark in messages, sized so a full queue holds `queue_budget` bytes'''
+
+        chunk_size = self.chunk_size if self.chunk_size > 0 else ZMQ_CHUNK_SIZE
+        # +3 for metadata, START and END messages
+        return max(16, self.queue_budget // chunk_size + 3)
+
+    def configure(self, socket):
+        '''Apply the current options to a socket, must be called before bind'''
+
+        socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+        socket.setsockopt(zmq.SNDBUF, self.sndbuf)
+        if socket.type in (zmq.PUB, zmq.XPUB):
+            # report a full queue as EAGAIN instead of silently dropping, see send()
+            socket.setsockopt(zmq.XPUB_NODROP, 1)
+        if self.protocol == "tcp":
+            socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+            socket.setsockopt(zmq.TCP_KEEPALIVE_IDLE, 60)
+        self.sockets.append(socket)
+
+    def _update_sockets(self):
+        # libzmq applies SNDHWM to existing pipes, SNDBUF only to new connections
+        for socket in self.sockets:
+            socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+            socket.setsockopt(zmq.SNDBUF, self.sndbuf)
+
+    def _set_chunk_size(self, chunk_size):
+        if chunk_size != self.chunk_size:
+            print(f"Tuning: chunk size {self.chunk_size // 1024}KB -> {chunk_size // 1024}KB")
+        self.chunk_size = chunk_size
+        self.samples = 0
+        self._update_sockets()
+
+    def record(self, nbytes, elapsed, stalled=0.0):
+        '''
+        Record a sent array, `stalled` seconds of `elapsed` were spent waiting for full queues to drain
+
+        The chunk size is hill-climbed on the drain rate of the arrays that stalled, the others leave it as it is.
+        '''
+
+        self.bytes_sent += nbytes
+        self.arrays_sent += 1
+        self.stalled_time += stalled
+
+        if elapsed <= 0 or nbytes < MIN_TUNE_BYTES or stalled < MIN_STALLED_SHARE * elapsed:
+            return
+
+        rate = nbytes / elapsed
+        self.last_throughput = rate
+
+        if not self.autotune:
+            return
+
+        size = self.chunk_size
+        old = self.throughput.get(size)
+        self.throughput[size] = rate if old is None else (1.0 - THROUGHPUT_EMA) * old + THROUGHPUT_EMA * rate
+        self.samples += 1
+        if self.samples < SAMPLES_PER_STEP:
+            return
+
+        self.steps += 1
+        home = self.home
+        neighbours = [s for s in (2 * home, home // 2) if MIN_CHUNK_SIZE <= s <= MAX_CHUNK_SIZE]
+
+        # forget neighbours from time to time, the link may have changed
+        if self.steps % REEXPLORE_STEPS == 0:
+            for s in neighbours:
+                self.throughput.pop(s, None)
+
+        for s in neighbours:
+            if s not in self.throughput:
+                self._set_chunk_size(s)
+                return
+
+        best = max([home] + neighbours, key=lambda s: self.throughput.get(s, 0.0))
+        self.home = best
+        self._set_chunk_size(best)
+
+    def on_stall(self):
+        '''A subscriber queue is full, give it more room'''
+
+        self.stalls += 1
+        if self.queue_budget < self.max_queue_budget:
+            self.queue_budget = min(2 * self.queue_budget, self.max_queue_budget)
+            self.sndbuf = min(2 * self.sndbuf, MAX_SNDBUF)
+            self._update_sockets()
+
+    def on_drop(self):
+        self.drops += 1
+
+    def get_stats(self):
+        return {
+            'protocol': self.protocol,
+            'autotune': self.autotune,
+            'chunk_size': self.chunk_size,
+            'sndhwm': self.sndhwm,
+            'sndbuf': self.sndbuf,
+            'throughput_mbps': round(8 * self.last_throughput / 1e6, 1),
+            'bytes_sent': self.bytes_sent,
+            'arrays_sent': self.arrays_sent,
+            'stalls': self.stalls,
+            'stalled_s': round(self.stalled_time, 3),
+            'drops': self.drops,
+        }
+
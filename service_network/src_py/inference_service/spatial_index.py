@@ -0,0 +1,250 @@
+import numpy as np
+
+POINTS_PER_CELL = 16
+MAX_CELLS = 1 << 22         # 32MB of cell offsets
+SIZING_ROUNDS = 3
+KNN_BATCH_ELEMENTS = 1 << 22    # candidate distances held at once by the k-NN search
+KNN_MAX_BOX_CELLS = 15 ** 3    # largest box of cells searched by the vectorized k-NN passes
+
+NEIGHBOUR_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def gather_ranges(starts, counts):
+    '''Concatenate the index ranges [start, start + count) without a Python loop'''
+
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros((0,), dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(total)
+
+
+class UniformGridIndex():
+    '''Uniform grid over a point cloud, point indices are sorted by cell (CSR layout)'''
+
+    def __init__(self, points, points_per_cell=POINTS_PER_CELL):
+        points = np.asarray(points, dtype=np.float32)
+        self.num_points = points.shape[0]
+
+        self.lower = points.min(axis=0).astype(np.float64)
+        self.upper = points.max(axis=0).astype(np.float64)
+        extent = np.maximum(self.upper - self.lower, 1e-6)
+
+        num_cells = max(1, self.num_points // points_per_cell)
+        self.cell_size = float(np.cbrt(np.prod(extent) / num_cells))
+        self.dims = np.maximum(1, np.ceil(extent / self.cell_size)).astype(np.int64)
+        cell_ids = self._cell_ids(points)
+
+        # simulation points cluster around the geometry, so size the cells from the occupancy seen
+        # by an average point rather than by an average cell
+        for _ in range(SIZING_ROUNDS):
+            counts = np.bincount(cell_ids).astype(np.float64)
+            occupancy = float(np.dot(counts, counts)) / max(1, self.num_points)
+            if occupancy <= 2 * points_per_cell:
+                break
+            cell_size = self.cell_size * float(np.cbrt(points_per_cell / occupancy))
+            cell_size = max(cell_size, float(np.cbrt(np.prod(extent) / MAX_CELLS)))
+            if cell_size >= self.cell_size:
+                break
+            self.cell_size = cell_size
+            self.dims = np.maximum(1, np.ceil(extent / self.cell_size)).astype(np.int64)
+            cell_ids = self._cell_ids(points)
+
+        self.order = np.argsort(cell_ids, kind='stable').astype(np.int32)
+        counts = np.bincount(cell_ids, minlength=int(np.prod(self.dims)))
+        self.cell_start = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.sorted_points = points[self.order]
+
+        self._occupied = None
+        self._occupied_lower = None
+
+    def _cell_coords(self, points):
+        ijk = np.floor((points - self.lower) / self.cell_size).astype(np.int64)
+        return np.clip(ijk, 0, self.dims - 1)
+
+    def _cell_ids(self, points):
+        return np.ravel_multi_index(self._cell_coords(points).T, self.dims)
+
+    def _cells_in_range(self, lower_ijk, upper_ijk):
+        '''Flat ids of all cells in an inclusive ijk range'''
+
+        axes = [np.arange(lower_ijk[i], upper_ijk[i] + 1) for i in range(3)]
+        grid = np.meshgrid(*axes, indexing='ij')
+        return np.ravel_multi_index([g.ravel() for g in grid], self.dims), np.stack([g.ravel() for g in grid], axis=1)
+
+    def query_aabb(self, lower, upper):
+        '''Indices (in input order) of the points inside an axis aligned box'''
+
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        if np.any(upper < self.lower) or np.any(lower > self.upper) or np.any(upper < lower):
+            return np.zeros((0,), dtype=np.int64)
+
+        lower_ijk = self._cell_coords(lower[None, :])[0]
+        upper_ijk = self._cell_coords(upper[None, :])[0]
+        cells, ijk = self._cells_in_range(lower_ijk, upper_ijk)
+
+        # cells completely inside the box are taken as they are, the others are tested point by point
+        cell_lower = self.lower + ijk * self.cell_size
+        cell_upper = cell_lower + self.cell_size
+        inside = np.all((cell_lower >= lower) & (cell_upper <= upper), axis=1)
+
+        starts = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - starts
+
+        full = gather_ranges(starts[inside], counts[inside])
+        partial = gather_ranges(starts[~inside], counts[~inside])
+        p = self.sorted_points[partial]
+        partial = partial[np.all((p >= lower) & (p <= upper), axis=1)]
+
+        return np.sort(self.order[np.concatenate([full, partial])])
+
+    def _box_margin(self, queries, cells, radius):
+        '''
+        Distance from each query to the faces of the box of cells within `radius` of its cell
+
+        Faces on the grid boundary do not count, there are no points beyond them. Every point
+        closer to the query than the margin is inside the box.
+        '''
+
+        box_lower = self.lower + (cells - radius) * self.cell_size
+        box_upper = self.lower + (cells + radius + 1) * self.cell_size
+        below = np.where(cells - radius > 0, queries - box_lower, np.inf)
+        above = np.where(cells + radius < self.dims - 1, box_upper - queries, np.inf)
+        return np.minimum(below, above).min(axis=1)
+
+    def _knn_cells(self, queries, radius, limits):
+        '''
+        Cell coordinates of the queries, flat ids and point counts of the cells within `radius`
+
+        Cells farther from a query than its limit (a bound of its k-th distance) are counted empty.
+        '''
+
+        cells = self._cell_coords(queries)
+        offsets = NEIGHBOUR_OFFSETS if radius == 1 else np.stack(
+            np.meshgrid(*[np.arange(-radius, radius + 1)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+        neighbours = cells[:, None, :] + offsets[None, :, :]
+        valid = np.all((neighbours >= 0) & (neighbours < self.dims), axis=2)
+
+        finite = np.isfinite(limits)
+        if np.any(finite):
+            cell_lower = self.lower + neighbours[finite] * self.cell_size
+            gap = np.maximum(np.maximum(cell_lower - queries[finite, None, :], queries[finite, None, :] - cell_lower - self.cell_size), 0.0)
+            valid[finite] &= np.einsum('qcd,qcd->qc', gap, gap) <= limits[finite, None] ** 2
+
+        neighbours = np.clip(neighbours, 0, self.dims - 1).reshape(-1, 3)
+        ids = np.ravel_multi_index(neighbours.T, self.dims).reshape(queries.shape[0], -1)
+        counts = np.where(valid, self.cell_start[ids + 1] - self.cell_start[ids], 0)
+        return cells, ids, counts
+
+    def _knn_box(self, queries, cells, ids, counts, radius, k):
+        '''k nearest points among the cells within `radius` of each query cell, vectorized over the queries'''
+
+        num_queries = queries.shape[0]
+        candidates = gather_ranges(self.cell_start[ids].ravel(), counts.ravel())
+        per_query = counts.sum(axis=1)
+        owner = np.repeat(np.arange(num_queries), per_query)
+        rank = np.arange(candidates.shape[0]) - np.repeat(np.cumsum(per_query) - per_query, per_query)
+
+        # pad the candidate distances to a matrix and partition each row
+        d = np.full((num_queries, max(int(per_query.max(initial=0)), k)), np.inf)
+        d[owner, rank] = np.linalg.norm(self.sorted_points[candidates] - queries[owner], axis=1)
+        c = np.zeros(d.shape, dtype=np.int64)
+        c[owner, rank] = candidates
+
+        nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+        nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(d, nearest, axis=1), axis=1), axis=1)
+        distances = np.take_along_axis(d, nearest, axis=1)
+        indices = self.order[np.take_along_axis(c, nearest, axis=1)]
+
+        found = distances[:, -1] <= self._box_margin(queries, cells, radius)
+        return indices, distances, found
+
+    def _knn_occupied(self, query, k):
+        '''k nearest points of one query, with a lower bound of the distance to every occupied cell'''
+
+        if self._occupied_lower is None:
+            self._occupied = np.flatnonzero(np.diff(self.cell_start))
+            self._occupied_lower = self.lower + np.stack(np.unravel_index(self._occupied, self.dims), axis=1) * self.cell_size
+
+        gap = np.maximum(np.maximum(self._occupied_lower - query, query - self._occupied_lower - self.cell_size), 0.0)
+        bound = np.einsum('cd,cd->c', gap, gap)
+
+        # the k closest cells hold at least k points, they bound the k-th distance
+        closest = np.argpartition(bound, k - 1)[:k] if k < bound.shape[0] else np.arange(bound.shape[0])
+        kth = self._knn_cells_distances(query, self._occupied[closest], k)[1][-1]
+
+        indices, distances = self._knn_cells_distances(query, self._occupied[bound <= kth * kth], k)
+        return self.order[indices], distances
+
+    def _knn_cells_distances(self, query, cells, k):
+        '''k nearest points of one query among the points of some cells, as sorted point and distance'''
+
+        starts = self.cell_start[cells]
+        candidates = gather_ranges(starts, self.cell_start[cells + 1] - starts)
+        d = np.linalg.norm(self.sorted_points[candidates] - query, axis=1)
+        nearest = np.argpartition(d, k - 1)[:k] if k < d.shape[0] else np.arange(d.shape[0])
+        nearest = nearest[np.argsort(d[nearest])]
+        return candidates[nearest], d[nearest]
+
+    def query_knn(self, queries, k=8):
+        '''
+        Indices (in input order) and distances of the k nearest points of each query point
+
+        Queries are answered from the cells around them, vectorized over the queries. The box of
+        cells grows for the queries whose k-th distance is not covered by it, queries far from the
+        points are searched over the occupied cells instead. k is limited to the number of points.
+        '''
+
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        k = max(1, min(int(k), self.num_points))
+        indices = np.zeros((queries.shape[0], k), dtype=np.int64)
+        distances = np.zeros((queries.shape[0], k), dtype=np.float64)
+        max_radius = int(self.dims.max())
+
+        # radius -> (queries, bounds of their k-th distance)
+        pending = {1: (np.arange(queries.shape[0]), np.full((queries.shape[0],), np.inf))}
+        far = []
+        while pending:
+            radius = min(pending)
+            group, limits = pending.pop(radius)
+            step = max(1, KNN_BATCH_ELEMENTS // (8 * (2 * radius + 1) ** 3))
+
+            for start in range(0, group.shape[0], step):
+                part = group[start:start + step]
+                cells, ids, counts = self._knn_cells(queries[part], radius, limits[start:start + step])
+
+                # queries sorted by candidate count pad little, batches are cut to a fixed number of distances
+                row_sizes = np.maximum(counts.sum(axis=1), k)
+                by_count = np.argsort(row_sizes, kind='stable')
+                row_sizes = row_sizes[by_count]
+
+                first = 0
+                while first < by_count.shape[0]:
+                    padded = np.arange(1, by_count.shape[0] - first + 1) * row_sizes[first:]
+                    last = first + max(1, int(np.searchsorted(padded, KNN_BATCH_ELEMENTS, side='right')))
+                    rows = by_count[first:last]
+                    first = last
+
+                    batch = part[rows]
+                    batch_indices, batch_distances, found = self._knn_box(queries[batch], cells[rows], ids[rows], counts[rows], radius, k)
+                    found |= radius >= max_radius
+                    indices[batch[found]] = batch_indices[found]
+                    distances[batch[found]] = batch_distances[found]
+
+                    # the box margin is at least radius cells, a box covering the k-th distance found so far is enough
+                    batch = batch[~found]
+                    kth = batch_distances[~found, -1]
+                    needed = np.where(np.isfinite(kth), np.ceil(np.minimum(kth / self.cell_size, max_radius)), 2 * radius)
+                    needed = np.minimum(np.maximum(needed.astype(np.int64), radius + 1), max_radius)
+                    small = (2 * needed + 1) ** 3 <= KNN_MAX_BOX_CELLS
+                    far.append(batch[~small])
+                    for r in np.unique(needed[small]):
+                        selected = small & (needed == r)
+                        queued = pending.get(int(r), (np.zeros((0,), dtype=np.int64), np.zeros((0,))))
+                        pending[int(r)] = (np.concatenate([queued[0], batch[selected]]), np.concatenate([queued[1], kth[selected]]))
+
+        for q in np.concatenate(far) if far else []:
+            indices[q], distances[q] = self._knn_occupied(queries[q], k)
+
+        return indices, distances
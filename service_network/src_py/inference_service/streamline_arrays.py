@@ -0,0 +1,38 @@
+import json
+import numpy as np
+
+from pathlib import Path
+
+# binary copy of an uploaded streamlines JSON file, written by the upload service (see STREAMLINE_FORMAT.md)
+ARRAYS_SUFFIX = ".arrays"
+ARRAY_NAMES = ['points', 'counts', 'bounds', 'scalars', 'colors']
+
+
+def load_streamline_arrays(json_path):
+    '''
+    Memory map the arrays of an uploaded streamlines file, None if missing or older than the JSON file
+
+    Returns a dict with 'points' float32 (P, 3), 'counts' int32 (L,), 'bounds' float32 (2, 3) and,
+    if any line has them, 'scalars' float32 (P,) and 'colors' float32 (L, 3) (NaN for the other lines).
+    '''
+
+    json_path = Path(json_path)
+    arrays_dir = json_path.with_suffix(ARRAYS_SUFFIX)
+    try:
+        with open(arrays_dir / "meta.json") as f:
+            meta = json.load(f)
+        stat = json_path.stat()
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('source_size') != stat.st_size or meta.get('source_mtime_ns') != stat.st_mtime_ns:
+        print(f"WARNING: Ignoring streamline arrays older than '{json_path}'")
+        return None
+
+    arrays = {}
+    for name in meta.get('arrays', []):
+        if name in ARRAY_NAMES:
+            arrays[name] = np.load(arrays_dir / f"{name}.npy", mmap_mode='r')
+    if 'points' not in arrays or 'counts' not in arrays:
+        return None
+    return arrays
@@ -0,0 +1,78 @@
+import zmq
+import json
+import asyncio
+
+from .socket_tuning import array_bytes
+from .file_inference import SURFACE_FIELDS
+
+
+class SurfaceChannel():
+    '''
+    Surface fields published on an XPUB socket, only while a client is subscribed to them
+
+    Clients subscribe with a SUB socket to a field name (b"surface_pressure", b"" for all of them).
+    Every message is multipart: [field name, metadata JSON, data]. The field of the current design
+    is published when a client subscribes and after every config update while it is subscribed,
+    so unused surface data is never read from disk.
+    '''
+
+    def __init__(self, get_data, tuner):
+        # field_name -> (metadata, array) of the current design, or (None, None), called in a worker thread
+        # as it may extract the surface fields of the design from its data file
+        self.get_data = get_data
+        self.tuner = tuner
+        self.socket = None
+        self.subscribed = set()
+        self.pending = set()
+        self.wakeup = asyncio.Event()
+
+    def bind(self, context, address):
+        self.socket = context.socket(zmq.XPUB)
+        # pass every subscription up, a late joiner gets the current value
+        self.socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.tuner.configure(self.socket)
+        self.socket.bind(address)
+        print(f"Created surface field socket on {address}")
+
+    def update(self):
+        '''The design changed, publish it to the subscribers'''
+
+        self.pending |= self.subscribed
+        self.wakeup.set()
+
+    async def receive_subscriptions(self):
+        while True:
+            message = await self.socket.recv()
+            if len(message) == 0:
+                continue
+
+            topic = message[1:].decode('utf-8', errors='replace')
+            fields = [f for f in SURFACE_FIELDS if f.startswith(topic)]
+            if message[0] == 1:
+                print(f"Surface fields subscribed: {fields}")
+                self.subscribed.update(fields)
+                self.pending.update(fields)
+                self.wakeup.set()
+            elif message[0] == 0:
+                # only the last unsubscription of a topic is passed up
+                self.subscribed.difference_update(fields)
+
+    async def publish(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            while self.pending:
+                field_name = self.pending.pop()
+                metadata, array = await loop.run_in_executor(None, self.get_data, field_name)
+                if array is None:
+                    continue
+
+                print(f"Sending surface field '{field_name}'...")
+                frames = [field_name.encode('utf-8'), json.dumps(metadata).encode('utf-8'), array_bytes(array)]
+                try:
+                    await self.socket.send_multipart(frames, copy=False)
+                except zmq.ZMQError as e:
+                    raise RuntimeError(f"Error sending surface field with ZMQ: {e}")
+                self.tuner.record(frames[-1].nbytes, 0)
@@ -0,0 +1,168 @@
+import numpy as np
+
+BLOCK_DIM = 8                   # cells per block edge, as a NanoVDB leaf node
+BLOCK_CELLS = BLOCK_DIM ** 3
+
+# Kit works in centimeters while the service data is in meters (see 'sdf_bounds')
+STAGE_UNITS_PER_METER = 100.0
+DEFAULT_CELL_SIZE = 1.625       # exts."omni.cgns".cell_size, in stage units
+
+VOXEL_FIELDS = ['voxel_blocks', 'voxel_masks', 'voxel_values']
+
+
+class SparseBlockGrid():
+    '''
+    Sparse grid of BLOCK_DIM^3 blocks holding the mean of the point values falling into each cell
+
+    The grid is published as three fields:
+        voxel_blocks: int32 (B, 3), origin of each block in cell units
+        voxel_masks:  uint64 (B, 8), occupancy bit mask of each block, bit (i * 64 + j * 8 + k)
+        voxel_values: float32 (M, C), values of the occupied cells ordered by block and bit
+    '''
+
+    def __init__(self, points, values, cell_size):
+        self.cell_size = float(cell_size)
+        values = np.asarray(values, dtype=np.float64).reshape(points.shape[0], -1)
+
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        blocks = cells // BLOCK_DIM
+        local = cells - blocks * BLOCK_DIM
+        bits = (local[:, 0] * BLOCK_DIM + local[:, 1]) * BLOCK_DIM + local[:, 2]
+
+        self.block_min = blocks.min(axis=0)
+        self.block_dims = blocks.max(axis=0) - self.block_min + 1
+        block_keys = np.ravel_multi_index((blocks - self.block_min).T, self.block_dims)
+
+        # unique cells sorted by block and bit, the mean of each cell by weighted bincount
+        cell_keys, inverse = np.unique(block_keys * BLOCK_CELLS + bits, return_inverse=True)
+        counts = np.bincount(inverse)
+        sums = np.stack([np.bincount(inverse, weights=values[:, c], minlength=cell_keys.shape[0])
+                         for c in range(values.shape[1])], axis=1)
+        self.values = (sums / counts[:, None]).astype(np.float32)
+        self.counts = counts.astype(np.int32)
+
+        cell_block_keys = cell_keys // BLOCK_CELLS
+        cell_bits = (cell_keys % BLOCK_CELLS).astype(np.uint64)
+        unique_block_keys, block_slots = np.unique(cell_block_keys, return_inverse=True)
+        block_coords = np.stack(np.unravel_index(unique_block_keys, self.block_dims), axis=1) + self.block_min
+        self.blocks = (block_coords * BLOCK_DIM).astype(np.int32)
+        self.block_slot_keys = unique_block_keys
+
+        # OR the bits of each (block, word), the keys are sorted so reduceat works on runs
+        word_keys = block_slots * (BLOCK_CELLS // 64) + (cell_bits // 64).astype(np.int64)
+        bit_values = np.left_shift(np.uint64(1), cell_bits % np.uint64(64))
+        run_starts = np.flatnonzero(np.diff(word_keys, prepend=-1))
+        masks = np.zeros((self.blocks.shape[0] * (BLOCK_CELLS // 64),), dtype=np.uint64)
+        masks[word_keys[run_starts]] = np.bitwise_or.reduceat(bit_values, run_starts)
+        self.masks = masks.reshape(-1, BLOCK_CELLS // 64)
+
+        self._block_lookup = None
+        self._cell_lookup = None
+        self._cells = None
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes + self.masks.nbytes + self.values.nbytes
+
+    def get_field(self, field_name):
+        return {
+            'voxel_blocks': self.blocks,
+            'voxel_masks': self.masks,
+            'voxel_values': self.values,
+        }.get(field_name)
+
+    def _build_lookup(self):
+        # dense block table over the block range, and cell -> value index per block
+        self._block_lookup = np.full((int(np.prod(self.block_dims)),), -1, dtype=np.int32)
+        self._block_lookup[self.block_slot_keys] = np.arange(self.blocks.shape[0], dtype=np.int32)
+
+        occupied = np.unpackbits(self.masks.astype('<u8').view(np.uint8), axis=1, bitorder='little').astype(bool)
+        self._cell_lookup = np.full(occupied.shape, -1, dtype=np.int32)
+        self._cell_lookup[occupied] = np.arange(self.values.shape[0], dtype=np.int32)
+
+    @property
+    def cells(self):
+        '''Integer coordinates of the occupied cells, in the order of the values'''
+
+        if self._cells is None:
+            occupied = np.unpackbits(self.masks.astype('<u8').view(np.uint8), axis=1, bitorder='little')
+            slots, bits = np.nonzero(occupied)
+            local = np.stack([bits // (BLOCK_DIM * BLOCK_DIM), (bits // BLOCK_DIM) % BLOCK_DIM, bits % BLOCK_DIM], axis=1)
+            self._cells = self.blocks[slots].astype(np.int64) + local
+        return self._cells
+
+    def gradient(self, values=None, positions=None):
+        '''
+        Gradient of the cell values (M, C, 3), by least squares over the 6 face neighbours
+
+        `positions` (M, 3) are where the cell values were sampled (for example the mean point of each
+        cell), the cell centers by default, which gives central differences. One-sided differences
+        are used next to empty cells, directions without an occupied neighbour get a zero gradient.
+        '''
+
+        values = self.values if values is None else values
+        values = values.astype(np.float64).reshape(values.shape[0], -1)
+        if positions is None:
+            positions = (self.cells + 0.5) * self.cell_size
+        positions = positions.astype(np.float64)
+
+        # normal equations, dv = G dx over the neighbours
+        normal = np.zeros((values.shape[0], 3, 3), dtype=np.float64)
+        moments = np.zeros((values.shape[0], values.shape[1], 3), dtype=np.float64)
+        for offset in np.concatenate([np.eye(3, dtype=np.int64), -np.eye(3, dtype=np.int64)]):
+            neighbours = self.lookup(self.cells + offset)
+            present = (neighbours >= 0)[:, None]
+            neighbours = np.maximum(neighbours, 0)
+            dx = np.where(present, positions[neighbours] - positions, 0.0)
+            dv = np.where(present, values[neighbours] - values, 0.0)
+            normal += dx[:, :, None] * dx[:, None, :]
+            moments += dv[:, :, None] * dx[:, None, :]
+
+        normal += 1e-6 * self.cell_size ** 2 * np.eye(3)
+        return np.linalg.solve(normal, moments.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+    def lookup(self, cells):
+        '''Value indices of integer cell coordinates, -1 for empty cells'''
+
+        if self._block_lookup is None:
+            self._build_lookup()
+
+        blocks = cells // BLOCK_DIM - self.block_min
+        inside = np.all((blocks >= 0) & (blocks < self.block_dims), axis=1)
+        indices = np.full((cells.shape[0],), -1, dtype=np.int32)
+
+        blocks = blocks[inside]
+        local = cells[inside] % BLOCK_DIM
+        slots = self._block_lookup[np.ravel_multi_index(blocks.T, self.block_dims)]
+        bits = (local[:, 0] * BLOCK_DIM + local[:, 1]) * BLOCK_DIM + local[:, 2]
+        found = np.where(slots >= 0, self._cell_lookup[np.maximum(slots, 0), bits], -1)
+        indices[inside] = found
+        return indices
+
+    def sample(self, points, values=None):
+        '''
+        Trilinear interpolation of the cell values at points, empty cells are left out of the weights
+
+        `values` (M, C) are sampled instead of the grid values, for quantities derived from them.
+        Returns the values (N, C) and a mask of points with at least one occupied neighbour cell.
+        '''
+
+        values = self.values if values is None else values.reshape(values.shape[0], -1)
+        g = np.asarray(points, dtype=np.float64) / self.cell_size - 0.5
+        base = np.floor(g).astype(np.int64)
+        frac = g - base
+
+        result = np.zeros((g.shape[0], values.shape[1]), dtype=np.float64)
+        weights = np.zeros((g.shape[0],), dtype=np.float64)
+        for corner in range(8):
+            offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            w = np.prod(np.where(offset, frac, 1.0 - frac), axis=1)
+            indices = self.lookup(base + offset)
+            present = indices >= 0
+            w = np.where(present, w, 0.0)
+            result += w[:, None] * values[np.maximum(indices, 0)]
+            weights += w
+
+        valid = weights > 0
+        result[valid] /= weights[valid, None]
+        return result.astype(np.float32), valid
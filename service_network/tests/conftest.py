@@ -0,0 +1,73 @@
+import asyncio
+import json
+import threading
+
+import numpy as np
+import pytest
+import zmq
+
+from inference_service import ServiceZMQ
+
+NUM_DESIGNS = 3
+NUM_POINTS = 500
+CONFIG_PORT = 5600
+REPLY_TIMEOUT_MS = 30000
+
+
+@pytest.fixture(scope="session")
+def dataset(tmp_path_factory):
+    '''Directory of small random designs design_1.npz .. design_3.npz'''
+
+    directory = tmp_path_factory.mktemp("dataset")
+    rng = np.random.default_rng(0)
+    for i in range(1, NUM_DESIGNS + 1):
+        np.savez(directory / f"design_{i}.npz",
+                 coordinates=rng.random((NUM_POINTS, 3), dtype=np.float32),
+                 velocity=rng.random((NUM_POINTS, 3), dtype=np.float32),
+                 pressure=rng.random((NUM_POINTS,), dtype=np.float32))
+    return directory
+
+
+@pytest.fixture(scope="session")
+def service(dataset, tmp_path_factory):
+    '''A ServiceZMQ serving the dataset on ipc sockets, run in a background thread'''
+
+    files = {'filepath': str(dataset / "design_%d.npz"), 'from': 1, 'to': NUM_DESIGNS}
+    service = ServiceZMQ(files=files, field_names=['coordinates', 'velocity', 'pressure'])
+    zmq_dir = tmp_path_factory.mktemp("zmq")
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(service.run(CONFIG_PORT, zmq_dir=str(zmq_dir)))
+
+    def serve():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    service.address = f"ipc://{zmq_dir}/{CONFIG_PORT}"
+    yield service
+
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(timeout=10)
+
+
+@pytest.fixture
+def request_service(service):
+    '''Send a request (a dict, or raw bytes) to the config port, returns the reply frames'''
+
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.RCVTIMEO, REPLY_TIMEOUT_MS)
+    socket.connect(service.address)
+
+    def send(message):
+        socket.send(message if isinstance(message, bytes) else json.dumps(message).encode('utf-8'))
+        return socket.recv_multipart()
+
+    yield send
+    socket.close()
@@ -0,0 +1,44 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inference_service.service import Service
+
+
+def test_cache_entry_computed_once():
+    service = Service(field_names=['coordinates'])
+    cache = {}
+    calls = []
+
+    def compute():
+        calls.append(threading.get_ident())
+        time.sleep(0.05)
+        return len(calls)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        values = list(pool.map(lambda _: service._get_cached(cache, 'entry', compute), range(16)))
+
+    assert len(calls) == 1
+    assert values == [1] * 16
+    assert cache['entry'] == 1
+
+
+def test_failed_computation_is_retried():
+    service = Service(field_names=['coordinates'])
+    cache = {}
+
+    def fail():
+        raise RuntimeError("failed")
+
+    try:
+        service._get_cached(cache, 'entry', fail)
+    except RuntimeError:
+        pass
+    assert 'entry' not in cache
+    assert service._get_cached(cache, 'entry', lambda: 2) == 2
+
+
+def test_query_of_designs_out_of_range(service):
+    for design_id in [0, 4, -1, "abc", None]:
+        assert service._query_file_index({'id': design_id}) is None
+    assert service._query_file_index({'id': "2"}) == 2
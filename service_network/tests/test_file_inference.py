@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+
+from inference_service.file_inference import FileInference
+
+
+def touch_later(path):
+    '''Move the modification time of a rewritten file past the previous one'''
+
+    mtime = os.path.getmtime(path) + 1
+    os.utime(path, (mtime, mtime))
+
+
+def test_sidecar_of_a_field_added_later(tmp_path):
+    path = tmp_path / "design.npz"
+    np.savez(path, surface_coordinates=np.zeros((4, 3)))
+    file_inference = FileInference(str(path))
+
+    assert file_inference.load_sidecar('surface_coordinates').shape == (4, 3)
+    assert file_inference.load_sidecar('surface_pressure') is None
+
+    np.savez(path, surface_coordinates=np.zeros((4, 3)), surface_pressure=np.ones(4))
+    touch_later(path)
+    assert np.array_equal(file_inference.load_sidecar('surface_pressure'), np.ones(4))
+
+
+def test_sidecar_of_a_removed_field(tmp_path):
+    path = tmp_path / "design.npz"
+    np.savez(path, surface_coordinates=np.zeros((4, 3)), surface_pressure=np.ones(4))
+    file_inference = FileInference(str(path))
+    assert file_inference.load_sidecar('surface_pressure') is not None
+
+    np.savez(path, surface_coordinates=np.zeros((4, 3)))
+    touch_later(path)
+    assert file_inference.load_sidecar('surface_pressure') is None
+    assert not file_inference.get_sidecar_path('surface_pressure').exists()
+
+
+def test_load_data_resets_missing_sidecars(tmp_path):
+    path = tmp_path / "design.npz"
+    np.savez(path, surface_coordinates=np.zeros((4, 3)))
+    file_inference = FileInference(str(path))
+    file_inference.load_sidecar('surface_pressure')
+    assert file_inference.missing_sidecars
+
+    file_inference.load_data()
+    assert not file_inference.missing_sidecars
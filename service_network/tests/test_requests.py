@@ -0,0 +1,70 @@
+import json
+
+import numpy as np
+
+from conftest import NUM_POINTS
+
+
+def reply_json(frames):
+    return json.loads(frames[0])
+
+
+def test_malformed_request_is_answered(request_service):
+    assert reply_json(request_service(b"not json")) == {'error': "Request must be a JSON object"}
+    assert reply_json(request_service([1, 2])) == {'error': "Request must be a JSON object"}
+    # the service keeps serving
+    assert 'sockets' in reply_json(request_service({'request_type': 'stats'}))
+
+
+def test_unknown_request_type(request_service):
+    assert reply_json(request_service({'request_type': 'nope', 'id': 1})) == {'error': "Unknown request_type 'nope'"}
+
+
+def test_config_request_validation(request_service):
+    assert reply_json(request_service({'timestamp': 1})) == {'error': "Config request needs an 'id'"}
+    assert 'error' in reply_json(request_service({'id': "abc", 'timestamp': 1}))
+    assert 'error' in reply_json(request_service({'id': True, 'timestamp': 1}))
+    assert reply_json(request_service({'id': 1})) == {'error': "Config request needs a numeric 'timestamp'"}
+
+
+def test_connect_request(request_service):
+    assert request_service({'id': -1}) == [b"0"]
+
+
+def test_probe(request_service):
+    reply = reply_json(request_service({'request_type': 'probe', 'id': 2, 'points': [[0.5, 0.5, 0.5]]}))
+    assert reply['id'] == 2
+    assert len(reply['distance']) == 1
+    assert np.shape(reply['velocity']) == (1, 3)
+    assert np.shape(reply['pressure']) == (1,)
+
+
+def test_probe_out_of_range(request_service):
+    # ids outside the dataset are not clamped to the nearest design
+    for design_id in [0, 4, 99, "abc"]:
+        reply = reply_json(request_service({'request_type': 'probe', 'id': design_id, 'points': [[0, 0, 0]]}))
+        assert reply == {'error': f"Design '{design_id}' is not available"}
+
+
+def test_slice_out_of_range(request_service):
+    frames = request_service({'request_type': 'slice', 'id': 99, 'axis': 'x', 'resolution': [8, 8]})
+    assert frames == [json.dumps({'error': "Design '99' is not available"}).encode('utf-8')]
+
+
+def test_slice(request_service):
+    frames = request_service({'request_type': 'slice', 'id': 1, 'axis': 'z', 'resolution': [8, 4]})
+    header = reply_json(frames)
+    assert header['resolution'] == [8, 4]
+    assert len(frames) == 3
+
+
+def test_batch_out_of_range(request_service):
+    frames = request_service({'request_type': 'batch', 'items': [[1, 30, 1], [99, 30, 1], [3, 30, 1]],
+                              'fields': ['pressure']})
+    header = reply_json(frames)
+    assert [item['loaded'] for item in header['items']] == [True, False, True]
+
+    field, = header['fields']
+    assert field['field_name'] == 'pressure'
+    assert field['offsets'] == [0, NUM_POINTS, NUM_POINTS, 2 * NUM_POINTS]
+    assert len(frames[1]) == 2 * NUM_POINTS * 4
@@ -0,0 +1,42 @@
+from inference_service.socket_tuning import SocketTuner, MAX_QUEUE_BUDGET, MIN_CHUNK_SIZE, ZMQ_CHUNK_SIZE
+
+ARRAY_BYTES = 16 * 1024 * 1024
+
+
+def link_rate(chunk_size):
+    '''Bytes/s of a simulated link, fastest with 512KB chunks'''
+
+    best = 512 * 1024
+    return 100e6 / (1 + abs(chunk_size.bit_length() - best.bit_length()))
+
+
+def test_unstalled_arrays_keep_the_chunk_size():
+    tuner = SocketTuner()
+    for _ in range(50):
+        # queued at once, larger chunks queue faster but say nothing about the link
+        tuner.record(ARRAY_BYTES, 1e-4 * ARRAY_BYTES / tuner.chunk_size)
+    assert tuner.chunk_size == ZMQ_CHUNK_SIZE
+
+
+def test_stalled_arrays_tune_to_the_link():
+    tuner = SocketTuner()
+    for _ in range(60):
+        elapsed = ARRAY_BYTES / link_rate(tuner.chunk_size)
+        tuner.record(ARRAY_BYTES, elapsed, 0.9 * elapsed)
+    assert tuner.home == 512 * 1024
+    assert MIN_CHUNK_SIZE <= tuner.chunk_size <= 1024 * 1024
+
+
+def test_fixed_chunk_size():
+    tuner = SocketTuner(chunk_size=ZMQ_CHUNK_SIZE // 2)
+    for _ in range(20):
+        tuner.record(ARRAY_BYTES, 0.1, 0.1)
+    assert tuner.chunk_size == ZMQ_CHUNK_SIZE // 2
+
+
+def test_stalls_bound_the_queue_budget():
+    tuner = SocketTuner()
+    for _ in range(40):
+        tuner.on_stall()
+    assert tuner.stalls == 40
+    assert tuner.queue_budget == tuner.max_queue_budget <= MAX_QUEUE_BUDGET
@@ -5,14 +5,28 @@ Handles uploads of STL files and JSON streamline data
 """
 import os
 import json
-import shutil
+from functools import partial
 from pathlib import Path
 from typing import Optional
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
 import uvicorn
 
+from chunked_uploads import UploadStore, copy_and_hash, CHUNK_SIZE, WRITE_BUFFER_SIZE
+from streamline_arrays import convert_streamlines, remove_streamline_arrays
+from file_index import FileIndex, SORT_COLUMNS
+from content_store import ContentStore
+from mesh_arrays import remove_mesh_arrays, get_mesh_dir, read_mesh_meta
+from streamline_arrays import get_arrays_dir, read_streamline_meta
+from downloads import file_response, get_etag
+from jobs import JobQueue
+from processing import plan_processing
+from quota import StorageQuota
+from prewarm import PrewarmNotifier
+
 app = FastAPI(title="Digital Twin Upload Service")
 
 # Enable CORS for web app access
@@ -27,11 +41,72 @@ app.add_middleware(
 UPLOAD_DIR = Path("/app/uploaded_files")
 STL_DIR = UPLOAD_DIR / "stl"
 STREAMLINES_DIR = UPLOAD_DIR / "streamlines"
+PARTIAL_DIR = UPLOAD_DIR / ".partial"
+OBJECTS_DIR = UPLOAD_DIR / ".objects"
+PREWARM_DIR = UPLOAD_DIR / ".prewarm"
 
 # Ensure directories exist
 STL_DIR.mkdir(parents=True, exist_ok=True)
 STREAMLINES_DIR.mkdir(parents=True, exist_ok=True)
 
+# Unfinished chunked uploads
+uploads = UploadStore(PARTIAL_DIR)
+UPLOAD_KINDS = {"stl": (STL_DIR, ".stl"), "streamlines": (STREAMLINES_DIR, ".json")}
+
+# Uploaded files stored once per content, the names are aliases of the stored objects
+content_store = ContentStore(OBJECTS_DIR, UPLOAD_KINDS)
+
+# Background processing of the uploads into what the loaders need, see processing.py
+jobs = JobQueue()
+
+# Tells the inference service about new uploads, it parses and caches them before their first load
+prewarm = PrewarmNotifier(PREWARM_DIR)
+
+# Metadata of the uploaded files, for the listing
+file_index = FileIndex(UPLOAD_DIR / ".index.sqlite", UPLOAD_KINDS)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def remove_upload(kind: str, filename: str):
+    """Delete an uploaded file, the link to its artifacts, its alias and its index row"""
+    directory, _ = UPLOAD_KINDS[kind]
+    file_path = directory / filename
+    file_path.unlink(missing_ok=True)
+    if kind == "stl":
+        remove_mesh_arrays(file_path)
+    else:
+        remove_streamline_arrays(file_path)
+    content_store.release(kind, filename)
+    file_index.remove(kind, filename)
+
+
+# Storage quota (UPLOAD_QUOTA_BYTES), least recently accessed artifacts then uploads are evicted
+quota = StorageQuota(content_store, file_index, {"stl": get_mesh_dir, "streamlines": get_arrays_dir}, remove_upload)
+
+
+def plan_upload(kind: str, file_path: Path):
+    """
+    Processing plan of an upload, followed by the quota check while a quota is set
+
+    The inference service is notified last, once the artifacts it loads are ready and were not evicted.
+    """
+    # the link of the artifacts changes the upload directory, the index records it instead of rescanning
+    plan = plan_processing(content_store, kind, file_path, partial(file_index.changed, kind))
+
+    def enforce_quota(context):
+        busy = {job.sha256 for job in jobs.list() if job.finished is None}
+        context["evicted"] = quota.enforce(busy)
+
+    def notify(context):
+        prewarm.notify(kind, file_path.name)
+
+    def stages(job):
+        quota_stage = [("quota", enforce_quota)] if quota.quota_bytes > 0 else []
+        return plan(job) + quota_stage + [("prewarm", notify)]
+
+    return stages
+
 
 @app.get("/")
 async def root():
@@ -41,7 +116,12 @@ async def root():
         "endpoints": {
             "upload_stl": "/upload/stl",
             "upload_streamlines": "/upload/streamlines",
+            "chunked_upload": "/uploads",
+            "jobs": "/jobs",
             "list_files": "/files",
+            "download": "/files/{kind}/{filename}",
+            "artifacts": "/files/{kind}/{filename}/artifacts",
+            "usage": "/usage",
             "health": "/health"
         }
     }
@@ -76,9 +156,10 @@ async def upload_stl(file: UploadFile = File(...), name: Optional[str] = Form(No
     file_path = STL_DIR / filename
 
     try:
-        # Save uploaded file
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Save uploaded file, off the event loop
+        result = await run_in_threadpool(copy_and_hash, file.file, file_path, None, partial(content_store.commit, "stl"))
+        await run_in_threadpool(file_index.add, "stl", file_path, result["sha256"])
+        job = jobs.submit("stl", filename, result["sha256"], plan_upload("stl", file_path))
 
         file_size = file_path.stat().st_size
 
@@ -87,6 +168,9 @@ async def upload_stl(file: UploadFile = File(...), name: Optional[str] = Form(No
             "filename": filename,
             "path": str(file_path),
             "size_bytes": file_size,
+            "sha256": result["sha256"],
+            "deduplicated": result["deduplicated"],
+            "job_id": job.job_id,
             "message": f"STL file '{filename}' uploaded successfully"
         })
 
@@ -135,125 +219,405 @@ async def upload_streamlines(file: UploadFile = File(...), name: Optional[str] =
     file_path = STREAMLINES_DIR / filename
 
     try:
-        # Read and validate JSON
-        content = await file.read()
-        data = json.loads(content)
-
-        # Validate structure
-        if "streamlines" not in data:
-            raise HTTPException(
-                status_code=400,
-                detail="JSON must contain 'streamlines' array"
-            )
-
-        streamlines = data["streamlines"]
-        if not isinstance(streamlines, list):
-            raise HTTPException(
-                status_code=400,
-                detail="'streamlines' must be an array"
-            )
+        # Save and validate JSON, off the event loop
+        result = await run_in_threadpool(copy_and_hash, file.file, file_path, validate_streamlines,
+                                         partial(content_store.commit, "streamlines"))
+        num_streamlines = result["num_streamlines"]
 
-        # Validate each streamline
-        for i, streamline in enumerate(streamlines):
-            if "path" not in streamline:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Streamline {i} missing 'path' field"
-                )
-
-            path = streamline["path"]
-            if not isinstance(path, list) or len(path) == 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Streamline {i} 'path' must be a non-empty array"
-                )
-
-            # Check first point is [x, y, z]
-            if len(path[0]) != 3:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Streamline {i} path points must be [x, y, z] arrays"
-                )
-
-        # Save validated JSON
-        with file_path.open("w") as f:
-            json.dump(data, f, indent=2)
+        # binary copy for the loaders, they skip parsing the JSON
+        await run_in_threadpool(content_store.link_streamline_arrays, file_path, result["sha256"], result.pop("arrays", None))
+        await run_in_threadpool(file_index.add, "streamlines", file_path, result["sha256"])
+        job = jobs.submit("streamlines", filename, result["sha256"], plan_upload("streamlines", file_path))
 
         file_size = file_path.stat().st_size
-        num_streamlines = len(streamlines)
 
         return JSONResponse(content={
             "success": True,
             "filename": filename,
             "path": str(file_path),
             "size_bytes": file_size,
+            "sha256": result["sha256"],
+            "deduplicated": result["deduplicated"],
+            "job_id": job.job_id,
             "num_streamlines": num_streamlines,
             "message": f"Streamlines file '{filename}' uploaded successfully with {num_streamlines} streamlines"
         })
 
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload file: {str(e)}")
 
 
+def validate_streamlines(file_path: Path, sha256: Optional[str] = None) -> dict:
+    """
+    Check the structure of a streamlines JSON file
+
+    Args:
+        file_path: Path of the JSON file
+        sha256: Optional digest of the file, content already stored is not parsed again
+
+    Returns:
+        Dictionary with the number of streamlines and their columnar arrays (left out for stored content),
+        raises HTTPException for an invalid file
+    """
+    meta = content_store.get_streamline_meta(sha256) if sha256 else None
+    if meta is not None:
+        return {"num_streamlines": meta["num_streamlines"]}
+
+    try:
+        with file_path.open() as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
+
+    # Validate structure
+    if not isinstance(data, dict) or "streamlines" not in data:
+        raise HTTPException(
+            status_code=400,
+            detail="JSON must contain 'streamlines' array"
+        )
+
+    streamlines = data["streamlines"]
+    if not isinstance(streamlines, list):
+        raise HTTPException(
+            status_code=400,
+            detail="'streamlines' must be an array"
+        )
+
+    # Validate each streamline
+    for i, streamline in enumerate(streamlines):
+        if "path" not in streamline:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Streamline {i} missing 'path' field"
+            )
+
+        path = streamline["path"]
+        if not isinstance(path, list) or len(path) == 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Streamline {i} 'path' must be a non-empty array"
+            )
+
+        # Check first point is [x, y, z]
+        if len(path[0]) != 3:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Streamline {i} path points must be [x, y, z] arrays"
+            )
+
+    try:
+        arrays = convert_streamlines(data)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Streamline path points must be [x, y, z] arrays: {str(e)}")
+
+    return {"num_streamlines": len(streamlines), "arrays": arrays}
+
+
+class UploadInit(BaseModel):
+    kind: str                       # "stl" or "streamlines"
+    filename: str
+    size: int
+    sha256: Optional[str] = None    # checked on finalize if set
+    upload_id: Optional[str] = None     # unfinished upload to resume
+
+
+@app.post("/uploads")
+async def init_upload(init: UploadInit):
+    """
+    Start a chunked upload, or resume an unfinished upload given by its id or by the sha256 of the file
+
+    Send the chunks with PUT /uploads/{upload_id}?offset=<offset> (raw bytes in the body),
+    starting at the returned offset, then POST /uploads/{upload_id}/finalize.
+
+    Args:
+        init: Kind, final file name and size in bytes, optional sha256 of the file and id of the upload to resume
+
+    Returns:
+        JSON with the upload id, the offset to continue from and the suggested chunk size
+    """
+    if init.kind not in UPLOAD_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown upload kind '{init.kind}', expected one of {list(UPLOAD_KINDS)}")
+    if init.size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+
+    _, extension = UPLOAD_KINDS[init.kind]
+    filename = Path(init.filename).name
+    if not filename.lower().endswith(extension):
+        filename += extension
+
+    upload = uploads.create(init.kind, filename, init.size, init.sha256, init.upload_id)
+    return dict(upload.to_dict(), chunk_size=CHUNK_SIZE)
+
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """State of a chunked upload, `offset` is where the next chunk starts"""
+    return uploads.get(upload_id).to_dict()
+
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int = Query(...)):
+    """
+    Append a chunk to an upload, the body is streamed to disk
+
+    Args:
+        upload_id: Id returned by POST /uploads
+        offset: Byte offset of the chunk, must be the current offset of the upload
+
+    Returns:
+        JSON with the new offset, 409 with the current offset if the chunk does not continue the upload
+    """
+    upload = uploads.get(upload_id)
+
+    async with upload.lock:
+        if offset != upload.offset:
+            return JSONResponse(status_code=409, content={
+                "detail": f"Chunk offset {offset} does not match the upload offset {upload.offset}",
+                "offset": upload.offset
+            })
+
+        # bounded buffer, disk writes in a worker thread
+        buffer = bytearray()
+        try:
+            async for data in request.stream():
+                buffer += data
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    await run_in_threadpool(uploads.write, upload, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await run_in_threadpool(uploads.write, upload, bytes(buffer))
+        finally:
+            # an interrupted chunk resumes from the bytes written
+            await run_in_threadpool(uploads.save, upload)
+
+    return {"upload_id": upload_id, "offset": upload.offset, "size": upload.size}
+
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str):
+    """
+    Check a complete upload and move it to the uploaded files
+
+    Returns:
+        JSON with the file path, size and sha256 (and the number of streamlines)
+    """
+    upload = uploads.get(upload_id)
+
+    async with upload.lock:
+        directory, _ = UPLOAD_KINDS[upload.kind]
+        file_path = directory / upload.filename
+        validate = validate_streamlines if upload.kind == "streamlines" else None
+
+        result = await run_in_threadpool(uploads.finalize, upload, file_path, validate,
+                                         partial(content_store.commit, upload.kind))
+        if upload.kind == "streamlines":
+            await run_in_threadpool(content_store.link_streamline_arrays, file_path, result["sha256"], result.pop("arrays", None))
+        await run_in_threadpool(file_index.add, upload.kind, file_path, result["sha256"])
+        job = jobs.submit(upload.kind, upload.filename, result["sha256"], plan_upload(upload.kind, file_path))
+
+    return JSONResponse(content=dict(result, **{
+        "success": True,
+        "job_id": job.job_id,
+        "filename": upload.filename,
+        "path": str(file_path),
+        "size_bytes": upload.size,
+        "message": f"File '{upload.filename}' uploaded successfully"
+    }))
+
+
+@app.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str):
+    """Abort a chunked upload and remove its partial file"""
+    upload = uploads.get(upload_id)
+    async with upload.lock:
+        await run_in_threadpool(uploads.abort, upload)
+    return {"success": True, "message": f"Aborted upload '{upload_id}'"}
+
+
+@app.get("/jobs")
+async def list_jobs(status: Optional[str] = Query(None, description="Only list 'queued', 'running', 'done' or 'failed' jobs")):
+    """Processing jobs of the uploads, oldest first"""
+    return {"jobs": [job.to_dict() for job in jobs.list(status)]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    State of the processing job of an upload
+
+    Returns:
+        JSON with the status ('queued', 'running', 'done' or 'failed'), the current stage,
+        the progress from 0 to 1 and, once done, the result of the processing
+    """
+    return jobs.get(job_id).to_dict()
+
+
 @app.get("/files")
-async def list_files():
+async def list_files(
+    kind: Optional[str] = Query(None, description="Only list 'stl' or 'streamlines' files"),
+    q: Optional[str] = Query(None, description="Substring of the file names"),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    sort: str = Query("name", description="Sort by 'name', 'mtime', 'size' or 'accessed'"),
+    descending: bool = Query(False)
+):
     """
-    List all uploaded files
+    List uploaded files, one page per kind
+
+    The files are listed from the metadata index, the totals count all files matching the filter.
 
     Returns:
         JSON with lists of STL and streamline files
     """
+    if kind is not None and kind not in UPLOAD_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind '{kind}', expected one of {list(UPLOAD_KINDS)}")
+    if sort not in SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort '{sort}', expected one of {list(SORT_COLUMNS)}")
+
     try:
+        pages = {}
+        for file_kind in UPLOAD_KINDS:
+            if kind is None or kind == file_kind:
+                pages[file_kind] = await run_in_threadpool(file_index.query, file_kind, q, offset, limit, sort, descending)
+            else:
+                pages[file_kind] = ([], 0)
+
+        stl_rows, total_stl = pages["stl"]
         stl_files = [
             {
-                "name": f.name,
-                "path": str(f),
-                "size_bytes": f.stat().st_size
+                "name": row["name"],
+                "path": row["path"],
+                "size_bytes": row["size_bytes"],
+                "modified": row["mtime_ns"] / 1e9,
+                "accessed": row["accessed"],
+                "sha256": row["sha256"]
             }
-            for f in STL_DIR.glob("*.stl")
+            for row in stl_rows
         ]
 
-        streamline_files = []
-        for f in STREAMLINES_DIR.glob("*.json"):
-            try:
-                with f.open() as json_file:
-                    data = json.load(json_file)
-                    num_streamlines = len(data.get("streamlines", []))
-            except:
-                num_streamlines = 0
-
-            streamline_files.append({
-                "name": f.name,
-                "path": str(f),
-                "size_bytes": f.stat().st_size,
-                "num_streamlines": num_streamlines
-            })
+        streamline_rows, total_streamlines = pages["streamlines"]
+        streamline_files = [
+            {
+                "name": row["name"],
+                "path": row["path"],
+                "size_bytes": row["size_bytes"],
+                "modified": row["mtime_ns"] / 1e9,
+                "accessed": row["accessed"],
+                "sha256": row["sha256"],
+                "num_streamlines": row["num_streamlines"],
+                "num_points": row["num_points"],
+                "bounds": json.loads(row["bounds"]) if row["bounds"] else None
+            }
+            for row in streamline_rows
+        ]
 
         return {
             "stl_files": stl_files,
             "streamline_files": streamline_files,
-            "total_stl": len(stl_files),
-            "total_streamlines": len(streamline_files)
+            "total_stl": total_stl,
+            "total_streamlines": total_streamlines,
+            "offset": offset,
+            "limit": limit
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list files: {str(e)}")
 
 
+# directory of the derived artifacts of a file and the check that they match it, per kind
+ARTIFACTS = {"stl": (get_mesh_dir, read_mesh_meta), "streamlines": (get_arrays_dir, read_streamline_meta)}
+
+
+def get_uploaded_path(kind: str, filename: str) -> Path:
+    """Path of an uploaded file, 404 for an unknown kind or file"""
+    if kind not in UPLOAD_KINDS:
+        raise HTTPException(status_code=404, detail=f"Unknown kind '{kind}', expected one of {list(UPLOAD_KINDS)}")
+    directory, extension = UPLOAD_KINDS[kind]
+    if Path(filename).name != filename or filename.startswith(".") or not filename.lower().endswith(extension):
+        raise HTTPException(status_code=404, detail=f"File '{filename}' not found")
+    file_path = directory / filename
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail=f"File '{filename}' not found")
+    return file_path
+
+
+def get_artifacts_dir(kind: str, file_path: Path) -> Path:
+    """Directory of the artifacts of an uploaded file, 404 while they are missing or older than the file"""
+    get_dir, read_meta = ARTIFACTS[kind]
+    if read_meta(file_path) is None:
+        raise HTTPException(status_code=404, detail=f"No artifacts of '{file_path.name}', see its processing job")
+    return get_dir(file_path)
+
+
+@app.api_route("/files/{kind}/{filename}", methods=["GET", "HEAD"])
+async def download_file(kind: str, filename: str, request: Request):
+    """
+    Download an uploaded file
+
+    Supports conditional requests (If-None-Match, If-Modified-Since), byte ranges (Range, If-Range)
+    and zstd or gzip compression (Accept-Encoding). The ETag is the sha256 of the content.
+    """
+    file_path = get_uploaded_path(kind, filename)
+    row = await run_in_threadpool(file_index.get, kind, filename)
+    etag = await run_in_threadpool(get_etag, file_path, row["sha256"] if row else None)
+    await run_in_threadpool(file_index.touch, kind, filename)
+    return file_response(request, file_path, etag)
+
+
+@app.get("/files/{kind}/{filename}/artifacts")
+async def list_artifacts(kind: str, filename: str):
+    """
+    List the derived artifacts of an uploaded file
+
+    Returns:
+        JSON with the meta.json of the artifacts and their names, sizes and ETags
+    """
+    file_path = get_uploaded_path(kind, filename)
+    artifacts_dir = get_artifacts_dir(kind, file_path)
+    await run_in_threadpool(file_index.touch, kind, filename)
+
+    def describe():
+        with (artifacts_dir / "meta.json").open() as f:
+            meta = json.load(f)
+        artifacts = [
+            {"name": path.name, "size_bytes": path.stat().st_size, "etag": get_etag(path)}
+            for path in sorted(artifacts_dir.iterdir()) if path.is_file() and not path.name.startswith(".")
+        ]
+        return {"filename": filename, "kind": kind, "meta": meta, "artifacts": artifacts}
+
+    return await run_in_threadpool(describe)
+
+
+@app.api_route("/files/{kind}/{filename}/artifacts/{artifact}", methods=["GET", "HEAD"])
+async def download_artifact(kind: str, filename: str, artifact: str, request: Request):
+    """
+    Download a derived artifact of an uploaded file (e.g. points.npy of streamlines, faces.npy of an STL mesh)
+
+    Supports the same conditional, range and compression headers as the file download.
+    """
+    file_path = get_uploaded_path(kind, filename)
+    artifacts_dir = get_artifacts_dir(kind, file_path)
+    artifact_path = artifacts_dir / artifact
+    if Path(artifact).name != artifact or artifact.startswith(".") or not artifact_path.is_file():
+        raise HTTPException(status_code=404, detail=f"Artifact '{artifact}' of '{filename}' not found")
+    etag = await run_in_threadpool(get_etag, artifact_path)
+    await run_in_threadpool(file_index.touch, kind, filename)
+    return file_response(request, artifact_path, etag)
+
+
 @app.delete("/files/stl/{filename}")
 async def delete_stl(filename: str):
-    """Delete an uploaded STL file"""
+    """Delete an uploaded STL file, its content is kept while other names alias it"""
     file_path = STL_DIR / filename
 
-    if not file_path.exists():
+    if not await run_in_threadpool(file_path.exists):
         raise HTTPException(status_code=404, detail=f"File '{filename}' not found")
 
     try:
-        file_path.unlink()
+        # unlinks and index updates, off the event loop
+        await run_in_threadpool(remove_upload, "stl", filename)
         return {"success": True, "message": f"Deleted '{filename}'"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
@@ -261,18 +625,31 @@ async def delete_stl(filename: str):
 
 @app.delete("/files/streamlines/{filename}")
 async def delete_streamlines(filename: str):
-    """Delete an uploaded streamlines file"""
+    """Delete an uploaded streamlines file, its content is kept while other names alias it"""
     file_path = STREAMLINES_DIR / filename
 
-    if not file_path.exists():
+    if not await run_in_threadpool(file_path.exists):
         raise HTTPException(status_code=404, detail=f"File '{filename}' not found")
 
     try:
-        file_path.unlink()
+        # unlinks and index updates, off the event loop
+        await run_in_threadpool(remove_upload, "streamlines", filename)
         return {"success": True, "message": f"Deleted '{filename}'"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
 
 
+@app.get("/usage")
+async def get_usage():
+    """
+    Storage usage of the uploaded files
+
+    Returns:
+        JSON with the quota (null if none), the bytes used by the uploads and by their derived
+        artifacts, the bytes saved by deduplication, the oldest last access and the recent evictions
+    """
+    return await run_in_threadpool(quota.get_usage)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,245 @@
+"""
+Resumable chunked uploads
+
+An upload is created with its final name and size, the client PUTs chunks at increasing
+offsets and finalizes it. The partial file and its state are kept on disk, so an interrupted
+upload resumes from the last offset received, also after a restart of the service.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+CHUNK_SIZE = 8 * 1024 * 1024        # chunk size suggested to clients
+WRITE_BUFFER_SIZE = 1024 * 1024     # request body bytes buffered before a disk write
+HASH_BLOCK_SIZE = 1024 * 1024
+UPLOAD_EXPIRY = 24 * 3600           # seconds without a chunk before an unfinished upload is removed
+
+
+def copy_and_hash(source, destination: Path, validate: Optional[Callable[[Path, str], dict]] = None,
+                  commit: Optional[Callable[[Path, str, Path], bool]] = None) -> dict:
+    """
+    Copy a file object to a path in blocks
+
+    The data is written to a temporary file next to the destination and renamed once
+    validated, so readers never see a partial file and an invalid upload keeps the old file.
+
+    Args:
+        source: File object to read
+        destination: Final path of the file
+        validate: Optional check of the file and its sha256, raises HTTPException or returns extra fields for the reply
+        commit: Optional replacement of the rename, called with the file, its sha256 and the destination,
+            returns whether the content was already stored
+
+    Returns:
+        Dictionary with the sha256 of the content, the fields returned by validate and whether commit deduplicated it
+    """
+    hasher = hashlib.sha256()
+    tmp_path = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with tmp_path.open("wb") as f:
+            while True:
+                block = source.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                hasher.update(block)
+                f.write(block)
+        sha256 = hasher.hexdigest()
+        result = validate(tmp_path, sha256) if validate else {}
+        if commit:
+            result = dict(result, deduplicated=commit(tmp_path, sha256, destination))
+        else:
+            os.replace(tmp_path, destination)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return dict(result, sha256=sha256)
+
+
+class ChunkedUpload:
+    """State of one upload, persisted next to its partial file"""
+
+    def __init__(self, upload_id: str, kind: str, filename: str, size: int,
+                 sha256: Optional[str] = None, offset: int = 0,
+                 created: Optional[float] = None, updated: Optional[float] = None):
+        self.upload_id = upload_id
+        self.kind = kind
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256        # expected digest, checked on finalize
+        self.offset = offset        # bytes received
+        self.created = created or time.time()
+        self.updated = updated or self.created
+        self.hasher = None          # sha256 of the bytes received, rebuilt from the partial file after a restart
+        self.lock = asyncio.Lock()  # one request writes at a time
+
+    def to_dict(self) -> dict:
+        return {
+            "upload_id": self.upload_id,
+            "kind": self.kind,
+            "filename": self.filename,
+            "size": self.size,
+            "sha256": self.sha256,
+            "offset": self.offset,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+
+class UploadStore:
+    """Unfinished uploads, a `<id>.part` file and a `<id>.json` state file each"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.uploads = {}
+
+        for state_path in self.directory.glob("*.json"):
+            try:
+                with state_path.open() as f:
+                    upload = ChunkedUpload(**json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                print(f"WARNING: Dropping unreadable upload state '{state_path}': {e}")
+                state_path.unlink()
+                continue
+            # the state is saved after the data, bytes past the saved offset are written again
+            upload.offset = min(upload.offset, self._part_path(upload).stat().st_size) if self._part_path(upload).exists() else 0
+            self.uploads[upload.upload_id] = upload
+
+    def _part_path(self, upload: ChunkedUpload) -> Path:
+        return self.directory / f"{upload.upload_id}.part"
+
+    def _state_path(self, upload: ChunkedUpload) -> Path:
+        return self.directory / f"{upload.upload_id}.json"
+
+    def save(self, upload: ChunkedUpload):
+        tmp_path = self._state_path(upload).with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(upload.to_dict(), f)
+        os.replace(tmp_path, self._state_path(upload))
+
+    def create(self, kind: str, filename: str, size: int, sha256: Optional[str] = None,
+               upload_id: Optional[str] = None) -> ChunkedUpload:
+        """
+        Start an upload, or resume an unfinished one
+
+        An upload is only resumed when the client identifies it: by its `upload_id`, or by the sha256
+        of the file. Two files with the same name and size are otherwise different uploads.
+
+        Args:
+            kind: Upload kind
+            filename: Final file name
+            size: File size in bytes
+            sha256: Optional sha256 of the file, checked on finalize
+            upload_id: Optional id of the unfinished upload to resume, a new upload is started if it expired
+
+        Returns:
+            The upload to send the chunks of, from its offset
+        """
+        self.expire()
+        sha256 = sha256.lower() if sha256 else None
+
+        if upload_id is not None and upload_id in self.uploads:
+            upload = self.uploads[upload_id]
+            if (upload.kind, upload.filename, upload.size) != (kind, filename, size) or \
+                    (sha256 and upload.sha256 and upload.sha256.lower() != sha256):
+                raise HTTPException(status_code=409, detail=f"Upload '{upload_id}' is for another file")
+            return upload
+
+        if sha256 and upload_id is None:
+            for upload in self.uploads.values():
+                if (upload.kind, upload.filename, upload.size) == (kind, filename, size) and \
+                        upload.sha256 and upload.sha256.lower() == sha256:
+                    return upload
+
+        upload = ChunkedUpload(uuid.uuid4().hex, kind, filename, size, sha256)
+        self._part_path(upload).touch()
+        self.save(upload)
+        self.uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id: str) -> ChunkedUpload:
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise HTTPException(status_code=404, detail=f"Upload '{upload_id}' not found")
+        return upload
+
+    def _get_hasher(self, upload: ChunkedUpload):
+        if upload.hasher is None:
+            upload.hasher = hashlib.sha256()
+            with self._part_path(upload).open("rb") as f:
+                remaining = upload.offset
+                while remaining > 0:
+                    block = f.read(min(HASH_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    upload.hasher.update(block)
+                    remaining -= len(block)
+        return upload.hasher
+
+    def write(self, upload: ChunkedUpload, data: bytes):
+        """Append data at the current offset (blocking, run it in a worker thread)"""
+        if upload.offset + len(data) > upload.size:
+            raise HTTPException(status_code=400, detail=f"Chunk exceeds the upload size of {upload.size} bytes")
+
+        hasher = self._get_hasher(upload)
+        with self._part_path(upload).open("r+b") as f:
+            f.seek(upload.offset)
+            f.write(data)
+        hasher.update(data)
+        upload.offset += len(data)
+        upload.updated = time.time()
+
+    def finalize(self, upload: ChunkedUpload, destination: Path,
+                 validate: Optional[Callable[[Path, str], dict]] = None,
+                 commit: Optional[Callable[[Path, str, Path], bool]] = None) -> dict:
+        """
+        Check and move a complete upload to its destination (blocking, run it in a worker thread)
+
+        Args:
+            upload: Upload with all bytes received
+            destination: Final path of the file
+            validate: Optional check of the file and its sha256, raises HTTPException or returns extra fields for the reply
+            commit: Optional replacement of the rename, called with the file, its sha256 and the destination,
+                returns whether the content was already stored
+
+        Returns:
+            Dictionary with the sha256, the fields returned by validate and whether commit deduplicated it
+        """
+        if upload.offset != upload.size:
+            raise HTTPException(status_code=400,
+                                detail=f"Upload incomplete: {upload.offset} of {upload.size} bytes received")
+
+        sha256 = self._get_hasher(upload).hexdigest()
+        if upload.sha256 and upload.sha256.lower() != sha256:
+            self.abort(upload)
+            raise HTTPException(status_code=400,
+                                detail=f"Checksum mismatch: expected {upload.sha256}, received {sha256}")
+
+        result = validate(self._part_path(upload), sha256) if validate else {}
+
+        if commit:
+            result = dict(result, deduplicated=commit(self._part_path(upload), sha256, destination))
+        else:
+            os.replace(self._part_path(upload), destination)
+        self._state_path(upload).unlink(missing_ok=True)
+        self.uploads.pop(upload.upload_id, None)
+        return dict(result, sha256=sha256)
+
+    def abort(self, upload: ChunkedUpload):
+        self._part_path(upload).unlink(missing_ok=True)
+        self._state_path(upload).unlink(missing_ok=True)
+        self.uploads.pop(upload.upload_id, None)
+
+    def expire(self):
+        """Remove uploads without a chunk within UPLOAD_EXPIRY"""
+        now = time.time()
+        for upload in [u for u in self.uploads.values() if now - u.updated > UPLOAD_EXPIRY and not u.lock.locked()]:
+            print(f"Removing expired upload '{upload.upload_id}' ({upload.filename})")
+            self.abort(upload)
@@ -0,0 +1,239 @@
+"""
+Content-addressed storage of the uploaded files
+
+Each distinct content is stored once as `.objects/<sha[:2]>/<sha256><ext>`, the names in
+`stl/` and `streamlines/` are hard links (aliases) to it, so readers keep opening files by
+name. Aliases are counted per object in a SQLite table, deleting a name drops its alias and
+the object goes with its last alias. Derived artifacts are written next to the object
+(`<sha256>.arrays/` for streamlines, `<sha256>.mesh/` for STL) and linked from every alias,
+so an upload of known content is neither stored nor converted again. The size of the derived
+artifacts is kept per object for the storage quota (see quota.py).
+"""
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from streamline_arrays import get_arrays_dir, read_streamline_meta, write_streamline_arrays, remove_arrays
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    refcount INTEGER NOT NULL,
+    derived_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (kind, name)
+);
+"""
+
+
+def dir_size(directory: Path) -> int:
+    """Bytes of the files in a directory (not following a symbolic link to it), 0 if missing"""
+    if directory.is_symlink() or not directory.is_dir():
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file(follow_symlinks=False))
+
+
+def _link(source: Path, destination: Path):
+    """Atomically point destination at the content of source, a copy where hard links are not supported"""
+    tmp_path = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.link")
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, destination)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+class ContentStore:
+    """Objects under `directory`, aliases of the upload kinds in `directories` (kind -> (directory, extension))"""
+
+    def __init__(self, directory: Path, directories: dict):
+        self.directory = directory
+        self.directories = directories
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(directory / "objects.sqlite"), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            columns = [row["name"] for row in self.db.execute("PRAGMA table_info(objects)")]
+            if "derived_bytes" not in columns:
+                self.db.execute("ALTER TABLE objects ADD COLUMN derived_bytes INTEGER")   # measured on first use
+            self.db.commit()
+
+    def object_path(self, sha256: str, extension: str) -> Path:
+        return self.directory / sha256[:2] / f"{sha256}{extension}"
+
+    def get_object(self, sha256: str) -> Optional[Path]:
+        """Path of a stored object, None if the content is not stored"""
+        with self.lock:
+            row = self.db.execute("SELECT path FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None or not Path(row["path"]).exists():
+            return None
+        return Path(row["path"])
+
+    def commit(self, kind: str, path: Path, sha256: str, destination: Path) -> bool:
+        """
+        Store a file by its content and alias it under its name (blocking, run it in a worker thread)
+
+        Args:
+            kind: Upload kind of the destination
+            path: Complete file, moved into the store or removed if its content is already stored
+            sha256: Digest of the file
+            destination: Name of the file in the directory of its kind, replaced atomically
+
+        Returns:
+            True if the content was already stored
+        """
+        _, extension = self.directories[kind]
+        with self.lock:
+            row = self.db.execute("SELECT path FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+            deduplicated = row is not None and Path(row["path"]).exists()
+            if deduplicated:
+                object_path = Path(row["path"])
+                path.unlink()
+            else:
+                object_path = self.object_path(sha256, extension)
+                object_path.parent.mkdir(exist_ok=True)
+                os.replace(path, object_path)
+                self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, 0, NULL)",
+                                (sha256, str(object_path), object_path.stat().st_size))
+
+            _link(object_path, destination)
+
+            previous = self.db.execute("SELECT sha256 FROM aliases WHERE kind = ? AND name = ?",
+                                       (kind, destination.name)).fetchone()
+            if previous is None or previous["sha256"] != sha256:
+                self.db.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)", (kind, destination.name, sha256))
+                self.db.execute("UPDATE objects SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+                if previous is not None:
+                    self._unref(previous["sha256"])
+            self.db.commit()
+        return deduplicated
+
+    def release(self, kind: str, name: str):
+        """Drop the alias of a deleted name, the object goes with its last alias"""
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM aliases WHERE kind = ? AND name = ?", (kind, name)).fetchone()
+            if row is None:
+                return      # copied in by hand, not in the store
+            self.db.execute("DELETE FROM aliases WHERE kind = ? AND name = ?", (kind, name))
+            self._unref(row["sha256"])
+            self.db.commit()
+
+    def _unref(self, sha256: str):
+        self.db.execute("UPDATE objects SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        row = self.db.execute("SELECT path, refcount FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None or row["refcount"] > 0:
+            return
+        object_path = Path(row["path"])
+        for derived in self._derived_dirs(object_path):
+            remove_arrays(derived)
+        object_path.unlink(missing_ok=True)
+        self.db.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+
+    @staticmethod
+    def _derived_dirs(object_path: Path) -> list:
+        return [path for path in object_path.parent.glob(f"{object_path.stem}.*") if path != object_path]
+
+    def get_streamline_meta(self, sha256: str) -> Optional[dict]:
+        """meta.json of the binary copy of stored streamlines, None if the content or its copy is missing"""
+        object_path = self.get_object(sha256)
+        return read_streamline_meta(object_path) if object_path is not None else None
+
+    def link_streamline_arrays(self, destination: Path, sha256: str, arrays: Optional[dict] = None):
+        """Link the binary copy of stored streamlines to an alias, writing it first if arrays are given"""
+        object_path = self.get_object(sha256)
+        if object_path is None:
+            raise RuntimeError(f"Streamlines {sha256} are not stored")
+        if arrays is not None:
+            write_streamline_arrays(object_path, arrays)
+        self.link_derived(object_path, destination, get_arrays_dir)
+
+    def link_derived(self, object_path: Path, destination: Path, get_dir):
+        """
+        Link a derived artifact of an object to an alias
+
+        `get_dir(destination)` becomes a symbolic link to `get_dir(object_path)`, readers check
+        it against the alias, which has the size and modification time of the object it links.
+        """
+        alias_dir = get_dir(destination)
+        tmp_link = alias_dir.with_name(f".{alias_dir.name}.{uuid.uuid4().hex}.link")
+        os.symlink(os.path.relpath(get_dir(object_path), alias_dir.parent), tmp_link)
+        try:
+            if alias_dir.is_dir() and not alias_dir.is_symlink():
+                remove_arrays(alias_dir)    # written before the store existed
+            os.replace(tmp_link, alias_dir)
+        finally:
+            if tmp_link.is_symlink():
+                tmp_link.unlink()
+        self._measure_derived(object_path)
+
+    def _measure_derived(self, object_path: Path) -> int:
+        derived_bytes = sum(dir_size(path) for path in self._derived_dirs(object_path))
+        with self.lock:
+            self.db.execute("UPDATE objects SET derived_bytes = ? WHERE path = ?", (derived_bytes, str(object_path)))
+            self.db.commit()
+        return derived_bytes
+
+    def list_objects(self) -> list:
+        """
+        Stored objects with their size, the size of their derived artifacts and their aliases
+
+        Returns:
+            List of dictionaries with sha256, path, size_bytes, derived_bytes and aliases [(kind, name)]
+        """
+        with self.lock:
+            objects = {row["sha256"]: dict(row, aliases=[]) for row in self.db.execute("SELECT * FROM objects")}
+            for row in self.db.execute("SELECT kind, name, sha256 FROM aliases"):
+                if row["sha256"] in objects:
+                    objects[row["sha256"]]["aliases"].append((row["kind"], row["name"]))
+        for entry in objects.values():
+            if entry["derived_bytes"] is None:
+                entry["derived_bytes"] = self._measure_derived(Path(entry["path"]))
+            del entry["refcount"]
+        return list(objects.values())
+
+    def remove_derived(self, sha256: str) -> int:
+        """
+        Remove the derived artifacts of an object and their links from its aliases, they are written
+        again when the content is next uploaded
+
+        Returns:
+            Bytes freed
+        """
+        object_path = self.get_object(sha256)
+        if object_path is None:
+            return 0
+        with self.lock:
+            aliases = self.db.execute("SELECT kind, name FROM aliases WHERE sha256 = ?", (sha256,)).fetchall()
+        freed = 0
+        for derived in self._derived_dirs(object_path):
+            for kind, name in aliases:
+                directory, _ = self.directories[kind]
+                alias_dir = directory / Path(name).with_suffix(derived.suffix)
+                if alias_dir.is_symlink():
+                    alias_dir.unlink()
+            freed += dir_size(derived)
+            remove_arrays(derived)
+        self._measure_derived(object_path)
+        return freed
+
+    def get_usage(self) -> dict:
+        with self.lock:
+            row = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), COALESCE(SUM(size_bytes * refcount), 0), "
+                                  "COALESCE(SUM(derived_bytes), 0) FROM objects").fetchone()
+        return {"objects": row[0], "stored_bytes": row[1], "aliased_bytes": row[2], "derived_bytes": row[3]}
@@ -0,0 +1,171 @@
+"""
+Download responses for the uploaded files and their artifacts
+
+Files are streamed from disk with ETag and Last-Modified validators, conditional requests
+(If-None-Match, If-Modified-Since, If-Range), single byte ranges and zstd or gzip transfer
+compression of complete responses, so remote readers only fetch what changed.
+"""
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_BLOCK_SIZE = 1024 * 1024
+MIN_COMPRESS_SIZE = 1024        # smaller files are sent as they are
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+MEDIA_TYPES = {".stl": "model/stl", ".json": "application/json", ".npy": "application/octet-stream"}
+
+
+def get_etag(path: Path, sha256: Optional[str] = None) -> str:
+    """Strong ETag of a file: its sha256 if known, otherwise its size and modification time"""
+    if sha256:
+        return f'"{sha256}"'
+    stat = path.stat()
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # compressed variants carry the encoding in their tag, they validate the same file
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    base = etag.rstrip('"')
+    return etag in tags or any(tag.startswith(base + "-") for tag in tags)
+
+
+def _not_modified_since(header: str, mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def _parse_range(header: str, size: int):
+    """(start, end) of a single "bytes=" range, None to send the whole file, "unsatisfiable" if out of the file"""
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None     # multiple ranges are answered with the whole file
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                return "unsatisfiable"
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return "unsatisfiable"
+    return start, end
+
+
+def _choose_encoding(header: str) -> Optional[str]:
+    """zstd or gzip if accepted by the client (q > 0), preferring zstd"""
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    if zstandard is not None and accepted.get("zstd", 0) > 0:
+        return "zstd"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def _read_blocks(path: Path, start: int, length: int):
+    with path.open("rb") as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(READ_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def _compress_blocks(blocks, encoding: str):
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)     # gzip container
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def file_response(request: Request, path: Path, etag: str, media_type: Optional[str] = None) -> Response:
+    """
+    Response for a GET or HEAD of a file
+
+    Args:
+        request: Request with the conditional, range and encoding headers
+        path: File to send
+        etag: Strong ETag of the file, see get_etag
+        media_type: Content type, from the file extension if None
+
+    Returns:
+        304 if the client copy is current, 206 with a single byte range, 416 for a range outside
+        the file, otherwise 200 with the file, compressed with zstd or gzip if the client accepts it
+    """
+    stat = path.stat()
+    size = stat.st_size
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+    }
+    media_type = media_type or MEDIA_TYPES.get(path.suffix.lower(), "application/octet-stream")
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if (if_none_match is not None and _etag_matches(if_none_match, etag)) or \
+            (if_none_match is None and if_modified_since is not None and _not_modified_since(if_modified_since, stat.st_mtime)):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # a range of a changed file is answered with the whole file
+    if range_header and (if_range is None or if_range.strip() == etag):
+        byte_range = _parse_range(range_header, size)
+    if byte_range == "unsatisfiable":
+        return Response(status_code=416, headers=dict(headers, **{"Content-Range": f"bytes */{size}"}))
+
+    head = request.method == "HEAD"
+    if byte_range is not None:
+        start, end = byte_range
+        headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+        body = [] if head else _read_blocks(path, start, end - start + 1)
+        return StreamingResponse(body, status_code=206, media_type=media_type, headers=headers)
+
+    encoding = _choose_encoding(request.headers.get("accept-encoding", "")) if size >= MIN_COMPRESS_SIZE else None
+    if encoding is None:
+        headers["Content-Length"] = str(size)
+        body = [] if head else _read_blocks(path, 0, size)
+        return StreamingResponse(body, media_type=media_type, headers=headers)
+
+    # the compressed variant has its own tag, its length is not known before compressing
+    headers.update({"Content-Encoding": encoding, "ETag": f'{etag[:-1]}-{encoding}"'})
+    body = [] if head else _compress_blocks(_read_blocks(path, 0, size), encoding)
+    return StreamingResponse(body, media_type=media_type, headers=headers)
@@ -0,0 +1,248 @@
+"""
+Metadata index of the uploaded files
+
+A SQLite table with one row per uploaded file: size, modification time, sha256 and, for
+streamlines, the line and point counts and the bounds. Rows are written at upload time.
+The uploads, deletes and evictions of the service update the rows and record the directory as
+scanned, a listing only rescans a directory once after startup and when its modification time
+changed otherwise (files copied in or removed by hand). It checks the rows of the requested page
+against the files, so its cost follows the page size.
+The last access of each file (upload, download) is recorded for the storage quota (see quota.py).
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Optional
+
+from streamline_arrays import convert_streamlines, write_streamline_arrays, read_streamline_meta, get_arrays_dir
+
+SORT_COLUMNS = {"name": "name", "mtime": "mtime_ns", "size": "size_bytes", "accessed": "accessed"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    num_streamlines INTEGER,
+    num_points INTEGER,
+    bounds TEXT,
+    indexed REAL NOT NULL,
+    accessed REAL,
+    PRIMARY KEY (kind, name)
+);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (kind, mtime_ns);
+CREATE INDEX IF NOT EXISTS files_size ON files (kind, size_bytes);
+CREATE TABLE IF NOT EXISTS directories (
+    kind TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+
+def describe_streamlines(path: Path) -> dict:
+    """Line and point counts and bounds of a streamlines file, from its binary copy (written if missing)"""
+    meta = read_streamline_meta(path)
+    if meta is None:
+        # uploaded before the binary copy existed, or copied in by hand
+        try:
+            with path.open() as f:
+                arrays = convert_streamlines(json.load(f))
+            write_streamline_arrays(path, arrays)
+        except Exception as e:
+            print(f"WARNING: Could not read streamlines '{path}': {e}")
+            return {"num_streamlines": 0, "num_points": 0, "bounds": None}
+        meta = read_streamline_meta(path)
+        if meta is None:
+            return {"num_streamlines": 0, "num_points": 0, "bounds": None}
+
+    bounds = np.load(get_arrays_dir(path) / "bounds.npy")
+    return {
+        "num_streamlines": meta["num_streamlines"],
+        "num_points": meta["num_points"],
+        "bounds": bounds.tolist() if meta["num_points"] > 0 else None,
+    }
+
+
+class FileIndex:
+    """Index of the files of each upload kind, `directories` maps a kind to (directory, extension)"""
+
+    def __init__(self, db_path: Path, directories: dict):
+        self.directories = directories
+        self.lock = threading.Lock()
+        self.scanned = set()    # kinds rescanned since startup
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            columns = [row["name"] for row in self.db.execute("PRAGMA table_info(files)")]
+            if "accessed" not in columns:
+                self.db.execute("ALTER TABLE files ADD COLUMN accessed REAL")
+                self.db.execute("UPDATE files SET accessed = indexed")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (kind, accessed)")
+            self.db.commit()
+
+    def add(self, kind: str, path: Path, sha256: Optional[str] = None):
+        """Index a file written by the service (blocking, run it in a worker thread)"""
+        self._index(kind, path, sha256)
+        self.changed(kind)
+
+    def remove(self, kind: str, name: str):
+        """Remove the row of a file deleted by the service"""
+        self._unindex(kind, name)
+        self.changed(kind)
+
+    def changed(self, kind: str):
+        """
+        Record a change the service made to the directory of a kind, its rows are up to date so the
+        next listing does not rescan it. Before the first rescan since startup the directory stays unscanned.
+        """
+        if kind not in self.scanned:
+            return
+        directory, _ = self.directories[kind]
+        mtime_ns = directory.stat().st_mtime_ns
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (kind, mtime_ns))
+            self.db.commit()
+
+    def _index(self, kind: str, path: Path, sha256: Optional[str] = None):
+        stat = path.stat()
+        row = {
+            "kind": kind,
+            "name": path.name,
+            "path": str(path),
+            "size_bytes": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+            "num_streamlines": None,
+            "num_points": None,
+            "bounds": None,
+            "indexed": time.time(),
+            "accessed": time.time(),
+        }
+        if kind == "streamlines":
+            description = describe_streamlines(path)
+            row.update(description, bounds=json.dumps(description["bounds"]))
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (kind, name, path, size_bytes, mtime_ns, sha256, num_streamlines, "
+                "num_points, bounds, indexed, accessed) VALUES (:kind, :name, :path, :size_bytes, :mtime_ns, :sha256, "
+                ":num_streamlines, :num_points, :bounds, :indexed, :accessed)", row)
+            self.db.commit()
+
+    def touch(self, kind: str, name: str):
+        """Record an access to a file"""
+        with self.lock:
+            self.db.execute("UPDATE files SET accessed = ? WHERE kind = ? AND name = ?", (time.time(), kind, name))
+            self.db.commit()
+
+    def list_all(self) -> list:
+        """Name, path, size, sha256 and last access of every indexed file, after rescanning changed directories"""
+        for kind in self.directories:
+            self.sync(kind)
+        with self.lock:
+            return [dict(row) for row in self.db.execute(
+                "SELECT kind, name, path, size_bytes, sha256, accessed FROM files ORDER BY accessed")]
+
+    def _unindex(self, kind: str, name: str):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE kind = ? AND name = ?", (kind, name))
+            self.db.commit()
+
+    def sync(self, kind: str):
+        """Rescan the directory of a kind once after startup, then when it changed other than through the service"""
+        directory, extension = self.directories[kind]
+        mtime_ns = directory.stat().st_mtime_ns
+        with self.lock:
+            row = self.db.execute("SELECT mtime_ns FROM directories WHERE kind = ?", (kind,)).fetchone()
+        if kind in self.scanned and row is not None and row["mtime_ns"] == mtime_ns:
+            return
+
+        with self.lock:
+            indexed = {r["name"]: (r["size_bytes"], r["mtime_ns"])
+                       for r in self.db.execute("SELECT name, size_bytes, mtime_ns FROM files WHERE kind = ?", (kind,))}
+
+        on_disk = set()
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not entry.name.lower().endswith(extension) or entry.name.startswith("."):
+                continue
+            on_disk.add(entry.name)
+            stat = entry.stat()
+            if indexed.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                self._index(kind, Path(entry.path))
+
+        for name in set(indexed) - on_disk:
+            self._unindex(kind, name)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (kind, mtime_ns))
+            self.db.commit()
+        self.scanned.add(kind)
+
+    def _verify(self, kind: str, row) -> Optional[dict]:
+        """Row of a file checked against its size and mtime, None if the file is gone"""
+        path = Path(row["path"])
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._unindex(kind, row["name"])
+            return None
+
+        if (stat.st_size, stat.st_mtime_ns) != (row["size_bytes"], row["mtime_ns"]):
+            self._index(kind, path)
+            with self.lock:
+                row = self.db.execute("SELECT * FROM files WHERE kind = ? AND name = ?", (kind, row["name"])).fetchone()
+        return dict(row)
+
+    def get(self, kind: str, name: str) -> Optional[dict]:
+        """Row of a file checked against the file, None if not indexed or gone (blocking, run it in a worker thread)"""
+        with self.lock:
+            row = self.db.execute("SELECT * FROM files WHERE kind = ? AND name = ?", (kind, name)).fetchone()
+        return self._verify(kind, row) if row is not None else None
+
+    def query(self, kind: str, name_filter: Optional[str] = None, offset: int = 0, limit: int = 100,
+              sort: str = "name", descending: bool = False):
+        """
+        One page of the files of a kind (blocking, run it in a worker thread)
+
+        Args:
+            kind: Upload kind
+            name_filter: Optional substring of the file names
+            offset: First file of the page
+            limit: Files per page
+            sort: "name", "mtime" or "size"
+            descending: Sort order
+
+        Returns:
+            Tuple of the file rows of the page and the total number of files matching the filter
+        """
+        self.sync(kind)
+
+        where = "kind = ?"
+        params = [kind]
+        if name_filter:
+            escaped = name_filter.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            where += " AND name LIKE ? ESCAPE '\\'"
+            params.append(f"%{escaped}%")
+        order = f"{SORT_COLUMNS[sort]} {'DESC' if descending else 'ASC'}, name"
+
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM files WHERE {where}", params).fetchone()[0]
+            rows = self.db.execute(f"SELECT * FROM files WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                                   params + [limit, offset]).fetchall()
+
+        files = []
+        for row in rows:
+            row = self._verify(kind, row)
+            if row is None:
+                total -= 1
+                continue
+            files.append(row)
+        return files, total
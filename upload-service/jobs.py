@@ -0,0 +1,143 @@
+"""
+Background processing of the uploaded files
+
+An upload queues a job that prepares everything the loaders need (see STREAMLINE_FORMAT.md),
+so selecting an upload loads ready arrays. Jobs run in a pool of worker threads, the jobs of
+the same content run one at a time and a job finding the artifacts ready only links them.
+"""
+import time
+import uuid
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+JOB_WORKERS = 2             # jobs processed in parallel
+MAX_FINISHED_JOBS = 1000    # finished jobs kept for the status endpoint
+
+
+class Job:
+    """State of one processing job, `stages` are (name, function) run in order on a shared context"""
+
+    def __init__(self, job_id: str, kind: str, filename: str, sha256: str):
+        self.job_id = job_id
+        self.kind = kind
+        self.filename = filename
+        self.sha256 = sha256
+        self.status = "queued"      # queued, running, done or failed
+        self.stage = None
+        self.stages = []
+        self.completed = 0          # stages done
+        self.result = {}
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def progress(self) -> float:
+        if self.status == "done":
+            return 1.0
+        return self.completed / len(self.stages) if self.stages else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "filename": self.filename,
+            "sha256": self.sha256,
+            "status": self.status,
+            "stage": self.stage,
+            "stages": self.stages,
+            "progress": round(self.progress, 3),
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """Jobs by id, run by a pool of worker threads"""
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-job")
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.content_locks = {}     # sha256 -> [lock, jobs holding or waiting for it]
+
+    def submit(self, kind: str, filename: str, sha256: str, plan: Callable[[Job], list]) -> Job:
+        """
+        Queue a job
+
+        Args:
+            kind: Upload kind
+            filename: Name of the uploaded file
+            sha256: Digest of the content, jobs of the same content run one at a time
+            plan: Called when the job starts, returns the (name, function(context)) stages still to run,
+                the functions share a context dictionary and may add to job.result
+
+        Returns:
+            The queued job
+        """
+        job = Job(uuid.uuid4().hex, kind, filename, sha256)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            finished = [j for j in self.jobs.values() if j.finished is not None]
+            for old in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[old.job_id]
+        self.executor.submit(self._run, job, plan)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+        return job
+
+    def list(self, status: Optional[str] = None) -> list:
+        with self.lock:
+            return [j for j in self.jobs.values() if status is None or j.status == status]
+
+    def _acquire(self, sha256: str) -> threading.Lock:
+        with self.lock:
+            entry = self.content_locks.setdefault(sha256, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        return entry[0]
+
+    def _release(self, sha256: str):
+        with self.lock:
+            entry = self.content_locks[sha256]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.content_locks[sha256]
+        entry[0].release()
+
+    def _run(self, job: Job, plan: Callable[[Job], list]):
+        self._acquire(job.sha256)
+        try:
+            job.status = "running"
+            job.started = time.time()
+            stages = plan(job)
+            job.stages = [name for name, _ in stages]
+
+            context = {}
+            for name, function in stages:
+                job.stage = name
+                function(context)
+                job.completed += 1
+            job.status = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.stage = None
+            job.finished = time.time()
+            self._release(job.sha256)
@@ -0,0 +1,246 @@
+"""
+Binary copy of an uploaded STL file, prepared for the loaders
+
+The triangle soup of the STL is welded into an indexed mesh with vertex normals and
+written to `<name>.mesh/` next to `<name>.stl`, so readers memory map a few .npy files
+instead of parsing and welding the STL. Coarser levels of detail are built by vertex
+clustering, readers pick a level by triangle budget. See STREAMLINE_FORMAT.md for the layout.
+"""
+import re
+import numpy as np
+from pathlib import Path
+
+from streamline_arrays import write_arrays, read_arrays_meta, remove_arrays
+
+MESH_SUFFIX = ".mesh"
+FORMAT_VERSION = 2
+
+LOD_REDUCTION = 4           # triangles of a level divided by those of the next level
+MIN_LOD_FACES = 500         # no coarser level below this many triangles
+LOD_ATTEMPTS = 4            # clusterings tried per level to reach its triangle budget
+
+STL_HEADER_SIZE = 84
+STL_RECORD = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")])
+STL_VERTEX = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+def get_mesh_dir(stl_path: Path) -> Path:
+    return stl_path.with_suffix(MESH_SUFFIX)
+
+
+def read_stl(stl_path: Path) -> np.ndarray:
+    """
+    Triangles of a binary or ASCII STL file
+
+    Returns:
+        float32 array (T, 3, 3) of the corners of each triangle
+    """
+    size = stl_path.stat().st_size
+    with stl_path.open("rb") as f:
+        header = f.read(STL_HEADER_SIZE)
+
+    # binary files may also start with "solid", the size tells them apart
+    if len(header) == STL_HEADER_SIZE:
+        count = int(np.frombuffer(header, dtype="<u4", count=1, offset=80)[0])
+        if size == STL_HEADER_SIZE + count * STL_RECORD.itemsize:
+            records = np.fromfile(stl_path, dtype=STL_RECORD, count=count, offset=STL_HEADER_SIZE)
+            return records["vertices"]
+
+    data = stl_path.read_bytes()
+    if not data.lstrip().lower().startswith(b"solid"):
+        raise ValueError("Not an STL file")
+    corners = np.array(STL_VERTEX.findall(data)).astype(np.float32)
+    if len(corners) % 3 != 0:
+        raise ValueError(f"ASCII STL with {len(corners)} vertices, not a multiple of 3")
+    return corners.reshape(-1, 3, 3)
+
+
+def weld_vertices(triangles: np.ndarray):
+    """
+    Indexed mesh of a triangle soup, corners with equal coordinates become one vertex
+
+    Returns:
+        Tuple of vertices float32 (V, 3) and faces int32 (F, 3), without the triangles that
+        collapsed to a line or a point
+    """
+    corners = np.ascontiguousarray(triangles.reshape(-1, 3), dtype=np.float32) + np.float32(0.0)  # -0.0 to 0.0
+    keys = corners.view(np.dtype((np.void, corners.itemsize * 3))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    vertices = corners[first]
+    faces = inverse.reshape(-1, 3).astype(np.int32)
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])
+    return vertices, faces[keep]
+
+
+def vertex_normals(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """Area weighted vertex normals, float32 (V, 3)"""
+    corners = vertices[faces].astype(np.float64)
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])   # length 2 * area
+
+    normals = np.empty((len(vertices), 3), dtype=np.float64)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(faces.ravel(), weights=np.repeat(face_normals[:, axis], 3),
+                                       minlength=len(vertices))
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    return normals.astype(np.float32)
+
+
+def _sum_by(index: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """Sums of the rows of values (N, K) with the same index, (size, K)"""
+    return np.stack([np.bincount(index, weights=values[:, k], minlength=size) for k in range(values.shape[1])], axis=1)
+
+
+def _vertex_quadrics(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """Sum of the area weighted plane quadrics of the faces around each vertex, A (3, 3) and b (3) flattened to (V, 12)"""
+    corners = vertices[faces].astype(np.float64)
+    cross = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    area = np.linalg.norm(cross, axis=1) / 2
+    normals = np.zeros_like(cross)
+    np.divide(cross, 2 * area[:, None], out=normals, where=area[:, None] > 0)
+    offsets = -(normals * corners[:, 0]).sum(axis=1)
+
+    # plane n.x + d = 0 weighted by area: A = area n n^T, b = area d n
+    face_a = area[:, None, None] * normals[:, :, None] * normals[:, None, :]
+    face_b = (area * offsets)[:, None] * normals
+    face_quadrics = np.concatenate([face_a.reshape(-1, 9), face_b], axis=1)
+    return _sum_by(faces.ravel(), np.repeat(face_quadrics, 3, axis=0), len(vertices))
+
+
+def cluster_vertices(vertices: np.ndarray, faces: np.ndarray, cell_size: float, quadrics=None):
+    """
+    Simplify a mesh by merging the vertices of each cell of a uniform grid into one
+
+    The merged vertex minimizes the distance to the planes of the faces around the cell
+    (quadric error), pulled slightly towards the mean of the cell and kept inside the cell.
+
+    Args:
+        vertices: float32 (V, 3)
+        faces: int32 (F, 3)
+        cell_size: Edge length of the grid cells
+        quadrics: Optional quadrics of the vertices from _vertex_quadrics, reused across cell sizes
+
+    Returns:
+        Tuple of vertices float32 (V', 3) and faces int32 (F', 3), without degenerate and duplicate faces
+    """
+    if quadrics is None:
+        quadrics = _vertex_quadrics(vertices, faces)
+    origin = vertices.min(axis=0).astype(np.float64)
+    cells = np.floor((vertices - origin) / cell_size).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * shape[1] + cells[:, 1]) * shape[2] + cells[:, 2]
+    _, first, cluster = np.unique(keys, return_index=True, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    num_clusters = len(first)
+
+    counts = np.bincount(cluster, minlength=num_clusters)
+    mean = _sum_by(cluster, vertices, num_clusters) / counts[:, None]
+    cluster_quadrics = _sum_by(cluster, quadrics, num_clusters)
+    cluster_a = cluster_quadrics[:, :9].reshape(-1, 3, 3)
+    cluster_b = cluster_quadrics[:, 9:]
+
+    # minimize x^T A x + 2 b^T x + w |x - mean|^2, w keeps flat and edge cells well posed
+    weight = 1e-3 * np.trace(cluster_a, axis1=1, axis2=2) / 3
+    weight = np.where(weight > 0, weight, 1.0)[:, None]
+    system = cluster_a + weight[:, :, None] * np.eye(3)
+    merged = np.linalg.solve(system, (weight * mean - cluster_b)[:, :, None])[:, :, 0]
+    cell_min = origin + cells[first] * cell_size
+    merged = np.clip(merged, cell_min, cell_min + cell_size)
+
+    new_faces = cluster[faces]
+    keep = (new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2]) & (new_faces[:, 2] != new_faces[:, 0])
+    new_faces = new_faces[keep]
+    # faces merged onto the same three vertices, in either orientation
+    _, unique = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(unique)]
+
+    # drop the clusters left without a face
+    used = np.unique(new_faces)
+    remap = np.full(num_clusters, -1, dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    return merged[used].astype(np.float32), remap[new_faces].astype(np.int32)
+
+
+def build_lods(vertices: np.ndarray, faces: np.ndarray) -> list:
+    """
+    Coarser levels of detail of a mesh, each with about 1/LOD_REDUCTION of the triangles of the previous one
+
+    Returns:
+        List of (vertices, faces) of the levels 1, 2, ..., down to MIN_LOD_FACES triangles
+    """
+    if len(faces) == 0:
+        return []
+    quadrics = _vertex_quadrics(vertices, faces)
+    corners = vertices[faces].astype(np.float64)
+    area = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1).sum() / 2
+
+    lods = []
+    budget = len(faces) // LOD_REDUCTION
+    while budget >= MIN_LOD_FACES and area > 0:
+        # a surface through n cells of size s has about 2 n = 2 area / s^2 triangles
+        cell_size = np.sqrt(2 * area / budget)
+        for _ in range(LOD_ATTEMPTS):
+            lod_vertices, lod_faces = cluster_vertices(vertices, faces, cell_size, quadrics)
+            if len(lod_faces) <= budget:
+                break
+            cell_size *= 1.05 * np.sqrt(len(lod_faces) / budget)
+        if len(lod_faces) < MIN_LOD_FACES or (lods and len(lod_faces) >= len(lods[-1][1])):
+            break
+        lods.append((lod_vertices, lod_faces))
+        budget = len(lod_faces) // LOD_REDUCTION
+    return lods
+
+
+def lod_prefix(level: int) -> str:
+    """Prefix of the array names of a level of detail, level 0 is the full mesh"""
+    return "" if level == 0 else f"lod{level}_"
+
+
+def mesh_bounds(vertices: np.ndarray) -> np.ndarray:
+    if len(vertices) == 0:
+        return np.zeros((2, 3), dtype=np.float32)
+    return np.stack([vertices.min(axis=0), vertices.max(axis=0)]).astype(np.float32)
+
+
+def write_mesh_arrays(stl_path: Path, arrays: dict, source_triangles: int):
+    """
+    Write the mesh of an STL file next to it, replacing an older copy
+
+    Args:
+        stl_path: Path of the STL file
+        arrays: vertices, faces, normals and bounds, and the vertices, faces and normals of the
+            coarser levels with their lod_prefix
+        source_triangles: Triangles in the STL file
+    """
+    lods = []
+    level = 0
+    while f"{lod_prefix(level)}faces" in arrays:
+        lods.append({
+            "level": level,
+            "num_vertices": int(len(arrays[f"{lod_prefix(level)}vertices"])),
+            "num_faces": int(len(arrays[f"{lod_prefix(level)}faces"])),
+        })
+        level += 1
+
+    meta = {
+        "version": FORMAT_VERSION,
+        "num_vertices": int(len(arrays["vertices"])),
+        "num_faces": int(len(arrays["faces"])),
+        "source_triangles": int(source_triangles),
+        "bounds": arrays["bounds"].tolist(),
+        "lods": lods,
+    }
+    write_arrays(get_mesh_dir(stl_path), stl_path, arrays, meta)
+
+
+def read_mesh_meta(stl_path: Path):
+    """meta.json of the mesh of an STL file, None if missing, older than the file or of an older format"""
+    meta = read_arrays_meta(get_mesh_dir(stl_path), stl_path)
+    if meta is None or meta.get("version") != FORMAT_VERSION:
+        return None
+    return meta
+
+
+def remove_mesh_arrays(stl_path: Path):
+    remove_arrays(get_mesh_dir(stl_path))
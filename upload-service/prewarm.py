@@ -0,0 +1,79 @@
+"""
+Prewarm notifications to the inference service
+
+Once the processing job of an upload is done the inference service is asked to prepare the new
+file in the background (a 'prewarm' request, see service_zmq.py), so the first selection of the
+file is served from its cache instead of parsing it. With pyzmq installed the request goes to the control socket
+of the service (PREWARM_ADDRESS). Without pyzmq, or if the service does not answer, the
+notification is spooled as a file in `.prewarm/` of the upload directory, which the service
+polls. Notifications are sent from a background thread, uploads never wait for them.
+"""
+import os
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+PREWARM_ADDRESS = os.environ.get("PREWARM_ADDRESS", "tcp://localhost:5555")    # "" to only spool
+PREWARM_TIMEOUT_MS = 1000
+MAX_SPOOLED = 100       # oldest notifications dropped beyond this, while the service is not running
+
+
+class PrewarmNotifier:
+    """Sends the prewarm notifications of the uploads, spooled to `spool_dir` when the socket is not available"""
+
+    def __init__(self, spool_dir: Path, address: str = PREWARM_ADDRESS):
+        self.spool_dir = spool_dir
+        self.address = address if zmq is not None else ""
+        self.context = zmq.Context.instance() if self.address else None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prewarm")
+
+    def notify(self, kind: str, filename: str):
+        """Queue the notification of an uploaded file"""
+        self.executor.submit(self._send, {"request_type": "prewarm", "kind": kind, "filename": filename})
+
+    def _send(self, notification: dict):
+        try:
+            if not self.address or not self._request(notification):
+                self._spool(notification)
+        except Exception as e:
+            print(f"WARNING: Could not send the prewarm notification of '{notification['filename']}': {e}")
+
+    def _request(self, notification: dict) -> bool:
+        """Send a prewarm request on the control socket, False if the service did not answer"""
+        # a socket per request, a REQ socket left without a reply cannot send again
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.SNDTIMEO, PREWARM_TIMEOUT_MS)
+        socket.setsockopt(zmq.RCVTIMEO, PREWARM_TIMEOUT_MS)
+        try:
+            socket.connect(self.address)
+            socket.send_json(notification)
+            reply = socket.recv_json()
+        except zmq.ZMQError as e:
+            print(f"WARNING: No answer from the inference service at {self.address} ({e}), spooling the prewarm notification")
+            return False
+        finally:
+            socket.close()
+
+        if "error" in reply:
+            print(f"WARNING: Prewarm of '{notification['filename']}' refused: {reply['error']}")
+        return True
+
+    def _spool(self, notification: dict):
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        tmp_path = self.spool_dir / f".{name}.tmp"
+        with tmp_path.open("w") as f:
+            json.dump(notification, f)
+        os.replace(tmp_path, self.spool_dir / name)
+
+        spooled = sorted(self.spool_dir.glob("*.json"))
+        for path in spooled[:max(0, len(spooled) - MAX_SPOOLED)]:
+            path.unlink(missing_ok=True)
@@ -0,0 +1,120 @@
+"""
+Processing stages of the uploaded files, run as jobs (see jobs.py)
+
+STL: welded indexed mesh, vertex normals, bounds and coarser levels of detail (`<name>.mesh/`).
+Streamlines: binary copy (`<name>.arrays/`) with the lines simplified for display and statistics
+of the lines and scalars (its stats.json).
+The artifacts are written once per content in the content store and linked to each name.
+"""
+import os
+import json
+import numpy as np
+from pathlib import Path
+from typing import Callable, Optional
+
+from content_store import ContentStore
+from jobs import Job
+from mesh_arrays import (read_stl, weld_vertices, vertex_normals, mesh_bounds, build_lods, lod_prefix,
+                         write_mesh_arrays, read_mesh_meta, get_mesh_dir)
+from streamline_arrays import (convert_streamlines, add_simplified, write_streamline_arrays, read_streamline_meta,
+                               get_arrays_dir, compute_streamline_stats, write_streamline_stats, read_streamline_stats,
+                               SIMPLIFY_TOLERANCE, SCALAR_TOLERANCE)
+
+
+def _link_stage(content_store: ContentStore, object_path: Path, destination: Path, get_dir,
+                on_linked: Optional[Callable[[], None]]):
+    def link(context):
+        # the name may have been uploaded again with other content meanwhile
+        if destination.exists() and os.path.samefile(destination, object_path):
+            content_store.link_derived(object_path, destination, get_dir)
+            if on_linked is not None:
+                on_linked()
+    return ("link", link)
+
+
+def _mesh_stages(job: Job, object_path: Path) -> list:
+    meta = read_mesh_meta(object_path)
+    if meta is not None:
+        job.result.update({k: meta[k] for k in ("num_vertices", "num_faces", "source_triangles", "bounds", "lods")})
+        return []
+
+    def read(context):
+        context["triangles"] = read_stl(object_path)
+
+    def weld(context):
+        triangles = context.pop("triangles")
+        context["source_triangles"] = len(triangles)
+        context["vertices"], context["faces"] = weld_vertices(triangles)
+
+    def normals(context):
+        context["normals"] = vertex_normals(context["vertices"], context["faces"])
+        context["bounds"] = mesh_bounds(context["vertices"])
+
+    def lods(context):
+        context["lods"] = [(vertices, faces, vertex_normals(vertices, faces))
+                           for vertices, faces in build_lods(context["vertices"], context["faces"])]
+
+    def write(context):
+        arrays = {name: context[name] for name in ("vertices", "faces", "normals", "bounds")}
+        for level, (vertices, faces, normals) in enumerate(context["lods"], start=1):
+            arrays.update({f"{lod_prefix(level)}vertices": vertices, f"{lod_prefix(level)}faces": faces,
+                           f"{lod_prefix(level)}normals": normals})
+        write_mesh_arrays(object_path, arrays, context["source_triangles"])
+        meta = read_mesh_meta(object_path)
+        job.result.update({k: meta[k] for k in ("num_vertices", "num_faces", "source_triangles", "bounds", "lods")})
+
+    return [("read", read), ("weld", weld), ("normals", normals), ("lods", lods), ("write", write)]
+
+
+def _streamline_stages(job: Job, object_path: Path) -> list:
+    stages = []
+    if read_streamline_meta(object_path) is None:
+        def convert(context):
+            with object_path.open() as f:
+                write_streamline_arrays(object_path, convert_streamlines(json.load(f)))
+        stages.append(("convert", convert))
+
+    tolerance = [SIMPLIFY_TOLERANCE, SCALAR_TOLERANCE]
+    meta = read_streamline_meta(object_path)
+    if SIMPLIFY_TOLERANCE > 0 and (meta is None or meta.get("simplify_tolerance") != tolerance):
+        def simplify(context):
+            # rewrites the copy, readers keep their memory maps of the replaced files
+            meta = read_streamline_meta(object_path)
+            arrays_dir = get_arrays_dir(object_path)
+            arrays = {name: np.load(arrays_dir / f"{name}.npy") for name in meta["arrays"]
+                      if name not in ("kept", "kept_counts")}
+            arrays = add_simplified(arrays, *tolerance)
+            write_streamline_arrays(object_path, arrays, tolerance)
+        stages.append(("simplify", simplify))
+
+    def stats(context):
+        stats = read_streamline_stats(object_path)
+        if stats is None:
+            meta = read_streamline_meta(object_path)
+            arrays_dir = get_arrays_dir(object_path)
+            arrays = {name: np.load(arrays_dir / f"{name}.npy", mmap_mode="r") for name in meta["arrays"]}
+            stats = compute_streamline_stats(arrays)
+            write_streamline_stats(object_path, stats)
+        job.result.update({k: v for k, v in stats.items() if not k.startswith("source_")})
+        job.result["num_kept_points"] = read_streamline_meta(object_path).get("num_kept_points")
+
+    stages.append(("stats", stats))
+    return stages
+
+
+def plan_processing(content_store: ContentStore, kind: str, destination: Path,
+                    on_linked: Optional[Callable[[], None]] = None) -> Callable[[Job], list]:
+    """Plan of the job of an uploaded file, the stages still needed for its content, `on_linked` runs after the link"""
+
+    def plan(job: Job) -> list:
+        object_path = content_store.get_object(job.sha256)
+        if object_path is None:
+            raise RuntimeError(f"Content of '{job.filename}' is no longer stored")
+
+        if kind == "stl":
+            link = _link_stage(content_store, object_path, destination, get_mesh_dir, on_linked)
+            return _mesh_stages(job, object_path) + [link]
+        link = _link_stage(content_store, object_path, destination, get_arrays_dir, on_linked)
+        return _streamline_stages(job, object_path) + [link]
+
+    return plan
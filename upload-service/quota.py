@@ -0,0 +1,171 @@
+"""
+Storage quota of the uploaded files
+
+Usage counts the stored objects and their derived artifacts (see content_store.py) and the
+files copied in by hand with their arrays. Above the quota, the least recently accessed
+contents are evicted until usage is back under QUOTA_LOW_WATER of the quota: first their
+derived artifacts, which the loaders can do without and the next upload of the content
+writes again, then the uploads themselves with all their names. The last access of a
+content is the latest access of its names recorded in the file index (upload, download of
+the file or of its artifacts).
+"""
+import os
+import time
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Callable
+
+from content_store import ContentStore, dir_size
+from file_index import FileIndex
+from streamline_arrays import remove_arrays
+
+QUOTA_BYTES = int(os.environ.get("UPLOAD_QUOTA_BYTES", "0"))            # 0: no quota
+QUOTA_LOW_WATER = float(os.environ.get("UPLOAD_QUOTA_LOW_WATER", "0.9"))  # eviction frees down to this fraction
+MAX_EVICTIONS = 100     # recent evictions kept for the usage endpoint
+
+
+class StorageQuota:
+    """
+    Quota of the upload directory
+
+    Args:
+        content_store: Stored objects and their aliases
+        file_index: Index of all uploaded files, with their last access
+        artifact_dirs: Upload kind -> function of a file path returning the directory of its artifacts
+        remove_file: Called with (kind, name) to delete an uploaded file, its artifacts and index row
+        quota_bytes: Quota, 0 for none
+        low_water: Fraction of the quota eviction frees down to
+    """
+
+    def __init__(self, content_store: ContentStore, file_index: FileIndex, artifact_dirs: dict,
+                 remove_file: Callable[[str, str], None], quota_bytes: int = QUOTA_BYTES,
+                 low_water: float = QUOTA_LOW_WATER):
+        self.content_store = content_store
+        self.file_index = file_index
+        self.artifact_dirs = artifact_dirs
+        self.remove_file = remove_file
+        self.quota_bytes = quota_bytes
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        self.evictions = deque(maxlen=MAX_EVICTIONS)
+
+    def _contents(self) -> list:
+        """Stored contents and files copied in by hand, with their sizes and last access"""
+        files = self.file_index.list_all()
+        accessed = {(f["kind"], f["name"]): f["accessed"] or 0.0 for f in files}
+
+        contents = []
+        stored = set()
+        for entry in self.content_store.list_objects():
+            names = entry["aliases"]
+            stored.update(names)
+            contents.append({"sha256": entry["sha256"], "names": names, "size_bytes": entry["size_bytes"],
+                             "derived_bytes": entry["derived_bytes"], "artifacts_dir": None,
+                             "accessed": max([accessed.get(name, 0.0) for name in names], default=0.0)})
+
+        for f in files:
+            name = (f["kind"], f["name"])
+            if name in stored:
+                continue
+            artifacts_dir = self.artifact_dirs[f["kind"]](Path(f["path"]))
+            contents.append({"sha256": f["sha256"], "names": [name], "size_bytes": f["size_bytes"],
+                             "derived_bytes": dir_size(artifacts_dir), "artifacts_dir": artifacts_dir,
+                             "accessed": accessed[name]})
+        return contents
+
+    def _evict(self, content: dict, what: str, freed: int):
+        record = {
+            "evicted": what,
+            "names": [f"{kind}/{name}" for kind, name in content["names"]],
+            "sha256": content["sha256"],
+            "freed_bytes": freed,
+            "last_access": content["accessed"],
+            "time": time.time(),
+        }
+        self.evictions.append(record)
+        print(f"Quota: evicted {what} of {', '.join(record['names'])} ({freed} bytes)")
+        return record
+
+    def _remove_artifacts(self, content: dict) -> int:
+        if content["artifacts_dir"] is not None:
+            freed = dir_size(content["artifacts_dir"])
+            remove_arrays(content["artifacts_dir"])
+            return freed
+        return self.content_store.remove_derived(content["sha256"])
+
+    def _remove_upload(self, content: dict) -> int:
+        removed = 0
+        for kind, name in content["names"]:
+            # skip a name uploaded again with other content meanwhile
+            row = self.file_index.get(kind, name)
+            if row is not None and content["sha256"] is not None and row["sha256"] != content["sha256"]:
+                continue
+            self.remove_file(kind, name)
+            removed += 1
+        return content["size_bytes"] + content["derived_bytes"] if removed == len(content["names"]) else 0
+
+    def enforce(self, busy=()) -> list:
+        """
+        Evict the least recently accessed contents while usage is above the quota (blocking, run it in a worker thread)
+
+        Args:
+            busy: sha256 of the contents being uploaded or processed, never evicted
+
+        Returns:
+            The evictions, dictionaries with what was evicted ("artifacts" or "upload"), the names and the bytes freed
+        """
+        if self.quota_bytes <= 0:
+            return []
+        with self.lock:
+            contents = self._contents()
+            used = sum(content["size_bytes"] + content["derived_bytes"] for content in contents)
+            if used <= self.quota_bytes:
+                return []
+            target = self.quota_bytes * self.low_water
+            contents.sort(key=lambda content: content["accessed"])
+
+            evicted = []
+            for content in contents:
+                if used <= target:
+                    break
+                if content["derived_bytes"] > 0 and content["sha256"] not in busy:
+                    freed = self._remove_artifacts(content)
+                    for kind in {kind for kind, _ in content["names"]}:
+                        self.file_index.changed(kind)
+                    content["derived_bytes"] = 0
+                    used -= freed
+                    evicted.append(self._evict(content, "artifacts", freed))
+
+            for content in contents:
+                if used <= target:
+                    break
+                if content["sha256"] not in busy:
+                    freed = self._remove_upload(content)
+                    if freed:
+                        used -= freed
+                        evicted.append(self._evict(content, "upload", freed))
+
+            if used > self.quota_bytes:
+                print(f"WARNING: Upload storage at {used} bytes, over the quota of {self.quota_bytes} bytes")
+            return evicted
+
+    def get_usage(self) -> dict:
+        """Storage usage against the quota and the recent evictions (blocking, run it in a worker thread)"""
+        with self.lock:
+            contents = self._contents()
+        original_bytes = sum(content["size_bytes"] for content in contents)
+        derived_bytes = sum(content["derived_bytes"] for content in contents)
+        store = self.content_store.get_usage()
+        return {
+            "quota_bytes": self.quota_bytes or None,
+            "low_water_bytes": int(self.quota_bytes * self.low_water) if self.quota_bytes else None,
+            "used_bytes": original_bytes + derived_bytes,
+            "original_bytes": original_bytes,
+            "derived_bytes": derived_bytes,
+            "deduplicated_bytes": store["aliased_bytes"] - store["stored_bytes"],
+            "contents": len(contents),
+            "files": sum(len(content["names"]) for content in contents),
+            "oldest_access": min((content["accessed"] for content in contents), default=None),
+            "recent_evictions": list(self.evictions),
+        }
@@ -0,0 +1,298 @@
+"""
+Binary columnar copy of an uploaded streamlines JSON file
+
+Written at upload time to `<name>.arrays/` next to `<name>.json`, so readers memory map
+a few .npy files instead of parsing the JSON. See STREAMLINE_FORMAT.md for the layout.
+"""
+import os
+import json
+import shutil
+import uuid
+import numpy as np
+from pathlib import Path
+
+ARRAYS_SUFFIX = ".arrays"
+FORMAT_VERSION = 1
+# Douglas-Peucker tolerance of the simplified lines, relative to the diagonal of the bounds (0 disables it)
+SIMPLIFY_TOLERANCE = float(os.environ.get("STREAMLINE_TOLERANCE", "1e-4"))
+# largest change of the colors of the simplified lines, relative to the range of the scalars (below one 8 bit step)
+SCALAR_TOLERANCE = float(os.environ.get("STREAMLINE_SCALAR_TOLERANCE", str(1 / 512)))
+TINY = 1e-30
+STATS_PERCENTILES = [5, 25, 50, 75, 95]
+STATS_BINS = 32
+
+
+def get_arrays_dir(json_path: Path) -> Path:
+    return json_path.with_suffix(ARRAYS_SUFFIX)
+
+
+def simplify_polylines(points: np.ndarray, counts: np.ndarray, tolerance: float,
+                       scalars: np.ndarray = None, scalar_tolerance: float = None) -> np.ndarray:
+    """
+    Douglas-Peucker simplification of many polylines at once
+
+    All lines are split in the same passes: each pass finds the point farthest from the chord of
+    every open span and keeps it if it is farther than the tolerance, splitting the span in two.
+    With scalars, a point is also kept where its scalar differs from the scalar interpolated along
+    the chord by more than the scalar tolerance, so colors along the lines do not change either.
+
+    Args:
+        points: Points of all lines, one after the other (P, 3)
+        counts: Number of points of each line (L,)
+        tolerance: Largest distance of a dropped point to the simplified line, positive
+        scalars: Optional scalars of the points (P,), NaN for none
+        scalar_tolerance: Largest difference of a dropped scalar to the interpolated one, positive
+
+    Returns:
+        Sorted indices of the kept points, the first and last point of each line are always kept
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if scalars is not None:
+        scalars = np.nan_to_num(np.asarray(scalars, dtype=np.float64))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    keep = np.zeros(len(points), dtype=bool)
+    keep[starts[counts > 0]] = True
+    keep[ends[counts > 0] - 1] = True
+
+    # spans between two kept points with points in between
+    span_start = starts[counts > 2]
+    span_end = ends[counts > 2] - 1
+    while len(span_start) > 0:
+        inner = span_end - span_start - 1
+        offsets = np.concatenate([[0], np.cumsum(inner)[:-1]])
+        span = np.repeat(np.arange(len(inner)), inner)
+        index = np.arange(inner.sum()) - offsets[span] + span_start[span] + 1
+
+        # distance to the chord segment of the span
+        a = points[span_start[span]]
+        chord = points[span_end[span]] - a
+        offset = points[index] - a
+        chord_sq = np.einsum("ij,ij->i", chord, chord)
+        t = np.zeros(len(index))
+        np.divide(np.einsum("ij,ij->i", offset, chord), chord_sq, out=t, where=chord_sq > 0)
+        t = np.clip(t, 0.0, 1.0)
+        offset -= t[:, None] * chord
+        error = np.sqrt(np.einsum("ij,ij->i", offset, offset)) / tolerance
+        if scalars is not None:
+            start_scalar = scalars[span_start[span]]
+            interpolated = start_scalar + t * (scalars[span_end[span]] - start_scalar)
+            error = np.maximum(error, np.abs(scalars[index] - interpolated) / scalar_tolerance)
+
+        max_error = np.maximum.reduceat(error, offsets)
+        # first point at the maximum of each span, the spans are in order
+        at_max = np.flatnonzero(error == max_error[span])
+        first = at_max[np.diff(span[at_max], prepend=-1) != 0]
+        farthest = index[first]
+
+        split = max_error > 1.0
+        keep[farthest[split]] = True
+        new_start = np.concatenate([span_start[split], farthest[split]])
+        new_end = np.concatenate([farthest[split], span_end[split]])
+        span_start, span_end = new_start[new_end - new_start > 1], new_end[new_end - new_start > 1]
+
+    return np.flatnonzero(keep)
+
+
+def add_simplified(arrays: dict, tolerance: float = SIMPLIFY_TOLERANCE, scalar_tolerance: float = SCALAR_TOLERANCE) -> dict:
+    """
+    Add the simplified lines to the arrays of a streamlines file
+
+    Args:
+        arrays: Arrays from convert_streamlines
+        tolerance: Tolerance relative to the diagonal of the bounds
+        scalar_tolerance: Tolerance of the scalars relative to their range
+
+    Returns:
+        The arrays with kept, the sorted indices of the kept points (K,), and kept_counts,
+        their number per line int32 (L,); the scalars of the kept points are scalars[kept]
+    """
+    points, counts, bounds = arrays["points"], np.asarray(arrays["counts"]), arrays["bounds"]
+    diagonal = float(np.linalg.norm(np.asarray(bounds[1], dtype=np.float64) - bounds[0]))
+    distance_tolerance = max(tolerance * diagonal, TINY)
+
+    scalars = arrays.get("scalars")
+    scalar_range = float(np.nanmax(scalars) - np.nanmin(scalars)) if scalars is not None and np.isfinite(scalars).any() else 0.0
+    if scalar_range > 0:
+        kept = simplify_polylines(points, counts, distance_tolerance, scalars, max(scalar_tolerance * scalar_range, TINY))
+    else:
+        kept = simplify_polylines(points, counts, distance_tolerance)
+
+    line = np.repeat(np.arange(len(counts)), counts)
+    return dict(arrays, kept=kept.astype(np.int32 if len(points) < 2 ** 31 else np.int64),
+                kept_counts=np.bincount(line[kept], minlength=len(counts)).astype(np.int32))
+
+
+def convert_streamlines(data: dict) -> dict:
+    """
+    Columnar arrays of the streamlines of a parsed JSON file
+
+    Args:
+        data: Parsed streamlines JSON
+
+    Returns:
+        Dictionary of arrays: points float32 (P, 3), counts int32 (L,), bounds float32 (2, 3),
+        scalars float32 (P,) and colors float32 (L, 3) if any line has them (NaN for the others)
+    """
+    streamlines = data.get("streamlines", [])
+    counts = np.array([len(s["path"]) for s in streamlines], dtype=np.int32)
+    num_points = int(counts.sum())
+
+    points = np.empty((num_points, 3), dtype=np.float32)
+    scalars = np.full(num_points, np.nan, dtype=np.float32)
+    colors = np.full((len(streamlines), 3), np.nan, dtype=np.float32)
+    has_scalars = False
+    has_colors = False
+
+    start = 0
+    for i, streamline in enumerate(streamlines):
+        end = start + counts[i]
+        points[start:end] = np.asarray(streamline["path"], dtype=np.float32).reshape(-1, 3)
+
+        # scalars of another length than the path are left out, as by the readers of the JSON
+        scalar = streamline.get("scalar")
+        if scalar is not None and len(scalar) == counts[i]:
+            scalars[start:end] = np.asarray(scalar, dtype=np.float32)
+            has_scalars = True
+
+        color = streamline.get("color")
+        if color is not None and len(color) == 3:
+            colors[i] = np.asarray(color, dtype=np.float32)
+            has_colors = True
+        start = end
+
+    if num_points > 0:
+        bounds = np.stack([points.min(axis=0), points.max(axis=0)])
+    else:
+        bounds = np.zeros((2, 3), dtype=np.float32)
+
+    arrays = {"points": points, "counts": counts, "bounds": bounds.astype(np.float32)}
+    if has_scalars:
+        arrays["scalars"] = scalars
+    if has_colors:
+        arrays["colors"] = colors
+    return arrays
+
+
+def write_arrays(arrays_dir: Path, source_path: Path, arrays: dict, meta: dict):
+    """
+    Write arrays as .npy files and a meta.json to a directory, replacing an older copy
+
+    The meta.json records the size and modification time of the source file,
+    readers ignore the arrays of a source file that changed since.
+    """
+    tmp_dir = arrays_dir.with_name(f".{arrays_dir.name}.{uuid.uuid4().hex}.tmp")
+    tmp_dir.mkdir(parents=True)
+
+    try:
+        for name, array in arrays.items():
+            np.save(tmp_dir / f"{name}.npy", array)
+
+        stat = source_path.stat()
+        meta = dict(meta, arrays=sorted(arrays), source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+        with (tmp_dir / "meta.json").open("w") as f:
+            json.dump(meta, f)
+
+        remove_arrays(arrays_dir)
+        os.replace(tmp_dir, arrays_dir)
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_arrays_meta(arrays_dir: Path, source_path: Path, filename: str = "meta.json"):
+    """meta.json (or another JSON file) of an arrays directory, None if missing or older than the source file"""
+    try:
+        with (arrays_dir / filename).open() as f:
+            meta = json.load(f)
+        stat = source_path.stat()
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("source_size") != stat.st_size or meta.get("source_mtime_ns") != stat.st_mtime_ns:
+        return None
+    return meta
+
+
+def remove_arrays(arrays_dir: Path):
+    if arrays_dir.is_symlink():
+        arrays_dir.unlink()     # copy shared with other names of the same content, see content_store.py
+    elif arrays_dir.exists():
+        shutil.rmtree(arrays_dir, ignore_errors=True)
+
+
+def write_streamline_arrays(json_path: Path, arrays: dict, simplify_tolerance: list = None):
+    """Write the arrays of a streamlines file next to it, replacing an older copy (with the tolerances of the kept points)"""
+    meta = {
+        "version": FORMAT_VERSION,
+        "num_streamlines": int(len(arrays["counts"])),
+        "num_points": int(len(arrays["points"])),
+    }
+    if "kept" in arrays:
+        meta.update(num_kept_points=int(len(arrays["kept"])), simplify_tolerance=simplify_tolerance)
+    write_arrays(get_arrays_dir(json_path), json_path, arrays, meta)
+
+
+def read_streamline_meta(json_path: Path):
+    """meta.json of the arrays of a streamlines file, None if missing or older than the file"""
+    return read_arrays_meta(get_arrays_dir(json_path), json_path)
+
+
+def remove_streamline_arrays(json_path: Path):
+    remove_arrays(get_arrays_dir(json_path))
+
+
+def _summarize(values: np.ndarray) -> dict:
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"count": 0}
+    percentiles = np.percentile(values, STATS_PERCENTILES)
+    counts, edges = np.histogram(values, bins=STATS_BINS)
+    return {
+        "count": int(len(values)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "percentiles": {str(p): float(v) for p, v in zip(STATS_PERCENTILES, percentiles)},
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+    }
+
+
+def compute_streamline_stats(arrays: dict) -> dict:
+    """Statistics of the scalars, the point counts and the arc lengths of the lines of a streamlines file"""
+    points = np.asarray(arrays["points"], dtype=np.float64)
+    counts = np.asarray(arrays["counts"])
+
+    # segment lengths, without the segments joining the end of a line to the start of the next
+    lengths = np.zeros(len(counts))
+    if len(points) > 1:
+        segments = np.linalg.norm(np.diff(points, axis=0), axis=1)
+        segments[np.cumsum(counts)[:-1] - 1] = 0.0
+        segments = np.append(segments, 0.0)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        nonempty = counts > 0
+        lengths[nonempty] = np.add.reduceat(segments, starts[nonempty])
+
+    stats = {
+        "points_per_line": _summarize(counts.astype(np.float64)),
+        "line_length": _summarize(lengths),
+    }
+    if "scalars" in arrays:
+        stats["scalars"] = _summarize(np.asarray(arrays["scalars"], dtype=np.float64))
+    return stats
+
+
+def write_streamline_stats(json_path: Path, stats: dict):
+    """Add statistics to the binary copy of a streamlines file"""
+    stats_path = get_arrays_dir(json_path) / "stats.json"
+    stat = json_path.stat()
+    tmp_path = stats_path.with_name(f".stats.{uuid.uuid4().hex}.tmp")
+    with tmp_path.open("w") as f:
+        json.dump(dict(stats, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns), f)
+    os.replace(tmp_path, stats_path)
+
+
+def read_streamline_stats(json_path: Path):
+    """Statistics of a streamlines file, None if missing or older than the file"""
+    return read_arrays_meta(get_arrays_dir(json_path), json_path, "stats.json")
@@ -0,0 +1,101 @@
+import hashlib
+
+import pytest
+from fastapi import HTTPException
+
+from chunked_uploads import UploadStore
+
+DATA = bytes(range(256)) * 40
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(tmp_path / ".partial")
+
+
+def test_upload_in_chunks(store, tmp_path):
+    upload = store.create("stl", "a.stl", len(DATA), SHA256)
+    store.write(upload, DATA[:1000])
+    store.write(upload, DATA[1000:])
+
+    result = store.finalize(upload, tmp_path / "a.stl")
+    assert result["sha256"] == SHA256
+    assert (tmp_path / "a.stl").read_bytes() == DATA
+    assert upload.upload_id not in store.uploads
+
+
+def test_same_file_without_digest_is_a_new_upload(store):
+    first = store.create("stl", "a.stl", len(DATA))
+    store.write(first, DATA[:100])
+
+    second = store.create("stl", "a.stl", len(DATA))
+    assert second.upload_id != first.upload_id
+    assert second.offset == 0
+
+
+def test_resume_by_id(store):
+    first = store.create("stl", "a.stl", len(DATA))
+    store.write(first, DATA[:100])
+
+    resumed = store.create("stl", "a.stl", len(DATA), upload_id=first.upload_id)
+    assert resumed is first
+    assert resumed.offset == 100
+
+
+def test_resume_by_id_of_another_file(store):
+    first = store.create("stl", "a.stl", len(DATA))
+    with pytest.raises(HTTPException) as error:
+        store.create("stl", "b.stl", len(DATA), upload_id=first.upload_id)
+    assert error.value.status_code == 409
+
+
+def test_resume_by_expired_id_starts_over(store):
+    upload = store.create("stl", "a.stl", len(DATA), upload_id="expired")
+    assert upload.upload_id != "expired"
+    assert upload.offset == 0
+
+
+def test_resume_by_digest(store):
+    first = store.create("stl", "a.stl", len(DATA), SHA256)
+    store.write(first, DATA[:100])
+
+    assert store.create("stl", "a.stl", len(DATA), SHA256.upper()) is first
+    assert store.create("stl", "a.stl", len(DATA), "0" * 64) is not first
+
+
+def test_resume_after_restart(store, tmp_path):
+    upload = store.create("stl", "a.stl", len(DATA), SHA256)
+    store.write(upload, DATA[:100])
+    store.save(upload)
+
+    restarted = UploadStore(tmp_path / ".partial")
+    resumed = restarted.create("stl", "a.stl", len(DATA), upload_id=upload.upload_id)
+    assert resumed.offset == 100
+    restarted.write(resumed, DATA[100:])
+    assert restarted.finalize(resumed, tmp_path / "a.stl")["sha256"] == SHA256
+
+
+def test_chunk_past_the_size(store):
+    upload = store.create("stl", "a.stl", 10)
+    with pytest.raises(HTTPException) as error:
+        store.write(upload, DATA[:11])
+    assert error.value.status_code == 400
+
+
+def test_checksum_mismatch(store, tmp_path):
+    upload = store.create("stl", "a.stl", len(DATA), "0" * 64)
+    store.write(upload, DATA)
+    with pytest.raises(HTTPException) as error:
+        store.finalize(upload, tmp_path / "a.stl")
+    assert error.value.status_code == 400
+    assert upload.upload_id not in store.uploads
+    assert not (tmp_path / "a.stl").exists()
+
+
+def test_incomplete_upload(store, tmp_path):
+    upload = store.create("stl", "a.stl", len(DATA))
+    store.write(upload, DATA[:100])
+    with pytest.raises(HTTPException) as error:
+        store.finalize(upload, tmp_path / "a.stl")
+    assert error.value.status_code == 400
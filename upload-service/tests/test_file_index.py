@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+import file_index
+from file_index import FileIndex
+
+STL = b"solid t\nendsolid t\n"
+
+
+@pytest.fixture
+def directories(tmp_path):
+    stl_dir = tmp_path / "stl"
+    stl_dir.mkdir()
+    return {"stl": (stl_dir, ".stl")}
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    '''Directories rescanned in full by FileIndex.sync'''
+
+    scanned = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scanned.append(str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(file_index.os, "scandir", counting_scandir)
+    return scanned
+
+
+def names(index):
+    files, total = index.query("stl")
+    return [f["name"] for f in files]
+
+
+def test_changes_of_the_service_do_not_rescan(tmp_path, directories, scans):
+    index = FileIndex(tmp_path / "index.sqlite", directories)
+    stl_dir, _ = directories["stl"]
+    assert names(index) == []
+    assert len(scans) == 1
+
+    (stl_dir / "a.stl").write_bytes(STL)
+    index.add("stl", stl_dir / "a.stl", "0" * 64)
+    assert names(index) == ["a.stl"]
+
+    (stl_dir / "a.stl").unlink()
+    index.remove("stl", "a.stl")
+    assert names(index) == []
+    assert len(scans) == 1
+
+
+def test_files_copied_by_hand_are_rescanned(tmp_path, directories, scans):
+    index = FileIndex(tmp_path / "index.sqlite", directories)
+    stl_dir, _ = directories["stl"]
+    assert names(index) == []
+
+    (stl_dir / "hand.stl").write_bytes(STL)
+    (stl_dir / ".hidden.stl").write_bytes(STL)
+    assert names(index) == ["hand.stl"]
+    assert len(scans) == 2
+
+
+def test_rescan_after_startup(tmp_path, directories, scans):
+    stl_dir, _ = directories["stl"]
+    index = FileIndex(tmp_path / "index.sqlite", directories)
+    assert names(index) == []
+
+    # an add before the first listing of a new process leaves the startup rescan to find the rest
+    (stl_dir / "hand.stl").write_bytes(STL)
+    restarted = FileIndex(tmp_path / "index.sqlite", directories)
+    (stl_dir / "a.stl").write_bytes(STL)
+    restarted.add("stl", stl_dir / "a.stl")
+    assert names(restarted) == ["a.stl", "hand.stl"]
+    assert len(scans) == 2
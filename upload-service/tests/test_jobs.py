@@ -0,0 +1,52 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from jobs import JobQueue
+
+
+def wait(job, timeout=5.0):
+    deadline = time.time() + timeout
+    while job.finished is None and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_stages_share_a_context():
+    queue = JobQueue()
+
+    def plan(job):
+        def first(context):
+            context["value"] = 1
+
+        def second(context):
+            job.result["value"] = context["value"] + 1
+
+        return [("first", first), ("second", second)]
+
+    job = wait(queue.submit("stl", "a.stl", "0" * 64, plan))
+    assert job.to_dict()["status"] == "done"
+    assert job.stages == ["first", "second"]
+    assert job.result == {"value": 2}
+    assert job.progress == 1.0
+    assert queue.get(job.job_id) is job
+
+
+def test_failed_stage():
+    queue = JobQueue()
+
+    def fail(context):
+        raise RuntimeError("broken")
+
+    job = wait(queue.submit("stl", "a.stl", "0" * 64, lambda job: [("fail", fail), ("never", lambda context: None)]))
+    assert job.status == "failed"
+    assert job.error == "broken"
+    assert job.completed == 0
+    assert queue.list("failed") == [job]
+
+
+def test_unknown_job():
+    with pytest.raises(HTTPException) as error:
+        JobQueue().get("missing")
+    assert error.value.status_code == 404